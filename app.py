@@ -1,13 +1,39 @@
-from flask import Flask, request, render_template, jsonify, session, Response, redirect, url_for
+from flask import Flask, request, render_template, jsonify, session, Response, redirect, url_for, abort
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from datetime import datetime
+import gzip
+import mimetypes
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import uuid
 import time
-from functools import wraps
+from collections import OrderedDict, deque
+from types import MappingProxyType
+import hashlib
+import atexit
+import ctypes
+import ctypes.util
+import random
+import select
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import re
+import sqlite3
+import numpy as np
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: a single development server, nothing to lock against
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,18 +41,306 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-here')
 
-# In-memory storage for resumes and chat history
+# In-memory storage for resumes (chat history lives in conversation_store)
 resumes_storage = {}
 
 # DeepSeek API configuration
 DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
-DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
+DEEPSEEK_API_URL = os.getenv('DEEPSEEK_API_URL', "https://api.deepseek.com/v1/chat/completions")
+
+# Chat completion backends the router may use, e.g. "deepseek,openai,stub"
+# (each one is configured in the LLM providers section below)
+LLM_PROVIDERS = [name.strip().lower() for name in os.getenv('LLM_PROVIDERS', 'deepseek').split(',') if name.strip()]
 
 # Check if API key is configured on startup
-if not DEEPSEEK_API_KEY:
+if 'deepseek' in LLM_PROVIDERS and not DEEPSEEK_API_KEY:
     print("WARNING: DEEPSEEK_API_KEY not found in environment variables!")
     print("Please add your API key to the .env file")
 
+# -----------------------------------------------------------------------------
+# Upstream client (one keep-alive connection pool per provider and worker process)
+# -----------------------------------------------------------------------------
+DEEPSEEK_POOL_SIZE = int(os.getenv('DEEPSEEK_POOL_SIZE', '10'))
+DEEPSEEK_CONNECT_TIMEOUT = float(os.getenv('DEEPSEEK_CONNECT_TIMEOUT', '10'))
+DEEPSEEK_READ_TIMEOUT = float(os.getenv('DEEPSEEK_READ_TIMEOUT', '60'))
+
+class UpstreamClient:
+    """Pooled keep-alive HTTP client for one OpenAI-style chat completions endpoint"""
+
+    def __init__(self, api_url, api_key, pool_size=DEEPSEEK_POOL_SIZE,
+                 connect_timeout=DEEPSEEK_CONNECT_TIMEOUT, read_timeout=DEEPSEEK_READ_TIMEOUT):
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.pid = os.getpid()
+
+        # Retries are handled by send_upstream, not by urllib3
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive'
+        })
+
+    def post(self, payload, stream=False, timeout=None):
+        """POST a completion request, reusing a pooled connection when one is idle"""
+        return self.session.post(
+            self.api_url,
+            json=payload,
+            headers={'Accept': 'text/event-stream' if stream else 'application/json'},
+            stream=stream,
+            timeout=timeout or self.timeout
+        )
+
+    def close(self):
+        self.session.close()
+
+# -----------------------------------------------------------------------------
+# Metrics (Prometheus text format, summed across workers via per-pid files)
+# -----------------------------------------------------------------------------
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'portfolio-metrics'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+THROUGHPUT_BUCKETS = (10, 25, 50, 100, 200, 400, 800, 1600)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsRegistry:
+    """Counters, gauges and histograms for one worker, merged with its siblings on scrape"""
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._definitions = {}  # name -> (kind, help, buckets)
+        self._values = {}       # name -> {label tuple: number, or [bucket counts..., sum, count]}
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+
+    def define(self, name, kind, help_text, buckets=None):
+        self._definitions[name] = (kind, help_text, tuple(buckets) if buckets else None)
+        self._values[name] = {}
+
+    def inc(self, name, amount=1, **labels):
+        """Add to a counter or gauge (gauges may go down)"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        buckets = self._definitions[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * len(buckets) + [0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {name: [[list(key), value if not isinstance(value, list) else list(value)]
+                           for key, value in series.items()]
+                    for name, series in self._values.items()}
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def _lock_directory(self):
+        """Exclusive lock across workers, released when the returned file is closed"""
+        handle = open(os.path.join(self.directory, '.lock'), 'a')
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def _merge(self, merged, sources):
+        for source in sources:
+            for name, series in source.items():
+                if name not in merged:
+                    continue
+                for key, value in series:
+                    key = tuple(tuple(pair) for pair in key)
+                    current = merged[name].get(key)
+                    if isinstance(value, list):
+                        merged[name][key] = value if current is None else [a + b for a, b in zip(current, value)]
+                    else:
+                        merged[name][key] = value + (current or 0)
+        return merged
+
+    def _retire(self, pid):
+        """Fold an exited worker's counters and histograms into exited.json; its gauges end with it
+
+        Dropping the file instead would make every total fall when a worker
+        is recycled, which Prometheus reads as a counter reset.
+        """
+        path = self._path(pid)
+        with self._lock_directory():
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    source = json.load(f)
+            except FileNotFoundError:
+                return  # another worker retired it first
+            except (OSError, ValueError):
+                source = {}
+            exited_path = self._path('exited')
+            try:
+                with open(exited_path, 'r', encoding='utf-8') as f:
+                    exited = json.load(f)
+            except (OSError, ValueError):
+                exited = {}
+            cumulative = {name: {} for name, definition in self._definitions.items() if definition[0] != 'gauge'}
+            self._merge(cumulative, [exited, source])
+            tmp_path = f"{exited_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({name: [[list(key), value] for key, value in series.items()]
+                           for name, series in cumulative.items()}, f)
+            os.replace(tmp_path, exited_path)
+            os.remove(path)
+
+    def flush(self):
+        """Publish this worker's values for the other workers to read"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(os.getpid())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def ensure_flusher(self):
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_forever, name='metrics-flusher', daemon=True).start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Metrics flush failed: {e}")
+
+    def collect(self):
+        """Sum the values of every live worker plus the counters and histograms of exited ones"""
+        merged = {name: {} for name in self._definitions}
+        own = self.snapshot()
+        sources = [own]
+        try:
+            self.flush()
+            file_names = os.listdir(self.directory)
+        except OSError as e:
+            print(f"Metrics directory unavailable, serving this worker only: {e}")
+            file_names = []
+        for file_name in file_names:
+            if not file_name.endswith('.json'):
+                continue
+            pid = int(file_name[:-5]) if file_name[:-5].isdigit() else None
+            if pid is None or pid == os.getpid():
+                continue
+            path = os.path.join(self.directory, file_name)
+            if not _pid_alive(pid):
+                try:
+                    self._retire(pid)
+                except OSError as e:
+                    print(f"Could not retire metrics of exited worker {pid}: {e}")
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    sources.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        try:
+            with open(self._path('exited'), 'r', encoding='utf-8') as f:
+                sources.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return self._merge(merged, sources)
+
+    def render(self):
+        """Prometheus text exposition of the merged values"""
+        lines = []
+        for name, series in self.collect().items():
+            kind, help_text, buckets = self._definitions[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(series.items()):
+                labels = ','.join(f'{k}="{_escape_label(v)}"' for k, v in key)
+                if kind != 'histogram':
+                    lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+                    continue
+                prefix = labels + ',' if labels else ''
+                # observe() already counts into every bucket >= value, so counts are cumulative
+                for bound, count in zip(buckets, value[:-2]):
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {value[-1]}')
+                lines.append(f"{name}_sum{{{labels}}} {value[-2]}" if labels else f"{name}_sum {value[-2]}")
+                lines.append(f"{name}_count{{{labels}}} {value[-1]}" if labels else f"{name}_count {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.define('portfolio_http_requests_total', 'counter', 'HTTP responses by route, method and status code')
+metrics.define('portfolio_active_sse_streams', 'gauge', 'SSE chat streams currently open')
+metrics.define('portfolio_upstream_attempts_total', 'counter', 'LLM provider requests sent, by provider and retry attempt number')
+metrics.define('portfolio_upstream_errors_total', 'counter', 'Failed LLM provider requests by provider and error class')
+metrics.define('portfolio_upstream_connect_seconds', 'histogram',
+               'Time from sending a provider request to receiving its response headers', LATENCY_BUCKETS)
+metrics.define('portfolio_time_to_first_token_seconds', 'histogram',
+               'Time from sending a streaming provider request to its first content delta', LATENCY_BUCKETS)
+metrics.define('portfolio_generation_seconds', 'histogram',
+               'Total time of an upstream generation', LATENCY_BUCKETS)
+metrics.define('portfolio_generation_chars_per_second', 'histogram',
+               'Generated characters per second over a whole upstream generation', THROUGHPUT_BUCKETS)
+metrics.define('portfolio_generation_tokens_per_second', 'histogram',
+               'Completion tokens per second, when the API reports usage', THROUGHPUT_BUCKETS)
+metrics.define('portfolio_upstream_in_flight', 'gauge', 'Upstream generations currently holding an admission slot')
+metrics.define('portfolio_upstream_queue_depth', 'gauge', 'Requests waiting for an upstream admission slot')
+metrics.define('portfolio_upstream_queue_wait_seconds', 'histogram',
+               'Time spent waiting for an admission slot and rate-limit token', LATENCY_BUCKETS)
+metrics.define('portfolio_upstream_shed_total', 'counter', 'Requests rejected by admission control, by reason')
+metrics.define('portfolio_provider_failovers_total', 'counter',
+               'Calls moved to the next provider after a failure before any content, by failed provider and reason')
+metrics.define('portfolio_batch_questions_total', 'counter',
+               'Questions answered through /chat/batch, by status and answer source (duplicates included)')
+metrics.define('portfolio_intent_answers_total', 'counter',
+               'Questions answered from portfolio data by the intent matcher, by matched intents')
+metrics.define('portfolio_memory_folds_total', 'counter',
+               'Background conversation summary updates, by outcome')
+metrics.define('portfolio_memory_fold_seconds', 'histogram',
+               'Time to fold older turns into a conversation summary', LATENCY_BUCKETS)
+metrics.define('portfolio_worker_boot_seconds', 'histogram',
+               'Time from a worker forking to being ready to accept requests', LATENCY_BUCKETS)
+metrics.define('portfolio_worker_resident_bytes', 'gauge', 'Resident memory of each worker process, by pid')
+
+def observe_generation(mode, started, chars, upstream_info=None):
+    """Record total time and throughput of a finished generation"""
+    elapsed = time.perf_counter() - started
+    metrics.observe('portfolio_generation_seconds', elapsed, mode=mode)
+    if elapsed > 0 and chars:
+        metrics.observe('portfolio_generation_chars_per_second', chars / elapsed, mode=mode)
+        completion_tokens = ((upstream_info or {}).get('usage') or {}).get('completion_tokens')
+        if completion_tokens:
+            metrics.observe('portfolio_generation_tokens_per_second', completion_tokens / elapsed, mode=mode)
+
 # -----------------------------------------------------------------------------
 # Portfolio content (sourced from user's resume)
 # -----------------------------------------------------------------------------
@@ -124,26 +438,458 @@ def load_resume_from_file(file_path: str) -> str:
         print(f"Failed to load resume from {file_path}: {e}")
         return ""
 
+_resume_hash_memo = (None, None)
+
+def resume_hash(resume_text):
+    """Short content hash of the resume, memoized for the current text object"""
+    global _resume_hash_memo
+    text, digest = _resume_hash_memo
+    if text is not resume_text:
+        digest = hashlib.sha256(resume_text.encode('utf-8')).hexdigest()[:16]
+        _resume_hash_memo = (resume_text, digest)
+    return digest
+
+def normalize_question(text):
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return re.sub(r'\s+', ' ', text.lower()).strip().rstrip('?!. ')
+
+# Pre-generated answers written by generate_faq.py
+FAQ_FILE_PATH = os.getenv('FAQ_FILE', os.path.join(os.path.dirname(__file__), 'content', 'faq_answers.json'))
+FAQ_ARTIFACT_VERSION = 1
+
+def load_faq_answers(file_path: str, resume_text: str) -> dict:
+    """Pre-generated answers keyed by normalized question, if they match this resume"""
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            artifact = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Failed to load FAQ answers from {file_path}: {e}")
+        return {}
+
+    if artifact.get('version') != FAQ_ARTIFACT_VERSION:
+        print(f"Ignoring FAQ answers in {file_path}: unsupported version {artifact.get('version')}")
+        return {}
+    if artifact.get('resume_hash') != resume_hash(resume_text):
+        print(f"Ignoring FAQ answers in {file_path}: generated for a different resume version")
+        return {}
+
+    return {normalize_question(entry['question']): entry['answer'] for entry in artifact.get('answers', [])}
+
+# Shortest resume text that is served; guards against truncated or half-written files
+RESUME_MIN_CHARS = int(os.getenv('RESUME_MIN_CHARS', '100'))
+
+def validate_resume(resume_text):
+    """Why a resume text must not be served, or None when it is fine"""
+    if not resume_text:
+        return 'file is empty or unreadable'
+    if len(resume_text) < RESUME_MIN_CHARS:
+        return f'only {len(resume_text)} characters (RESUME_MIN_CHARS is {RESUME_MIN_CHARS})'
+    if '\x00' in resume_text:
+        return 'contains NUL bytes'
+    return None
+
+def build_resume_snapshot(resume_text):
+    """Immutable view of one resume version; a request keeps the snapshot it started with"""
+    return MappingProxyType({
+        'resume_text': resume_text,
+        'version': resume_hash(resume_text),
+        'upload_timestamp': datetime.now().isoformat(),
+        'uploader': 'system',
+        'faq_answers': MappingProxyType(load_faq_answers(FAQ_FILE_PATH, resume_text))
+    })
+
 def initialize_public_resume():
     resume_text = load_resume_from_file(RESUME_FILE_PATH)
-    if resume_text:
-        resumes_storage['public'] = {
-            'resume_text': resume_text,
-            'upload_timestamp': datetime.now().isoformat(),
-            'chat_history': [],
-            'uploader': 'system'
-        }
-        print(f"Public resume loaded from {RESUME_FILE_PATH} ({len(resume_text)} chars)")
+    problem = validate_resume(resume_text)
+    if problem is None:
+        resumes_storage['public'] = build_resume_snapshot(resume_text)
+        print(f"Public resume loaded from {RESUME_FILE_PATH} ({len(resume_text)} chars, "
+              f"{len(resumes_storage['public']['faq_answers'])} pre-generated answers)")
     else:
-        print(f"No resume loaded. Ensure resume exists at {RESUME_FILE_PATH}")
+        print(f"No resume loaded ({problem}). Ensure resume exists at {RESUME_FILE_PATH}")
 
 # Initialize at import time
 initialize_public_resume()
 
+# -----------------------------------------------------------------------------
+# Resume hot reload (watch the resume and FAQ files, swap in a new snapshot)
+# -----------------------------------------------------------------------------
+RESUME_WATCH = os.getenv('RESUME_WATCH', 'auto').lower()  # auto (inotify where available), poll or off
+RESUME_POLL_INTERVAL = float(os.getenv('RESUME_POLL_INTERVAL', '2'))
+# Pause after a change notification so the writer can finish before the file is read
+RESUME_RELOAD_DEBOUNCE = 0.2
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+def open_inotify(directories):
+    """Non-blocking inotify fd watching directories for written or replaced files, or None where unsupported"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    # Editors often save by renaming a new file over the old one, so watch the directories
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    for directory in directories:
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return None
+    return fd
+
+def drain_inotify(fd):
+    try:
+        while os.read(fd, 65536):
+            pass
+    except BlockingIOError:
+        pass
+
+class ResumeWatcher:
+    """Re-reads the resume and FAQ files when they change and swaps in a validated snapshot
+
+    Change notifications come from inotify where available; the files are
+    also stat()ed every RESUME_POLL_INTERVAL seconds, which is the only
+    mechanism elsewhere. An invalid file keeps the current snapshot.
+    """
+
+    def __init__(self, paths, interval=RESUME_POLL_INTERVAL, mode=RESUME_WATCH):
+        self.paths = paths
+        self.interval = interval
+        self.mode = mode
+        self.mechanism = None
+        self.reloads = 0
+        self.rejected = 0
+        self.last_error = None
+        self.last_reload_at = None
+        self._signature = self.signature()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def signature(self):
+        """(mtime, size, inode) of each watched file, None for missing ones"""
+        signature = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                signature.append(None)
+                continue
+            signature.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+        return tuple(signature)
+
+    def ensure_started(self):
+        # One watcher thread per worker; threads do not survive fork
+        if self.mode == 'off' or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='resume-watcher', daemon=True).start()
+
+    def _run(self):
+        directories = sorted({os.path.dirname(os.path.abspath(path)) for path in self.paths})
+        fd = open_inotify(directories) if self.mode == 'auto' else None
+        self.mechanism = 'inotify' if fd is not None else 'polling'
+        while True:
+            if fd is None:
+                time.sleep(self.interval)
+            elif select.select([fd], [], [], self.interval)[0]:
+                time.sleep(RESUME_RELOAD_DEBOUNCE)
+                drain_inotify(fd)
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Resume reload failed: {e}")
+
+    def check(self):
+        """Reload when a watched file changed since the last check; True if a new snapshot was swapped in"""
+        signature = self.signature()
+        if signature == self._signature:
+            return False
+        self._signature = signature
+        return self.reload()
+
+    def reload(self):
+        resume_text = load_resume_from_file(RESUME_FILE_PATH)
+        problem = validate_resume(resume_text)
+        current = resumes_storage.get('public')
+        if problem is not None:
+            self.rejected += 1
+            self.last_error = problem
+            kept = current['version'] if current else 'none'
+            print(f"Ignoring changed resume at {RESUME_FILE_PATH}: {problem}; keeping version {kept}")
+            return False
+        snapshot = build_resume_snapshot(resume_text)
+        self.last_error = None
+        if (current is not None and current['version'] == snapshot['version']
+                and dict(current['faq_answers']) == dict(snapshot['faq_answers'])):
+            return False
+        # A single assignment: requests that already hold the old snapshot finish on it
+        resumes_storage['public'] = snapshot
+        self.reloads += 1
+        self.last_reload_at = datetime.now().isoformat()
+        on_resume_swapped(current, snapshot)
+        print(f"Resume reloaded: version {snapshot['version']} ({len(resume_text)} chars, "
+              f"{len(snapshot['faq_answers'])} pre-generated answers)")
+        return True
+
+    def stats(self):
+        current = resumes_storage.get('public')
+        return {
+            'version': current['version'] if current else None,
+            'loaded_at': current['upload_timestamp'] if current else None,
+            'watch': self.mechanism or ('off' if self.mode == 'off' else 'not_started'),
+            'reloads': self.reloads,
+            'rejected': self.rejected,
+            'last_error': self.last_error,
+            'last_reload_at': self.last_reload_at
+        }
+
+def warm_resume_state(snapshot):
+    """Build the compiled prompt and retrieval index for a resume version ahead of the first chat"""
+    prompt_builder.system_prompt(snapshot['resume_text'])
+    if RETRIEVAL_MODE == 'topk':
+        get_retrieval_index(snapshot['resume_text'])
+
+def on_resume_swapped(previous, current):
+    """Invalidate state derived from the previous resume version and warm it for the new one"""
+    if previous is not None and previous['version'] != current['version']:
+        answer_cache.retire_resume(previous['version'])
+    warm_resume_state(current)
+
+resume_watcher = ResumeWatcher([RESUME_FILE_PATH, FAQ_FILE_PATH])
+
+# -----------------------------------------------------------------------------
+# Static assets (fingerprinted and precompressed by build_assets.py)
+# -----------------------------------------------------------------------------
+STATIC_DIST_DIR = os.path.join(app.static_folder, 'dist')
+ASSET_MANIFEST_PATH = os.path.join(STATIC_DIST_DIR, 'manifest.json')
+ASSET_MANIFEST_VERSION = 1
+ASSET_HASH_LENGTH = 12
+# Precompressed variants written by the build, best first
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def asset_fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:ASSET_HASH_LENGTH]
+
+def compress_variants(data):
+    """Precompressed encodings of data, keyed by content coding (brotli only when installed)"""
+    # mtime=0 keeps the gzip bytes, and so any ETag built on them, reproducible
+    variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    return variants
+
+def accepted_encodings(header):
+    """Content codings an Accept-Encoding header allows (q > 0)"""
+    accepted = set()
+    for item in (header or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+class AssetStore:
+    """Build output held in memory: fingerprinted name -> {content coding: bytes}"""
+
+    def __init__(self, manifest_path=ASSET_MANIFEST_PATH):
+        self.manifest_path = manifest_path
+        self.urls = {}     # 'js/chat.js' -> 'js/chat.<hash>.js'
+        self.files = {}    # 'js/chat.<hash>.js' -> (mimetype, {'identity': b'...', 'gzip': b'...'})
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            print("No asset manifest; serving unversioned static files (run build_assets.py)")
+            return
+        if manifest.get('version') != ASSET_MANIFEST_VERSION:
+            print("Asset manifest version mismatch; serving unversioned static files")
+            return
+
+        dist_dir = os.path.dirname(self.manifest_path)
+        for source, built in manifest.get('assets', {}).items():
+            try:
+                with open(os.path.join(app.static_folder, source), 'rb') as f:
+                    current = asset_fingerprint(f.read())
+                with open(os.path.join(dist_dir, built), 'rb') as f:
+                    variants = {'identity': f.read()}
+            except OSError:
+                continue
+            # A source edited since the last build is served unversioned rather than stale
+            if current != asset_fingerprint(variants['identity']):
+                print(f"Asset {source} changed since the last build; serving it unversioned")
+                continue
+            for coding, suffix in ASSET_ENCODINGS:
+                try:
+                    with open(os.path.join(dist_dir, built + suffix), 'rb') as f:
+                        variants[coding] = f.read()
+                except OSError:
+                    pass
+            mimetype = mimetypes.guess_type(source)[0] or 'application/octet-stream'
+            self.urls[source] = built
+            self.files[built] = (mimetype, variants)
+        print(f"Loaded {len(self.files)} fingerprinted static assets")
+
+    def select(self, filename, accept_encoding):
+        """(mimetype, content coding or None, body) for the best variant a client accepts, or None"""
+        entry = self.files.get(filename)
+        if entry is None:
+            return None
+        mimetype, variants = entry
+        accepted = accepted_encodings(accept_encoding)
+        for coding, _ in ASSET_ENCODINGS:
+            if coding in variants and coding in accepted:
+                return mimetype, coding, variants[coding]
+        return mimetype, None, variants['identity']
+
+    def headers(self, coding):
+        headers = {'Cache-Control': ASSET_CACHE_CONTROL, 'Vary': 'Accept-Encoding'}
+        if coding:
+            headers['Content-Encoding'] = coding
+        return headers
+
+assets = AssetStore()
+
+def asset_url_for(endpoint, **values):
+    """url_for for templates: static files resolve to their fingerprinted build when there is one"""
+    if endpoint == 'static':
+        built = assets.urls.get(values.get('filename'))
+        if built:
+            values['filename'] = built
+            return url_for('asset', **values)
+    return url_for(endpoint, **values)
+
+@app.context_processor
+def fingerprinted_urls():
+    return {'url_for': asset_url_for}
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    """Fingerprinted static file, precompressed when the client accepts it"""
+    selected = assets.select(filename, request.headers.get('Accept-Encoding'))
+    if selected is None:
+        abort(404)
+    mimetype, coding, body = selected
+    return Response(body, mimetype=mimetype, headers=assets.headers(coding))
+
+# -----------------------------------------------------------------------------
+# Full-page cache (pages rendered once per template/data version, ETag + 304)
+# -----------------------------------------------------------------------------
+PAGE_CACHE_CHECK_INTERVAL = float(os.getenv('PAGE_CACHE_CHECK_INTERVAL', '2'))  # seconds between staleness checks
+
+def page_source_version():
+    """Fingerprint of everything a cached page is rendered from"""
+    parts = []
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    for root, _, files in os.walk(template_dir):
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            parts.append(f"{os.path.relpath(os.path.join(root, name), template_dir)}:{stat.st_mtime_ns}:{stat.st_size}")
+    parts.append(json.dumps(PORTFOLIO_DATA, sort_keys=True))
+    parts.append(json.dumps(assets.urls, sort_keys=True))
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+class CachedPage:
+    """One rendered page: its compressed variants and their strong ETags"""
+
+    def __init__(self, html):
+        body = html.encode('utf-8')
+        self.digest = hashlib.sha256(body).hexdigest()[:20]
+        self.variants = {'identity': body, **compress_variants(body)}
+
+    def etag(self, coding):
+        # Each content coding is a different representation, so it gets its own strong ETag
+        return f'"{self.digest}"' if coding is None else f'"{self.digest}-{coding}"'
+
+    def matches(self, if_none_match, coding):
+        """Whether an If-None-Match header names the variant being served"""
+        etag = self.etag(coding)
+        for tag in (if_none_match or '').split(','):
+            tag = tag.strip()
+            if tag == '*' or tag.removeprefix('W/') == etag:
+                return True
+        return False
+
+class PageCache:
+    """Rendered pages by name, dropped as a whole when templates, data or asset URLs change"""
+
+    def __init__(self, check_interval=PAGE_CACHE_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.version = None
+        self.checked_at = 0.0
+        self.pages = {}
+        self.hits = 0
+        self.renders = 0
+        self._lock = threading.Lock()
+
+    def _current(self):
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        version = page_source_version()
+        if version != self.version:
+            if self.version is not None:
+                print("Templates or page data changed; dropping cached pages")
+            self.version = version
+            self.pages = {}
+            # Jinja keeps compiled templates unless auto-reload is on
+            if app.jinja_env.cache is not None:
+                app.jinja_env.cache.clear()
+
+    def get(self, name, render):
+        """The cached page for name, rendering it with render() on a miss"""
+        with self._lock:
+            self._current()
+            page = self.pages.get(name)
+            if page is not None:
+                self.hits += 1
+                return page
+            page = self.pages[name] = CachedPage(render())
+            self.renders += 1
+            return page
+
+    def respond(self, name, render):
+        """Serve a cached page, answering a matching If-None-Match with 304"""
+        page = self.get(name, render)
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding'))
+        coding = next((c for c, _ in ASSET_ENCODINGS if c in page.variants and c in accepted), None)
+        headers = {'ETag': page.etag(coding), 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if page.matches(request.headers.get('If-None-Match'), coding):
+            return Response(status=304, headers=headers)
+        if coding:
+            headers['Content-Encoding'] = coding
+        return Response(page.variants[coding or 'identity'], mimetype='text/html', headers=headers)
+
+    def stats(self):
+        with self._lock:
+            return {'pages': len(self.pages), 'hits': self.hits, 'renders': self.renders}
+
+page_cache = PageCache()
+
 @app.route('/')
 def portfolio():
     """Public portfolio landing page with arcade feel"""
-    return render_template('portfolio.html', data=PORTFOLIO_DATA)
+    return page_cache.respond('portfolio', lambda: render_template('portfolio.html', data=PORTFOLIO_DATA))
 
 @app.route('/public')
 def public_chat():
@@ -152,7 +898,8 @@ def public_chat():
     if 'public' not in resumes_storage or not resumes_storage['public'].get('resume_text'):
         return jsonify({'error': 'Resume not found. Please ensure content/resume.txt exists.'}), 500
     session['public_session_id'] = 'public'
-    return render_template('public_chat.html')
+    get_conversation_id()
+    return page_cache.respond('public_chat', lambda: render_template('public_chat.html'))
 
 @app.route('/upload', methods=['POST'])
 def upload_resume():
@@ -161,29 +908,801 @@ def upload_resume():
 
 # Removed admin chat. Public chat is the only mode.
 
-@app.route('/chat/message', methods=['POST'])
-def chat_message():
-    """Handle chat messages and get AI responses (non-streaming fallback) - works for both admin and public"""
+# -----------------------------------------------------------------------------
+# Shared state (conversations and cached answers visible to every worker)
+# -----------------------------------------------------------------------------
+# 'memory' keeps state inside each worker process; 'sqlite' shares it through a
+# WAL-mode database file on the host, with each worker's stores caching reads
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory').lower()
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(tempfile.gettempdir(), 'portfolio-state.db'))
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', '0.05'))  # seconds a write may wait to be batched
+STATE_FLUSH_BATCH = int(os.getenv('STATE_FLUSH_BATCH', '256'))  # queued writes that trigger an early flush
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    conversation_id TEXT PRIMARY KEY,
+    last_seq INTEGER NOT NULL,
+    last_active REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversations_by_activity ON conversations (last_active);
+CREATE TABLE IF NOT EXISTS turns (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    user_message TEXT NOT NULL,
+    ai_response TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    answer TEXT NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS answers_by_expiry ON answers (expires);
+CREATE TABLE IF NOT EXISTS summaries (
+    conversation_id TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    covered_until REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+class SQLiteStateBackend:
+    """Conversations and cached answers in one SQLite file shared by the workers on a host
+
+    WAL mode lets every worker read while one writes. Writes are queued and
+    committed in batched transactions, by a background thread or by a caller
+    that needs its write visible to other workers now (flush() then commits
+    whatever other threads have queued too). The queue is consulted on reads
+    so a worker always sees its own writes. Times stored are wall-clock,
+    since they are compared across processes.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path=STATE_DB_PATH, flush_interval=STATE_FLUSH_INTERVAL, batch_size=STATE_FLUSH_BATCH):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._reset_queue()
+        self.flushes = 0
+        self.batched_writes = 0
+        self.failed_writes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(STATE_SCHEMA)
+
+    def _reset_queue(self):
+        # ('turn', conversation_id, turn, keep, on_commit) or ('answer', key, answer, expires)
+        self._pending = []
+        self._flushing = []  # the batch being committed right now
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flusher_pid = None
+
+    def reset_after_fork(self):
+        # The parent still flushes what it queued; the child starts empty
+        self._reset_queue()
+
+    def _connection(self):
+        """This thread's connection; connections are never shared across a fork"""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    # --- writes (queued, committed in batches) -------------------------------
+
+    def _enqueue(self, op):
+        self._ensure_flusher()
+        with self._lock:
+            self._pending.append(op)
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def append_turn(self, conversation_id, turn, keep, on_commit=None):
+        """Queue a turn; only the newest keep turns are retained, on_commit(seq) runs once it is stored"""
+        self._enqueue(('turn', conversation_id, turn, keep, on_commit))
+
+    def put_answer(self, key, answer, expires):
+        self._enqueue(('answer', key, answer, expires))
+
+    def pending_turns(self, conversation_id):
+        """This worker's turns for a conversation that are not committed yet, oldest first"""
+        with self._lock:
+            return [op[2] for op in self._flushing + self._pending if op[0] == 'turn' and op[1] == conversation_id]
+
+    def flush(self):
+        """Commit every queued write in one transaction"""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._flushing = self._pending
+                self._pending = []
+            if not batch:
+                return
+            connection = self._connection()
+            committed = []
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                for op in batch:
+                    if op[0] == 'turn':
+                        _, conversation_id, (user_message, ai_response, created), keep, on_commit = op
+                        seq = connection.execute(
+                            'INSERT INTO conversations (conversation_id, last_seq, last_active) VALUES (?, 1, ?) '
+                            'ON CONFLICT (conversation_id) DO UPDATE SET last_seq = last_seq + 1, '
+                            'last_active = excluded.last_active RETURNING last_seq',
+                            (conversation_id, created)
+                        ).fetchone()[0]
+                        connection.execute('INSERT INTO turns VALUES (?, ?, ?, ?, ?)',
+                                           (conversation_id, seq, user_message, ai_response, created))
+                        connection.execute('DELETE FROM turns WHERE conversation_id = ? AND seq <= ?',
+                                           (conversation_id, seq - keep))
+                        if on_commit is not None:
+                            committed.append((on_commit, seq))
+                    else:
+                        _, key, answer, expires = op
+                        connection.execute('INSERT OR REPLACE INTO answers VALUES (?, ?, ?)', (key, answer, expires))
+                connection.execute('COMMIT')
+                self.flushes += 1
+                self.batched_writes += len(batch)
+            except sqlite3.Error as e:
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                self.failed_writes += len(batch)
+                print(f"State flush failed, dropping {len(batch)} writes: {e}")
+            finally:
+                with self._lock:
+                    self._flushing = []
+            for on_commit, seq in committed:
+                on_commit(seq)
+
+    def _ensure_flusher(self):
+        # One flusher thread per worker; threads do not survive fork
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_forever, name='state-flusher', daemon=True).start()
+
+    def _flush_forever(self):
+        while True:
+            # Woken early when a batch fills up; otherwise writes wait at most one interval
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"State flush failed: {e}")
+
+    # --- reads and maintenance ------------------------------------------------
+
+    def conversation_version(self, conversation_id):
+        """Sequence number of the conversation's newest committed turn, or None"""
+        row = self._connection().execute('SELECT last_seq FROM conversations WHERE conversation_id = ?',
+                                         (conversation_id,)).fetchone()
+        return row[0] if row else None
+
+    def load_conversation(self, conversation_id, limit):
+        """(version, newest limit turns oldest first) read in one snapshot"""
+        connection = self._connection()
+        connection.execute('BEGIN')
+        try:
+            version = self.conversation_version(conversation_id)
+            rows = connection.execute(
+                'SELECT user_message, ai_response, created FROM turns WHERE conversation_id = ? '
+                'ORDER BY seq DESC LIMIT ?', (conversation_id, limit)
+            ).fetchall()
+        finally:
+            connection.execute('COMMIT')
+        return version, [tuple(row) for row in reversed(rows)]
+
+    def clear_conversation(self, conversation_id):
+        # Queued turns go first, so none of them lands after the delete
+        self.flush()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM turns WHERE conversation_id = ?', (conversation_id,))
+            connection.execute('DELETE FROM summaries WHERE conversation_id = ?', (conversation_id,))
+            connection.execute('DELETE FROM conversations WHERE conversation_id = ?', (conversation_id,))
+        except sqlite3.Error:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def get_answer(self, key):
+        """(answer, wall-clock expiry) of an unexpired shared answer, or None"""
+        row = self._connection().execute('SELECT answer, expires FROM answers WHERE key = ? AND expires > ?',
+                                         (key, time.time())).fetchone()
+        return tuple(row) if row else None
+
+    def get_summary(self, conversation_id):
+        """(summary, covered_until) of a conversation's older turns, or None"""
+        row = self._connection().execute('SELECT summary, covered_until FROM summaries WHERE conversation_id = ?',
+                                         (conversation_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def put_summary(self, conversation_id, summary, covered_until):
+        """Store a summary unless another worker already stored one covering more turns"""
+        # Written off the request path and rarely, so committed directly rather than queued
+        self._connection().execute(
+            'INSERT INTO summaries (conversation_id, summary, covered_until) VALUES (?, ?, ?) '
+            'ON CONFLICT (conversation_id) DO UPDATE SET summary = excluded.summary, covered_until = excluded.covered_until '
+            'WHERE excluded.covered_until > summaries.covered_until',
+            (conversation_id, summary, covered_until))
+
+    def sweep(self, idle_before):
+        """Delete conversations idle since before the given wall-clock time, and expired answers"""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM turns WHERE conversation_id IN '
+                               '(SELECT conversation_id FROM conversations WHERE last_active < ?)', (idle_before,))
+            connection.execute('DELETE FROM summaries WHERE conversation_id IN '
+                               '(SELECT conversation_id FROM conversations WHERE last_active < ?)', (idle_before,))
+            expired = connection.execute('DELETE FROM conversations WHERE last_active < ?', (idle_before,)).rowcount
+            connection.execute('DELETE FROM answers WHERE expires < ?', (time.time(),))
+        except sqlite3.Error:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return expired
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'backend': self.name,
+            'path': self.path,
+            'pending_writes': pending,
+            'flushes': self.flushes,
+            'batched_writes': self.batched_writes,
+            'failed_writes': self.failed_writes
+        }
+
+def create_state_backend(kind=STATE_BACKEND):
+    """The shared backend for STATE_BACKEND, or None to keep state in each worker's memory"""
+    if kind == 'memory':
+        return None
+    if kind != 'sqlite':
+        print(f"WARNING: unknown STATE_BACKEND {kind!r}, keeping state in memory")
+        return None
     try:
-        # Public session only
-        session_id = session.get('public_session_id') or 'public'
-        
-        if not session_id or session_id not in resumes_storage:
-            return jsonify({'error': 'No active session. Please access the chat properly.'}), 400
-        
-        user_message = request.json.get('message', '').strip()
-        if not user_message:
-            return jsonify({'error': 'Please provide a message'}), 400
-        
-        resume_data = resumes_storage[session_id]
-        resume_text = resume_data['resume_text']
-        
-        # Create context for the AI
-        system_prompt = f"""You are an AI assistant representing a job candidate based on their resume. 
+        backend = SQLiteStateBackend()
+    except (OSError, sqlite3.Error) as e:
+        print(f"WARNING: cannot open state database {STATE_DB_PATH}, keeping state in memory: {e}")
+        return None
+    print(f"Sharing conversations and answers through {backend.path}")
+    return backend
+
+state_backend = create_state_backend()
+
+if state_backend is not None:
+    atexit.register(state_backend.flush)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=state_backend.reset_after_fork)
+
+def state_stats():
+    return state_backend.stats() if state_backend is not None else {'backend': 'memory'}
+
+# -----------------------------------------------------------------------------
+# Conversation store (per-visitor history, bounded in turns, bytes and idle time)
+# -----------------------------------------------------------------------------
+CONVERSATION_MAX_TURNS = int(os.getenv('CONVERSATION_MAX_TURNS', '10'))
+CONVERSATION_STORE_MAX_BYTES = int(os.getenv('CONVERSATION_STORE_MAX_BYTES', str(16 * 1024 * 1024)))
+CONVERSATION_IDLE_TTL = int(os.getenv('CONVERSATION_IDLE_TTL', '1800'))
+CONVERSATION_SWEEP_INTERVAL = int(os.getenv('CONVERSATION_SWEEP_INTERVAL', '60'))
+
+# Rough per-turn bookkeeping cost on top of the message text
+TURN_OVERHEAD_BYTES = 120
+
+class Conversation:
+    """Ring buffer of (user_message, ai_response, timestamp) tuples"""
+    __slots__ = ('turns', 'size', 'last_active', 'version')
+
+    def __init__(self, max_turns, version=None):
+        self.turns = deque(maxlen=max_turns)
+        self.size = 0
+        self.last_active = time.monotonic()
+        # Shared backend only: the committed version these turns were read at
+        self.version = version
+
+def turn_size(turn):
+    return len(turn[0]) + len(turn[1]) + TURN_OVERHEAD_BYTES
+
+class ConversationStore:
+    """Conversations keyed by visitor id, evicted LRU past a global size cap
+
+    With a shared backend this worker's conversations are a read-through
+    cache: a cached conversation is served while its version matches the
+    committed one, and reloaded (plus this worker's uncommitted turns) when
+    another worker has written to it.
+    """
+
+    def __init__(self, max_turns=CONVERSATION_MAX_TURNS, max_bytes=CONVERSATION_STORE_MAX_BYTES,
+                 idle_ttl=CONVERSATION_IDLE_TTL, sweep_interval=CONVERSATION_SWEEP_INTERVAL, backend=None):
+        self.backend = backend
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self._conversations = OrderedDict()  # least recently active first
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._sweeper_pid = None
+        self.evictions = 0
+        self.expirations = 0
+        self.cached_reads = 0
+        self.backend_reads = 0
+
+    def history(self, conversation_id):
+        """Snapshot of a conversation's turns, oldest first"""
+        if self.backend is None:
+            with self._lock:
+                conversation = self._conversations.get(conversation_id)
+                return list(conversation.turns) if conversation else []
+
+        try:
+            version = self.backend.conversation_version(conversation_id)
+            with self._lock:
+                conversation = self._conversations.get(conversation_id)
+                if conversation is not None and conversation.version == version:
+                    self.cached_reads += 1
+                    return list(conversation.turns)
+            version, turns = self.backend.load_conversation(conversation_id, self.max_turns)
+        except sqlite3.Error as e:
+            print(f"State read failed, using this worker's copy of the conversation: {e}")
+            with self._lock:
+                conversation = self._conversations.get(conversation_id)
+                return list(conversation.turns) if conversation else []
+
+        turns = (turns + self.backend.pending_turns(conversation_id))[-self.max_turns:]
+        with self._lock:
+            self.backend_reads += 1
+            self._replace(conversation_id, turns, version)
+        return turns
+
+    def _replace(self, conversation_id, turns, version):
+        """Cache a conversation as read from the backend; the lock must be held"""
+        previous = self._conversations.pop(conversation_id, None)
+        if previous is not None:
+            self._bytes -= previous.size
+        conversation = self._conversations[conversation_id] = Conversation(self.max_turns, version)
+        conversation.turns.extend(turns)
+        conversation.size = sum(turn_size(turn) for turn in turns)
+        self._bytes += conversation.size
+        self._evict()
+
+    def _evict(self):
+        # Evict the least recently active conversations, never the current one
+        while self._bytes > self.max_bytes and len(self._conversations) > 1:
+            oldest_id = next(iter(self._conversations))
+            self._bytes -= self._conversations.pop(oldest_id).size
+            self.evictions += 1
+
+    def append(self, conversation_id, user_message, ai_response):
+        self._ensure_sweeper()
+        turn = (user_message, ai_response, time.time())
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None:
+                conversation = self._conversations[conversation_id] = Conversation(self.max_turns)
+            else:
+                self._conversations.move_to_end(conversation_id)
+            if len(conversation.turns) == conversation.turns.maxlen:
+                dropped = turn_size(conversation.turns[0])
+                conversation.size -= dropped
+                self._bytes -= dropped
+            conversation.turns.append(turn)
+            conversation.size += turn_size(turn)
+            conversation.last_active = time.monotonic()
+            self._bytes += turn_size(turn)
+            self._evict()
+
+        if self.backend is not None:
+            # The visitor's next message may reach another worker, so the turn is
+            # committed before the response finishes; concurrent appends share a commit
+            self.backend.append_turn(conversation_id, turn, self.max_turns,
+                                     lambda seq: self._committed(conversation_id, seq))
+            self.backend.flush()
+
+    def _committed(self, conversation_id, seq):
+        """Keep serving the cached copy if this worker's turn is the only one committed since it was read"""
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is not None and (conversation.version or 0) + 1 == seq:
+                conversation.version = seq
+
+    def clear(self, conversation_id):
+        with self._lock:
+            conversation = self._conversations.pop(conversation_id, None)
+            if conversation is not None:
+                self._bytes -= conversation.size
+        if self.backend is not None:
+            self.backend.clear_conversation(conversation_id)
+
+    def sweep(self):
+        """Drop conversations idle for longer than the TTL"""
+        cutoff = time.monotonic() - self.idle_ttl
+        with self._lock:
+            while self._conversations:
+                oldest_id, oldest = next(iter(self._conversations.items()))
+                if oldest.last_active > cutoff:
+                    break
+                del self._conversations[oldest_id]
+                self._bytes -= oldest.size
+                self.expirations += 1
+        if self.backend is not None:
+            self.backend.sweep(time.time() - self.idle_ttl)
+
+    def _ensure_sweeper(self):
+        # Threads do not survive fork, so each worker starts its own sweeper
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_forever, name='conversation-sweeper', daemon=True).start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Conversation sweep failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'conversations': len(self._conversations),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'cached_reads': self.cached_reads,
+                'backend_reads': self.backend_reads
+            }
+
+conversation_store = ConversationStore(backend=state_backend)
+
+def get_conversation_id():
+    """Per-visitor conversation id, created on first use and kept in the session"""
+    conversation_id = session.get('conversation_id')
+    if not conversation_id:
+        conversation_id = session['conversation_id'] = uuid.uuid4().hex
+    return conversation_id
+
+# -----------------------------------------------------------------------------
+# Retrieval index (BM25 over resume and PORTFOLIO_DATA passages)
+# -----------------------------------------------------------------------------
+# 'full' embeds the whole resume in every prompt; 'topk' sends only the
+# passages that best match the question
+RETRIEVAL_MODE = os.getenv('RETRIEVAL_MODE', 'full').lower()
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '8'))
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = frozenset(
+    'a an and are as at be by did do does for from had has have how i in is it its me my of on or '
+    'our so that the their them this to was were what when where which who why will with you your'.split()
+)
+
+def stem(token):
+    """Crude suffix stripping so 'studied', 'skills' and 'pipelines' match their stems"""
+    if len(token) > 4:
+        if token.endswith(('ies', 'ied')):
+            return token[:-3] + 'y'
+        for suffix in ('ing', 'ed', 's'):
+            if token.endswith(suffix) and not token.endswith('ss'):
+                return token[:-len(suffix)]
+    return token
+
+def tokenize(text):
+    return [stem(token) for token in re.findall(r'[a-z0-9+#]+', text.lower()) if token not in STOPWORDS]
+
+def resume_passages(resume_text):
+    """One passage per resume line, prefixed with the job or section it belongs to"""
+    passages = []
+    heading = ''
+    for line in resume_text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        # Section titles are upper case and only set the heading; job headers
+        # carry a dash-separated date range and are useful passages themselves
+        if line.rstrip(':').isupper():
+            heading = line.rstrip(':')
+            continue
+        if ' – ' in line and re.search(r'\b(19|20)\d\d\b', line):
+            heading = line
+            passages.append(line)
+            continue
+        passages.append(f"{heading}: {line}" if heading else line)
+    return passages
+
+def portfolio_passages(data):
+    """Passages built from the structured PORTFOLIO_DATA"""
+    passages = []
+    for job in data['experience']:
+        prefix = f"{job['role']} at {job['company']}, {job['location']} ({job['period']})"
+        passages.extend(f"{prefix}: {highlight}" for highlight in job['highlights'])
+    passages.extend(f"Technical summary - {item}" for item in data['technical_summary'])
+    passages.append("Technical skills: " + ", ".join(data['skills']))
+    passages.extend(f"Education: studied {e['degree']} at {e['school']} ({e['period']})" for e in data['education'])
+    passages.extend(f"Achievement: {item}" for item in data['achievements'])
+    contact = data['contact']
+    passages.append(f"Contact: phone {contact['phone']}, email {contact['email']}, "
+                    f"GitHub {contact['github']}, portfolio {contact['portfolio']}")
+    return passages
+
+class RetrievalIndex:
+    """BM25 index with the per-term weights precomputed into sparse postings
+
+    Postings are stored CSR-style by term: the passages containing term t are
+    doc_ids[indptr[t]:indptr[t + 1]], with their weights alongside, so memory
+    and build time follow the number of (passage, term) pairs rather than
+    passages x vocabulary.
+    """
+
+    def __init__(self, passages):
+        self.passages = passages
+        self.vocabulary = {}
+        rows, columns, counts = [], [], []
+        for row, passage in enumerate(passages):
+            passage_counts = {}
+            for token in tokenize(passage):
+                column = self.vocabulary.setdefault(token, len(self.vocabulary))
+                passage_counts[column] = passage_counts.get(column, 0) + 1
+            rows.extend([row] * len(passage_counts))
+            columns.extend(passage_counts)
+            counts.extend(passage_counts.values())
+
+        rows = np.array(rows, dtype=np.int32)
+        columns = np.array(columns, dtype=np.int32)
+        tf = np.array(counts, dtype=np.float32)
+        lengths = np.bincount(rows, weights=tf, minlength=len(passages))
+        avg_length = float(lengths.mean()) if len(passages) else 0.0
+        df = np.bincount(columns, minlength=len(self.vocabulary))
+        idf = np.log1p((len(passages) - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(avg_length, 1.0))
+        weights = (tf * (BM25_K1 + 1) / (tf + norm[rows])) * idf[columns]
+
+        # Group the (passage, term) pairs by term; query time then touches only its terms' postings
+        order = np.argsort(columns, kind='stable')
+        self.indptr = np.concatenate(([0], np.cumsum(df))).astype(np.int64)
+        self.doc_ids = rows[order]
+        self.data = weights[order].astype(np.float32)
+
+    def search(self, query, k=RETRIEVAL_TOP_K):
+        """Indices of the top-k passages for query, in document order"""
+        columns = [self.vocabulary[token] for token in set(tokenize(query)) if token in self.vocabulary]
+        if not columns or not self.passages:
+            return []
+        postings = [slice(self.indptr[column], self.indptr[column + 1]) for column in columns]
+        scores = np.zeros(len(self.passages), dtype=np.float32)
+        np.add.at(scores, np.concatenate([self.doc_ids[p] for p in postings]),
+                  np.concatenate([self.data[p] for p in postings]))
+        k = min(k, len(self.passages))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return sorted(int(i) for i in top if scores[i] > 0)
+
+    def context(self, query, k=RETRIEVAL_TOP_K):
+        return "\n".join(self.passages[i] for i in self.search(query, k))
+
+_retrieval_index = (None, None)  # (resume hash, index)
+
+def get_retrieval_index(resume_text):
+    """Index for the current resume version, rebuilt when the resume changes"""
+    global _retrieval_index
+    digest, index = _retrieval_index
+    if digest != resume_hash(resume_text):
+        started = time.perf_counter()
+        index = RetrievalIndex(resume_passages(resume_text) + portfolio_passages(PORTFOLIO_DATA))
+        _retrieval_index = (resume_hash(resume_text), index)
+        print(f"Retrieval index built: {len(index.passages)} passages, "
+              f"{len(index.vocabulary)} terms in {(time.perf_counter() - started) * 1000:.1f}ms")
+    return index
+
+# -----------------------------------------------------------------------------
+# Conversation memory (older turns folded into a rolling summary off the request path)
+# -----------------------------------------------------------------------------
+# 'window' sends the last PROMPT_HISTORY_TURNS exchanges verbatim; 'summary'
+# sends a running summary of older exchanges plus the last MEMORY_RECENT_TURNS
+CONVERSATION_MEMORY = os.getenv('CONVERSATION_MEMORY', 'window').lower()
+MEMORY_RECENT_TURNS = int(os.getenv('MEMORY_RECENT_TURNS', '2'))
+MEMORY_SUMMARY_MAX_TOKENS = int(os.getenv('MEMORY_SUMMARY_MAX_TOKENS', '300'))
+MEMORY_MAX_CONVERSATIONS = 4096
+# Long answers are cut before summarizing; their gist is at the start
+MEMORY_TURN_MAX_CHARS = 2000
+
+SUMMARY_INSTRUCTIONS = """You keep the memory of an interview chat between a recruiter and an assistant answering as a job candidate.
+Merge the new exchanges into the existing summary. Keep what the recruiter asked about, the key facts given in the answers,
+and anything the recruiter said about the role or their priorities. Leave out pleasantries and repetition.
+Reply with the updated summary only, in the third person, in at most {words} words."""
+
+def build_summary_messages(summary, turns, max_tokens=MEMORY_SUMMARY_MAX_TOKENS):
+    exchanges = '\n\n'.join(f"Recruiter: {user_message}\nCandidate: {ai_response[:MEMORY_TURN_MAX_CHARS]}"
+                            for user_message, ai_response, _ in turns)
+    return [
+        # Roughly 0.75 words per token leaves room for the model to finish its last sentence
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(words=max_tokens * 3 // 5)},
+        {"role": "user", "content": f"Existing summary:\n{summary or 'None yet.'}\n\nNew exchanges:\n{exchanges}"}
+    ]
+
+class ConversationMemory:
+    """Per-conversation (summary, covered_until) of the turns that left the verbatim window
+
+    After each answer the conversation is queued for a background thread,
+    which folds every turn but the newest recent_turns into the summary with
+    one model call. Prompts carry the summary plus the turns it does not
+    cover yet, so a slow or failed fold only makes a prompt longer. With a
+    shared backend, summaries are stored there for the other workers.
+    """
+
+    def __init__(self, mode=CONVERSATION_MEMORY, recent_turns=MEMORY_RECENT_TURNS,
+                 max_tokens=MEMORY_SUMMARY_MAX_TOKENS, max_conversations=MEMORY_MAX_CONVERSATIONS, backend=None):
+        self.enabled = mode == 'summary'
+        self.recent_turns = recent_turns
+        self.max_tokens = max_tokens
+        self.max_conversations = max_conversations
+        self.backend = backend
+        self._summaries = OrderedDict()  # conversation id -> (summary, covered_until), least recent first
+        self._pending = OrderedDict()    # conversation ids waiting for a fold
+        self._condition = threading.Condition()
+        self._worker_pid = None
+        self.folds = 0
+        self.failed_folds = 0
+
+    def _remember(self, conversation_id, summary, covered_until):
+        with self._condition:
+            current = self._summaries.pop(conversation_id, None)
+            if current is not None and current[1] > covered_until:
+                summary, covered_until = current
+            self._summaries[conversation_id] = (summary, covered_until)
+            while len(self._summaries) > self.max_conversations:
+                self._summaries.popitem(last=False)
+
+    def _lookup(self, conversation_id, shared=False):
+        """(summary, covered_until); shared=True reads the backend even when this worker has a copy"""
+        with self._condition:
+            local = self._summaries.get(conversation_id)
+        if self.backend is None or (local is not None and not shared):
+            return local or (None, 0.0)
+        try:
+            stored = self.backend.get_summary(conversation_id)
+        except sqlite3.Error as e:
+            print(f"State read failed, using this worker's conversation summary: {e}")
+            stored = None
+        if stored is not None:
+            self._remember(conversation_id, *stored)
+            with self._condition:
+                return self._summaries[conversation_id]
+        return local or (None, 0.0)
+
+    def context(self, conversation_id, history):
+        """(summary or None, turns the summary does not cover) for a prompt"""
+        if not self.enabled or not history:
+            return None, history
+        summary, covered_until = self._lookup(conversation_id)
+        return summary, [turn for turn in history if turn[2] > covered_until]
+
+    def schedule(self, conversation_id):
+        """Queue a conversation for folding once an answer has been stored"""
+        if not self.enabled:
+            return
+        self._ensure_worker()
+        with self._condition:
+            self._pending[conversation_id] = True
+            self._condition.notify()
+
+    def forget(self, conversation_id):
+        with self._condition:
+            self._summaries.pop(conversation_id, None)
+            self._pending.pop(conversation_id, None)
+
+    def _ensure_worker(self):
+        # Threads do not survive fork, so each worker starts its own
+        if self._worker_pid == os.getpid():
+            return
+        with self._condition:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+            # Conversations queued by the parent are folded there
+            self._pending.clear()
+        threading.Thread(target=self._run, name='conversation-memory', daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                conversation_id, _ = self._pending.popitem(last=False)
+            try:
+                self.fold(conversation_id)
+            except Exception as e:
+                self.failed_folds += 1
+                print(f"Conversation summary failed: {e}")
+
+    def fold(self, conversation_id):
+        """Summarize the conversation's turns older than the recent window; True if the summary moved on"""
+        history = conversation_store.history(conversation_id)
+        summary, covered_until = self._lookup(conversation_id, shared=True)
+        uncovered = [turn for turn in history if turn[2] > covered_until]
+        foldable = uncovered[:len(uncovered) - self.recent_turns]
+        if not foldable:
+            return False
+
+        started = time.perf_counter()
+        upstream_info = {}
+        try:
+            ticket = upstream_admission.acquire()
+        except UpstreamOverloaded:
+            # The turns stay in the prompt verbatim and are folded after the next answer
+            metrics.inc('portfolio_memory_folds_total', outcome='shed')
+            return False
+        with ticket:
+            text = call_chat_api(build_summary_messages(summary, foldable, self.max_tokens), upstream_info,
+                                 max_tokens=self.max_tokens)
+        if not upstream_info.get('ok') or not text or not text.strip():
+            self.failed_folds += 1
+            metrics.inc('portfolio_memory_folds_total', outcome='failed')
+            return False
+
+        summary, covered_until = text.strip(), foldable[-1][2]
+        self._remember(conversation_id, summary, covered_until)
+        if self.backend is not None:
+            self.backend.put_summary(conversation_id, summary, covered_until)
+        self.folds += 1
+        metrics.inc('portfolio_memory_folds_total', outcome='ok')
+        metrics.observe('portfolio_memory_fold_seconds', time.perf_counter() - started)
+        print(f"Folded {len(foldable)} turn(s) into a {estimate_tokens(summary)}-token summary "
+              f"in {(time.perf_counter() - started) * 1000:.0f}ms")
+        return True
+
+    def stats(self):
+        with self._condition:
+            return {
+                'mode': 'summary' if self.enabled else 'window',
+                'recent_turns': self.recent_turns,
+                'summaries': len(self._summaries),
+                'pending': len(self._pending),
+                'folds': self.folds,
+                'failed_folds': self.failed_folds
+            }
+
+conversation_memory = ConversationMemory(backend=state_backend)
+
+# -----------------------------------------------------------------------------
+# Chat pipeline helpers (shared by the Flask routes and the asyncio gateway)
+# -----------------------------------------------------------------------------
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '6000'))
+PROMPT_HISTORY_TURNS = int(os.getenv('PROMPT_HISTORY_TURNS', '5'))
+
+# Per-message framing the API adds on top of the content (role, separators)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+def estimate_tokens(text):
+    """Local token estimate: ~4 characters per token for English text"""
+    return (len(text) + 3) // 4 + MESSAGE_TOKEN_OVERHEAD
+
+def build_system_prompt(resume_text, label="CANDIDATE'S RESUME"):
+    """System prompt that makes the model answer as the candidate"""
+    return f"""You are an AI assistant representing a job candidate based on their resume. 
         You should answer questions as if you are the candidate, using the information from their resume.
         Be professional, confident, and elaborate on the experiences mentioned in the resume.
         
-        CANDIDATE'S RESUME:
+        {label}:
         {resume_text}
         
         Instructions:
@@ -192,32 +1711,801 @@ def chat_message():
         - If asked about something not in the resume, politely mention it's not covered in your background
         - Be enthusiastic and professional
         - Provide detailed responses that showcase the candidate's qualifications"""
-        
-        # Prepare messages for DeepSeek API
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
-        ]
-        
-        # Add chat history for context
-        for chat in resume_data['chat_history'][-5:]:  # Last 5 exchanges for context
-            messages.append({"role": "user", "content": chat['user_message']})
-            messages.append({"role": "assistant", "content": chat['ai_response']})
-        
+
+class PromptBuilder:
+    """Builds token-budgeted message lists, compiling the system prompt once per resume"""
+
+    def __init__(self, token_budget=PROMPT_TOKEN_BUDGET, history_turns=PROMPT_HISTORY_TURNS,
+                 retrieval_mode=RETRIEVAL_MODE, top_k=RETRIEVAL_TOP_K):
+        self.token_budget = token_budget
+        self.history_turns = history_turns
+        self.retrieval_mode = retrieval_mode
+        self.top_k = top_k
+        self._compiled = (None, None, 0)  # (resume hash, system prompt, tokens)
+
+    def system_prompt(self, resume_text):
+        """Compiled system prompt and its token estimate for this resume version"""
+        digest = resume_hash(resume_text)
+        compiled = self._compiled
+        if compiled[0] != digest:
+            prompt = build_system_prompt(resume_text)
+            compiled = (digest, prompt, estimate_tokens(prompt))
+            self._compiled = compiled
+        return compiled[1], compiled[2]
+
+    def retrieved_system_prompt(self, resume_text, history, user_message):
+        """System prompt carrying only the passages relevant to this question"""
+        # Include the previous question so follow-ups like "tell me more" still match
+        query = user_message if not history else f"{history[-1][0]} {user_message}"
+        context = get_retrieval_index(resume_text).context(query, self.top_k)
+        if not context:
+            return self.system_prompt(resume_text)
+        prompt = build_system_prompt(context, label="RELEVANT EXCERPTS FROM THE CANDIDATE'S RESUME")
+        return prompt, estimate_tokens(prompt)
+
+    def build(self, resume_text, history, user_message, summary=None, history_turns=None):
+        """Return (messages, prompt_tokens, history_turns_used); summary stands in for turns before history
+
+        history_turns overrides the verbatim window of the newest turns; the
+        token budget applies either way.
+        """
+        history_turns = self.history_turns if history_turns is None else history_turns
+        if self.retrieval_mode == 'topk':
+            system_prompt, system_tokens = self.retrieved_system_prompt(resume_text, history, user_message)
+        else:
+            system_prompt, system_tokens = self.system_prompt(resume_text)
+        used = system_tokens + estimate_tokens(user_message)
+        summary_message = f"Summary of the earlier conversation:\n{summary}" if summary else None
+        if summary_message:
+            used += estimate_tokens(summary_message)
+
+        # Walk back from the newest turn and stop at the first one that does not fit
+        included = []
+        for past_message, past_response, _ in reversed(history[-history_turns:] if history_turns else []):
+            turn_tokens = estimate_tokens(past_message) + estimate_tokens(past_response)
+            if used + turn_tokens > self.token_budget:
+                break
+            included.append((past_message, past_response))
+            used += turn_tokens
+        included.reverse()
+
+        # Stable layout for upstream prefix caching: the system prompt and earlier
+        # turns stay byte-identical between requests, only the tail changes
+        messages = [{"role": "system", "content": system_prompt}]
+        if summary_message:
+            messages.append({"role": "system", "content": summary_message})
+        for past_message, past_response in included:
+            messages.append({"role": "user", "content": past_message})
+            messages.append({"role": "assistant", "content": past_response})
         messages.append({"role": "user", "content": user_message})
+        return messages, used, len(included)
+
+prompt_builder = PromptBuilder()
+
+# Build the index up front so the first visitor does not pay for it
+if RETRIEVAL_MODE == 'topk' and 'public' in resumes_storage:
+    get_retrieval_index(resumes_storage['public']['resume_text'])
+
+def build_chat_messages(resume_data, history, user_message, conversation_id=None):
+    """Assemble the DeepSeek message list for a question; returns (messages, prompt_tokens)"""
+    summary, recent = conversation_memory.context(conversation_id, history) if conversation_id else (None, history)
+    # In summary mode every turn the summary does not cover yet is sent, however far
+    # folds lag behind: those turns are in no summary, so dropping them loses them
+    window = len(recent) if conversation_id and conversation_memory.enabled else None
+    messages, prompt_tokens, turns = prompt_builder.build(resume_data['resume_text'], recent, user_message,
+                                                          summary, history_turns=window)
+    print(f"Prompt estimate: {prompt_tokens} tokens ({turns}/{len(history)} history turns"
+          f"{', with summary' if summary else ''}, budget {prompt_builder.token_budget})")
+    return messages, prompt_tokens
+
+def record_chat_turn(conversation_id, user_message, ai_response):
+    """Store a completed exchange in the visitor's conversation"""
+    conversation_store.append(conversation_id, user_message, ai_response)
+    conversation_memory.schedule(conversation_id)
+
+def sse_event(data, event_id=None):
+    """Format a payload as a compact Server-Sent Event frame"""
+    frame = f"data: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+    return f"id: {event_id}\n{frame}" if event_id else frame
+
+# Live deltas are coalesced into frames: after the first frame (sent at once to
+# keep time-to-first-token low) a frame waits up to the window for more text
+SSE_COALESCE_WINDOW = float(os.getenv('SSE_COALESCE_WINDOW', '0.05'))
+SSE_COALESCE_CHARS = int(os.getenv('SSE_COALESCE_CHARS', '512'))
+
+class StreamAccumulator:
+    """Collects streamed text in linear time and tracks its UTF-8 length and CRC-32"""
+
+    def __init__(self):
+        self.parts = []
+        self.chars = 0
+        self.length = 0
+        self.crc = 0
+
+    def add(self, text):
+        data = text.encode('utf-8')
+        self.parts.append(text)
+        self.chars += len(text)
+        self.length += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+
+    def text(self):
+        return ''.join(self.parts)
+
+    def complete_event(self, event_id=None):
+        """Completion frame the client checks its own copy against, instead of echoing the text"""
+        return sse_event({'type': 'complete', 'length': self.length, 'crc32': f'{self.crc:08x}'}, event_id)
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'Access-Control-Allow-Origin': '*',
+    'X-Accel-Buffering': 'no'  # Disable nginx buffering
+}
+
+# -----------------------------------------------------------------------------
+# Answer cache (repeated questions against the same resume skip the upstream)
+# -----------------------------------------------------------------------------
+ANSWER_CACHE_MAX_BYTES = int(os.getenv('ANSWER_CACHE_MAX_BYTES', str(4 * 1024 * 1024)))
+ANSWER_CACHE_MAX_ENTRY_BYTES = int(os.getenv('ANSWER_CACHE_MAX_ENTRY_BYTES', str(64 * 1024)))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', '3600'))
+
+class AnswerCache:
+    """LRU + TTL cache of model answers, bounded by total size in bytes
+
+    With a shared backend, answers are also written through to it and a local
+    miss reads through to it, so an answer generated by one worker serves
+    the same question on all of them.
+    """
+
+    def __init__(self, max_bytes=ANSWER_CACHE_MAX_BYTES, ttl=ANSWER_CACHE_TTL,
+                 max_entry_bytes=ANSWER_CACHE_MAX_ENTRY_BYTES, backend=None):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()  # key -> (answer, expires_at, size)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._resume_hash = None
+        self._retired = set()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _sync_resume(self, resume_hash):
+        """False for a retired resume hash; the lock must be held"""
+        # Requests still running on a replaced resume must not refill the cache with its answers
+        if resume_hash in self._retired:
+            return False
+        # Every key embeds the resume hash; a new hash means all entries are stale
+        if resume_hash != self._resume_hash:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._bytes = 0
+            if self._resume_hash is not None:
+                self._retired.add(self._resume_hash)
+            self._resume_hash = resume_hash
+        return True
+
+    def retire_resume(self, resume_hash):
+        """Drop and refuse answers for a resume version that has been replaced"""
+        with self._lock:
+            self._retired.add(resume_hash)
+            if resume_hash == self._resume_hash:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self._bytes = 0
+                self._resume_hash = None
+
+    def _drop(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _store(self, key, answer, expires_at, size):
+        """Insert an entry and evict down to the size cap; the lock must be held"""
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (answer, expires_at, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get(self, key):
+        resume_hash, digest = key
+        with self._lock:
+            if not self._sync_resume(resume_hash):
+                self.misses += 1
+                return None
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] >= time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._drop(key)
+            if self.backend is None:
+                self.misses += 1
+                return None
+
+        try:
+            shared = self.backend.get_answer(f'{resume_hash}:{digest}')
+        except sqlite3.Error as e:
+            print(f"State read failed, treating as an answer cache miss: {e}")
+            shared = None
+        with self._lock:
+            if shared is None:
+                self.misses += 1
+                return None
+            answer, expires = shared
+            self.hits += 1
+            self.shared_hits += 1
+            if not self._sync_resume(resume_hash):
+                return answer
+            # Keep the shared expiry, translated to this process's monotonic clock
+            self._store(key, answer, time.monotonic() + max(0.0, expires - time.time()),
+                        len(answer.encode('utf-8')))
+            return answer
+
+    def put(self, key, answer):
+        size = len(answer.encode('utf-8'))
+        if size > self.max_entry_bytes:
+            return
+        resume_hash, digest = key
+        with self._lock:
+            if not self._sync_resume(resume_hash):
+                return
+            self._store(key, answer, time.monotonic() + self.ttl, size)
+        if self.backend is not None:
+            self.backend.put_answer(f'{resume_hash}:{digest}', answer, time.time() + self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'retired_resumes': len(self._retired)
+            }
+
+answer_cache = AnswerCache(backend=state_backend)
+
+# -----------------------------------------------------------------------------
+# Intent matcher (lookup questions answered from PORTFOLIO_DATA, no upstream call)
+# -----------------------------------------------------------------------------
+# Share of a question's content words an intent must explain before it answers; above 1 disables
+# Share of content words a lookup must explain; by default a single unexplained word
+# ("Why did you leave ...", "... with Spark at ...") sends the question to the model
+INTENT_MIN_CONFIDENCE = float(os.getenv('INTENT_MIN_CONFIDENCE', '1.0'))
+
+# Phrasing that carries no meaning for matching: question words, pronouns, politeness
+INTENT_FILLER = frozenset("""
+    a about all an and any are at be can could did do does for from get give has have how i
+    is it its know let list me my of on or please s share show some tell that the there to
+    may should was were what whats when where which who with would you your yours
+""".split())
+
+# Words that point unambiguously at an intent, besides the names taken from PORTFOLIO_DATA itself
+INTENT_CUES = {
+    'name': {'name'},
+    'email': {'email', 'mail', 'gmail'},
+    'phone': {'phone', 'mobile', 'telephone', 'cell'},
+    'contact': {'contact', 'reach'},
+    'github': {'github', 'repositories', 'repos', 'repo'},
+    'website': {'website', 'homepage', 'url'},
+    'skills': {'skills', 'skill', 'skillset', 'technologies'},
+    'education': {'study', 'studied', 'education', 'degree', 'degrees', 'university', 'universities',
+                  'school', 'college', 'graduate', 'graduated', 'masters', 'master', 'bachelor', 'bachelors'},
+    'achievements': {'achievements', 'achievement', 'awards', 'award', 'honors', 'accomplishments'},
+    'company': set(),  # matched by a company name from PORTFOLIO_DATA
+}
+
+# Words that only count towards an intent whose cue or name is also present:
+# on their own ("your background", "can you code", "your address") they are open questions
+INTENT_SUPPORT = {
+    'name': {'called', 'full'},
+    'email': {'e', 'address', 'id'},
+    'phone': {'number', 'call'},
+    'contact': {'details', 'info', 'information'},
+    'github': {'code', 'profile', 'link'},
+    'website': {'portfolio', 'site', 'web', 'page', 'link'},
+    'skills': {'technology', 'tech', 'stack', 'tools', 'programming', 'languages', 'technical'},
+    'education': {'educational', 'background', 'qualifications'},
+    'achievements': set(),
+    'company': {'work', 'worked', 'working', 'job', 'role', 'roles', 'position', 'title', 'long',
+                'time', 'dates', 'join', 'joined', 'leave', 'left', 'experience', 'responsibilities',
+                'located', 'location', 'city'},
+}
+
+# Words that ask for reasons, opinions or a story: never a lookup, whatever else the question names
+INTENT_OPEN_WORDS = frozenset({'why', 'explain', 'describe', 'think', 'feel', 'opinion', 'compare',
+                               'prefer', 'favorite', 'favourite'})
+# "how", "would", "could" and "should" open a question except in these lookup phrasings:
+# "how long/many", "how can I ...", "would you share ...", "could I get ..."
+INTENT_LOOKUP_AFTER_HOW = frozenset({'long', 'many', 'much', 'to'})
+INTENT_LOOKUP_PERSONS = frozenset({'i', 'we'})
+INTENT_REQUEST_WORDS = frozenset({'share', 'tell', 'give', 'list', 'show', 'please'})
+
+# Trailing words of an organisation name that a visitor may leave out
+INTENT_OPTIONAL_NAME_WORDS = frozenset({'university', 'college', 'lab', 'inc'})
+
+def intent_words(text):
+    return re.findall(r"[a-z0-9+#]+", text.lower())
+
+def format_period(period):
+    start, _, end = period.partition(' - ')
+    return f"from {start} to {end}" if end else period
+
+def is_open_question(words):
+    """True for why/how/would-style questions that ask for more than a stored fact"""
+    for i, word in enumerate(words):
+        following = words[i + 1:i + 3]
+        if word in INTENT_OPEN_WORDS:
+            return True
+        if word == 'how':
+            if following[:1] and following[0] in INTENT_LOOKUP_AFTER_HOW:
+                continue
+            # "how can I reach you", "how do we contact you"
+            if len(following) == 2 and following[1] in INTENT_LOOKUP_PERSONS:
+                continue
+            return True
+        if word in ('would', 'could', 'should'):
+            if following[:1] and following[0] in INTENT_LOOKUP_PERSONS:
+                continue
+            if following[:1] == ['you'] and following[1:] and following[1] in INTENT_REQUEST_WORDS:
+                continue
+            # After "how" ("how should I contact you") the phrasing was already judged
+            if i and words[i - 1] == 'how':
+                continue
+            return True
+    return False
+
+def join_items(items):
+    items = list(items)
+    if len(items) < 2:
+        return ''.join(items)
+    return f"{', '.join(items[:-1])} and {items[-1]}"
+
+class IntentMatcher:
+    """Answers pure lookup questions (contact details, skills, education, dates at a company) in first person
+
+    A question is split into content words. An intent applies only when one
+    of its unambiguous cues (or a company name) is present; it then also
+    explains its supporting words. When the applicable intents together
+    explain at least min_confidence of the content words (by default all of
+    them), their answers are returned without calling the model. Anything
+    else goes upstream, and so does any open question ("why did you leave
+    ...", "tell me about your background") however many entities it names.
+    """
+
+    def __init__(self, data, min_confidence=INTENT_MIN_CONFIDENCE):
+        self.min_confidence = min_confidence
+        contact = data['contact']
+        self.answers = {
+            'name': f"My name is {data['name']}, and I work as a {data['title']}.",
+            'email': f"You can email me at {contact['email']}.",
+            'phone': f"My phone number is {contact['phone']}.",
+            'contact': (f"You can reach me by email at {contact['email']} or by phone at {contact['phone']}. "
+                        f"My GitHub is {contact['github']} and my portfolio is at {contact['portfolio']}."),
+            'github': f"My GitHub is {contact['github']}.",
+            'website': f"My portfolio website is {contact['portfolio']}.",
+            'skills': f"My technical skills include {join_items(data['skills'])}.",
+            'education': "I hold " + join_items(
+                f"a {entry['degree']} from {entry['school']} ({entry['period']})" for entry in data['education']) + ".",
+            'achievements': ' '.join(data['achievements']),
+        }
+        self.companies = {}  # required name words -> experience entries at that organisation
+        self.company_words = {}  # required name words -> every word of the name
+        for entry in data['experience']:
+            words = intent_words(entry['company'])
+            required = tuple(w for w in words if w not in INTENT_OPTIONAL_NAME_WORDS)
+            self.companies.setdefault(required, []).append(entry)
+            self.company_words[required] = set(words)
+        self.cues = {intent: set(cues) for intent, cues in INTENT_CUES.items()}
+        self.support = INTENT_SUPPORT
+        for entry in data['education']:
+            self.cues['education'].update(intent_words(entry['school']))
+
+    def company_answer(self, entries, words):
+        if 'when' in words or 'long' in words:
+            parts = [f"I was at {e['company']} {format_period(e['period'])} as a {e['role']}." for e in entries]
+        elif 'where' in words:
+            parts = [f"{entries[0]['company']} is in {entries[0]['location']}, where I worked as "
+                     f"{join_items('a ' + e['role'] for e in entries)}."]
+        else:
+            parts = [f"At {e['company']} ({e['location']}) I worked as a {e['role']} "
+                     f"{format_period(e['period'])}. " + ' '.join(e['highlights']) for e in entries]
+        return ' '.join(parts)
+
+    def match(self, question):
+        """(answer, intents) when the question is a confident lookup, else None"""
+        words = intent_words(question)
+        content = [w for w in words if w not in INTENT_FILLER]
+        if not content or is_open_question(words):
+            return None
+
+        explained = set()
+        intents = []
+        mentioned = [name for name in self.companies if all(w in words for w in name)]
+        named = {w for name in mentioned for w in self.company_words[name]}
+        # "When did you study at ..." is about education even where I also worked
+        if mentioned and not any(w in self.cues['education'] and w not in named for w in content):
+            explained |= named
+            explained.update(w for w in content if w in self.support['company'])
+            intents.append('company')
+        for intent, cues in self.cues.items():
+            if intent == 'company':
+                continue
+            # Words of a company name already belong to the company intent
+            hits = {w for w in content if w in cues and w not in explained}
+            if hits:
+                explained |= hits
+                explained.update(w for w in content if w in self.support[intent])
+                intents.append(intent)
+        if not intents:
+            return None
+        # A specific contact detail makes the general "contact" cue words redundant
+        if 'contact' in intents and {'email', 'phone', 'github', 'website'} & set(intents):
+            intents.remove('contact')
+
+        confidence = sum(1 for w in content if w in explained) / len(content)
+        if confidence < self.min_confidence:
+            return None
+        parts = []
+        for intent in intents:
+            if intent == 'company':
+                parts.extend(self.company_answer(self.companies[name], words) for name in mentioned)
+            else:
+                parts.append(self.answers[intent])
+        return ' '.join(parts), intents
+
+intent_matcher = IntentMatcher(PORTFOLIO_DATA)
+
+def lookup_ready_answer(resume_data, user_message):
+    """Answer that needs neither a prompt nor an upstream call; returns (answer, 'faq' | 'intent' | 'miss')"""
+    answer = resume_data.get('faq_answers', {}).get(normalize_question(user_message))
+    if answer is not None:
+        return answer, 'faq'
+    matched = intent_matcher.match(user_message)
+    if matched is not None:
+        answer, intents = matched
+        metrics.inc('portfolio_intent_answers_total', intent='+'.join(intents))
+        return answer, 'intent'
+    return None, 'miss'
+
+def answer_cache_key(resume_data, messages, user_message):
+    """Cache key: resume hash plus a digest of the question and the prompt context it is asked in
+
+    The context is every message the builder put before the question, so two
+    questions share an answer only when the model would see the same turns.
+    """
+    digest = hashlib.sha256(normalize_question(user_message).encode('utf-8'))
+    for message in messages[:-1]:
+        digest.update(b'\x00' + message['role'].encode('utf-8'))
+        digest.update(b'\x00' + message['content'].encode('utf-8'))
+    return (resume_hash(resume_data['resume_text']), digest.hexdigest())
+
+def prepare_chat_turn(resume_data, conversation_id, user_message):
+    """Ready answer or prompt for a question: (cache_key, answer, cache_status, messages, prompt_tokens)
+
+    messages is None when an answer is ready. The cache key (also the
+    single-flight key) is derived from the built prompt. conversation_id
+    None answers without history, as for batch questions.
+    """
+    answer, cache_status = lookup_ready_answer(resume_data, user_message)
+    if answer is not None:
+        return None, answer, cache_status, None, 0
+    history = conversation_store.history(conversation_id) if conversation_id else []
+    messages, prompt_tokens = build_chat_messages(resume_data, history, user_message, conversation_id)
+    cache_key = answer_cache_key(resume_data, messages, user_message)
+    answer = answer_cache.get(cache_key)
+    if answer is not None:
+        return cache_key, answer, 'hit', None, 0
+    return cache_key, None, 'miss', messages, prompt_tokens
+
+# -----------------------------------------------------------------------------
+# Single-flight streams (identical concurrent questions share one generation)
+# -----------------------------------------------------------------------------
+# Longest a subscriber waits for the next chunk before giving up
+SINGLE_FLIGHT_CHUNK_TIMEOUT = DEEPSEEK_READ_TIMEOUT + 5
+
+class Flight:
+    """One upstream generation that any number of SSE clients can follow"""
+
+    def __init__(self):
+        self.chunks = []
+        self.chars = 0
+        self.done = False
+        self.error = None
+        self.upstream_info = {}
+        self._condition = threading.Condition()
+
+    @classmethod
+    def finished(cls, text):
+        """A completed flight holding a ready answer, so it can be streamed and resumed like a live one"""
+        flight = cls()
+        flight.publish(text)
+        flight.finish()
+        return flight
+
+    def text(self):
+        with self._condition:
+            return ''.join(self.chunks)
+
+    def _locate(self, offset):
+        """(chunk index, chars into that chunk) of a character offset"""
+        position, before = 0, 0
+        while position < len(self.chunks) and before + len(self.chunks[position]) <= offset:
+            before += len(self.chunks[position])
+            position += 1
+        return position, offset - before
+
+    def publish(self, chunk):
+        with self._condition:
+            self.chunks.append(chunk)
+            self.chars += len(chunk)
+            self._condition.notify_all()
+
+    def finish(self, error=None):
+        with self._condition:
+            self.error = error
+            self.done = True
+            self._condition.notify_all()
+
+    def subscribe(self, timeout=SINGLE_FLIGHT_CHUNK_TIMEOUT, window=SSE_COALESCE_WINDOW,
+                  max_chars=SSE_COALESCE_CHARS, offset=0):
+        """Yield the text from offset on, then the live tail until the flight ends, as coalesced frames"""
+        with self._condition:
+            position, trim = self._locate(offset)
+        consumed = 0
+        while True:
+            with self._condition:
+                while position >= len(self.chunks) and not self.done:
+                    if not self._condition.wait(timeout):
+                        raise TimeoutError("Timed out waiting for the upstream response")
+                if consumed:
+                    linger_until = time.monotonic() + window
+                    while not self.done and self.chars - consumed < max_chars:
+                        remaining = linger_until - time.monotonic()
+                        if remaining <= 0 or not self._condition.wait(remaining):
+                            break
+                new_chunks = self.chunks[position:]
+                finished = self.done
+                consumed = self.chars
+            if new_chunks:
+                yield ''.join(new_chunks)[trim:]
+                trim = 0
+            position += len(new_chunks)
+            if finished:
+                if self.error:
+                    raise RuntimeError(self.error)
+                return
+
+class SingleFlight:
+    """Registry of in-flight generations keyed by prompt fingerprint"""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def _follow(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.followers += 1
+            return flight
+
+    def join(self, key, producer, admit=None):
+        """Attach to the flight for key, starting producer(upstream_info) if there is none
+
+        Returns (flight, is_leader). The producer runs on its own thread so a
+        disconnecting client never cuts the stream short for the others. Only
+        a new leader calls admit(), whose ticket is held until the producer
+        ends; followers ride along without taking an upstream slot.
+        """
+        flight = self._follow(key)
+        if flight is not None:
+            return flight, False
+        ticket = admit() if admit else None
+        with self._lock:
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[key] = Flight()
+                self.leaders += 1
+            else:
+                # Another leader started while we waited for admission
+                self.followers += 1
+        if not is_leader:
+            if ticket is not None:
+                ticket.release()
+            return flight, False
+        threading.Thread(target=self._run, args=(key, flight, producer, ticket), name='single-flight', daemon=True).start()
+        return flight, True
+
+    def _run(self, key, flight, producer, ticket=None):
+        error = None
+        try:
+            for chunk in producer(flight.upstream_info):
+                if chunk:
+                    flight.publish(chunk)
+        except Exception as e:
+            print(f"Error in single-flight generation: {str(e)}")
+            error = str(e)
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            if ticket is not None:
+                ticket.release()
+            flight.finish(error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'followers': self.followers
+            }
+
+single_flight = SingleFlight()
+
+# -----------------------------------------------------------------------------
+# Resumable streams (a reconnect with Last-Event-ID continues from its offset)
+# -----------------------------------------------------------------------------
+STREAM_BUFFER_TTL = float(os.getenv('STREAM_BUFFER_TTL', '300'))  # seconds a stream stays resumable
+STREAM_BUFFER_MAX_CHARS = int(os.getenv('STREAM_BUFFER_MAX_CHARS', str(4 * 1024 * 1024)))
+
+class BufferedStream:
+    """One visitor's view of a flight, plus whether its turn was recorded yet"""
+
+    def __init__(self, flight, conversation_id, user_message):
+        self.flight = flight
+        self.conversation_id = conversation_id
+        self.user_message = user_message
+        self.created = time.monotonic()
+        self.recorded = False
+
+class StreamBuffer:
+    """Recent streams by id, evicted by age and by the text they hold in total
+
+    Event ids are '<stream id>:<characters sent so far>', so a resumed
+    stream can restart at any frame boundary however it was coalesced.
+    """
+
+    def __init__(self, ttl=STREAM_BUFFER_TTL, max_chars=STREAM_BUFFER_MAX_CHARS):
+        self.ttl = ttl
+        self.max_chars = max_chars
+        self._streams = OrderedDict()  # oldest first
+        self._lock = threading.Lock()
+        self.resumed = 0
+        self.evicted = 0
+
+    def register(self, flight, conversation_id, user_message):
+        """Buffer a new stream; returns (stream id, BufferedStream)"""
+        stream_id = uuid.uuid4().hex
+        stream = BufferedStream(flight, conversation_id, user_message)
+        with self._lock:
+            self._streams[stream_id] = stream
+            self._evict()
+        return stream_id, stream
+
+    def resume(self, last_event_id, conversation_id):
+        """(stream id, BufferedStream, offset) for a Last-Event-ID header, or None if it cannot be resumed"""
+        stream_id, _, offset = (last_event_id or '').partition(':')
+        if not offset.isdigit():
+            return None
+        with self._lock:
+            self._evict()
+            stream = self._streams.get(stream_id)
+            if stream is None or stream.conversation_id != conversation_id or int(offset) > stream.flight.chars:
+                return None
+            self.resumed += 1
+        return stream_id, stream, int(offset)
+
+    def claim_turn(self, stream):
+        """True exactly once per stream, for whichever connection sees it complete"""
+        with self._lock:
+            if stream.recorded:
+                return False
+            stream.recorded = True
+            return True
+
+    def _evict(self):
+        expired = time.monotonic() - self.ttl
+        while self._streams:
+            stream = next(iter(self._streams.values()))
+            if stream.created > expired or not stream.flight.done:
+                break
+            self._streams.popitem(last=False)
+            self.evicted += 1
+        # Followers share a flight, so its text is only counted once
+        flights = {id(stream.flight): stream.flight for stream in self._streams.values()}
+        total = sum(flight.chars for flight in flights.values())
+        while total > self.max_chars and len(self._streams) > 1:
+            _, stream = self._streams.popitem(last=False)
+            self.evicted += 1
+            flight = stream.flight
+            if all(other.flight is not flight for other in self._streams.values()):
+                total -= flight.chars
+
+    def stats(self):
+        with self._lock:
+            return {
+                'streams': len(self._streams),
+                'resumed': self.resumed,
+                'evicted': self.evicted
+            }
+
+stream_buffer = StreamBuffer()
+
+def streaming_producer(messages, cache_key):
+    """Upstream generation for a flight; caches the answer before the flight closes"""
+    def produce(upstream_info):
+        parts = []
+        for chunk in call_chat_api_streaming(messages, upstream_info):
+            parts.append(chunk)
+            yield chunk
+        if upstream_info.get('ok') and parts:
+            answer_cache.put(cache_key, ''.join(parts))
+    return produce
+
+@app.route('/chat/message', methods=['POST'])
+def chat_message():
+    """Handle chat messages and get AI responses (non-streaming fallback) - works for both admin and public"""
+    try:
+        # Public session only
+        session_id = session.get('public_session_id') or 'public'
         
-        # Call DeepSeek API
-        response = call_deepseek_api(messages)
+        if not session_id or session_id not in resumes_storage:
+            return jsonify({'error': 'No active session. Please access the chat properly.'}), 400
+        
+        user_message = request.json.get('message', '').strip()
+        if not user_message:
+            return jsonify({'error': 'Please provide a message'}), 400
+        
+        resume_data = resumes_storage[session_id]
+        conversation_id = get_conversation_id()
+        cache_key, cached, cache_status, messages, prompt_tokens = prepare_chat_turn(
+            resume_data, conversation_id, user_message)
+        if cached is not None:
+            record_chat_turn(conversation_id, user_message, cached)
+            return jsonify({'response': cached}), 200, {'X-Answer-Cache': cache_status}
+        
+        # Call the LLM provider(s)
+        upstream_info = {}
+        try:
+            ticket = upstream_admission.acquire()
+        except UpstreamOverloaded as e:
+            return shed_response(e)
+        with ticket:
+            response = call_chat_api(messages, upstream_info)
         
         if response:
             # Store chat history (even if it's an error message from API)
-            resume_data['chat_history'].append({
-                'user_message': user_message,
-                'ai_response': response,
-                'timestamp': datetime.now().isoformat()
-            })
+            record_chat_turn(conversation_id, user_message, response)
+            if upstream_info.get('ok'):
+                answer_cache.put(cache_key, response)
             
-            return jsonify({'response': response})
+            return jsonify({'response': response}), 200, {'X-Answer-Cache': 'miss', 'X-Prompt-Tokens': str(prompt_tokens)}
         else:
             # This means the API call completely failed (returned None)
             return jsonify({'error': 'Failed to get AI response. Please check your internet connection and try again.'}), 500
@@ -239,312 +2527,1253 @@ def chat_stream():
         if not user_message:
             return jsonify({'error': 'Please provide a message'}), 400
         
+        resume_data = resumes_storage[session_id]
+        conversation_id = get_conversation_id()
+        resumed = stream_buffer.resume(request.headers.get('Last-Event-ID'), conversation_id)
+        if resumed is not None:
+            # A dropped connection coming back: continue the buffered stream, no upstream call
+            stream_id, buffered, offset = resumed
+            flight = buffered.flight
+            headers = {**SSE_HEADERS, 'X-Stream-Resumed': str(offset)}
+        else:
+            cache_key, cached, cache_status, messages, prompt_tokens = prepare_chat_turn(
+                resume_data, conversation_id, user_message)
+            headers = {**SSE_HEADERS, 'X-Answer-Cache': cache_status}
+            if cached is not None:
+                flight = Flight.finished(cached)
+            else:
+                headers['X-Prompt-Tokens'] = str(prompt_tokens)
+                # Identical concurrent questions attach to one upstream generation
+                try:
+                    flight, is_leader = single_flight.join(cache_key, streaming_producer(messages, cache_key),
+                                                           admit=upstream_admission.acquire)
+                except UpstreamOverloaded as e:
+                    return shed_response(e)
+                headers['X-Single-Flight'] = 'leader' if is_leader else 'follower'
+            offset = 0
+            stream_id, buffered = stream_buffer.register(flight, conversation_id, user_message)
+        headers['X-Stream-Id'] = stream_id
+        
         def generate_response():
+            metrics.inc('portfolio_active_sse_streams')
             try:
-                resume_data = resumes_storage[session_id]
-                resume_text = resume_data['resume_text']
-                
-                # Create context for the AI
-                system_prompt = f"""You are an AI assistant representing a job candidate based on their resume. 
-                You should answer questions as if you are the candidate, using the information from their resume.
-                Be professional, confident, and elaborate on the experiences mentioned in the resume.
-                
-                CANDIDATE'S RESUME:
-                {resume_text}
-                
-                Instructions:
-                - Answer as the candidate in first person
-                - Be specific about experiences mentioned in the resume
-                - If asked about something not in the resume, politely mention it's not covered in your background
-                - Be enthusiastic and professional
-                - Provide detailed responses that showcase the candidate's qualifications"""
-                
-                # Prepare messages for DeepSeek API
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ]
-                
-                # Add chat history for context
-                for chat in resume_data['chat_history'][-5:]:  # Last 5 exchanges for context
-                    messages.append({"role": "user", "content": chat['user_message']})
-                    messages.append({"role": "assistant", "content": chat['ai_response']})
-                
-                messages.append({"role": "user", "content": user_message})
+                # The digest covers the whole answer, including text sent before a reconnect
+                accumulator = StreamAccumulator()
+                if offset:
+                    accumulator.add(flight.text()[:offset])
                 
                 # Stream response from DeepSeek API
-                full_response = ""
-                for chunk in call_deepseek_api_streaming(messages):
+                for chunk in flight.subscribe(offset=offset):
                     if chunk:
-                        full_response += chunk
+                        accumulator.add(chunk)
                         # Send chunk as Server-Sent Event
-                        yield f"data: {json.dumps({'chunk': chunk, 'type': 'chunk'})}\n\n"
+                        yield sse_event({'chunk': chunk, 'type': 'chunk'}, f'{stream_id}:{accumulator.chars}')
                 
-                # Store complete response in chat history
-                if full_response:
-                    resume_data['chat_history'].append({
-                        'user_message': user_message,
-                        'ai_response': full_response,
-                        'timestamp': datetime.now().isoformat()
-                    })
+                # Store complete response in chat history, once per stream
+                full_response = accumulator.text()
+                if full_response and stream_buffer.claim_turn(buffered):
+                    record_chat_turn(conversation_id, buffered.user_message, full_response)
                     
                 # Send completion signal
-                yield f"data: {json.dumps({'type': 'complete', 'full_response': full_response})}\n\n"
+                yield accumulator.complete_event(f'{stream_id}:{accumulator.chars}')
                 
             except Exception as e:
                 print(f"Error in streaming: {str(e)}")
-                yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+                yield sse_event({'type': 'error', 'error': str(e)})
+            
+            finally:
+                metrics.inc('portfolio_active_sse_streams', -1)
         
         return Response(
             generate_response(),
             mimetype='text/event-stream',
-            headers={
-                'Cache-Control': 'no-cache',
-                'Connection': 'keep-alive',
-                'Access-Control-Allow-Origin': '*',
-                'X-Accel-Buffering': 'no'  # Disable nginx buffering
-            }
+            headers=headers
         )
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def retry_api_call(max_retries=3, delay=1):
-    """Retry decorator for API calls with exponential backoff"""
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            for attempt in range(max_retries):
+# -----------------------------------------------------------------------------
+# Batch questions (a recruiter's screening list, answered concurrently)
+# -----------------------------------------------------------------------------
+BATCH_MAX_QUESTIONS = int(os.getenv('BATCH_MAX_QUESTIONS', '25'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))  # per worker, shared by all batches
+
+def read_batch_questions(body):
+    """Unique questions of a batch request as [(question, [indices])]; raises ValueError when invalid"""
+    questions = body.get('questions') if isinstance(body, dict) else None
+    if not isinstance(questions, list) or not questions:
+        raise ValueError('Please provide a list of questions')
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        raise ValueError(f'Please send at most {BATCH_MAX_QUESTIONS} questions per batch')
+    unique = OrderedDict()
+    for index, question in enumerate(questions):
+        if not isinstance(question, str) or not question.strip():
+            raise ValueError(f'Question {index + 1} is empty')
+        # The same question pasted twice is answered once and reported for every position
+        unique.setdefault(normalize_question(question), (question.strip(), []))[1].append(index)
+    return list(unique.values())
+
+def batch_result(indices, question, status, answer, source, started, **extra):
+    """SSE payload for one answered question of a batch"""
+    metrics.inc('portfolio_batch_questions_total', len(indices), status=status, source=source)
+    return {'type': 'result', 'indices': indices, 'question': question, 'status': status, 'source': source,
+            'answer': answer, 'elapsed_ms': round((time.perf_counter() - started) * 1000, 1), **extra}
+
+def batch_summary(total, results, started):
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    return {'type': 'complete', 'questions': total, 'unique': len(results), 'statuses': statuses,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)}
+
+def answer_batch_question(resume_data, question, indices):
+    """Answer one batch question on its own, without conversation history"""
+    started = time.perf_counter()
+    cache_key, cached, cache_status, messages, _ = prepare_chat_turn(resume_data, None, question)
+    if cached is not None:
+        return batch_result(indices, question, 'ok', cached, cache_status, started)
+
+    upstream_info = {}
+    try:
+        ticket = upstream_admission.acquire()
+    except UpstreamOverloaded as e:
+        return batch_result(indices, question, 'shed', str(e), 'miss', started, retry_after=e.retry_after)
+    with ticket:
+        response = call_chat_api(messages, upstream_info)
+    if upstream_info.get('ok'):
+        answer_cache.put(cache_key, response)
+    return batch_result(indices, question, 'ok' if upstream_info.get('ok') else 'error', response, 'miss',
+                        started, provider=upstream_info.get('provider'))
+
+_batch_pool = (None, None)  # (pid, executor)
+_batch_pool_lock = threading.Lock()
+
+def batch_executor():
+    """This worker's thread pool for batch questions; pool threads do not survive fork"""
+    global _batch_pool
+    with _batch_pool_lock:
+        pid, executor = _batch_pool
+        if pid != os.getpid():
+            executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch')
+            _batch_pool = (os.getpid(), executor)
+        return executor
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """Answer a list of questions concurrently, streaming each result as an SSE event when it is ready"""
+    session_id = session.get('public_session_id') or 'public'
+    if not session_id or session_id not in resumes_storage:
+        return jsonify({'error': 'No active session. Please access the chat properly.'}), 400
+    try:
+        groups = read_batch_questions(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    resume_data = resumes_storage[session_id]
+    total = sum(len(indices) for _, indices in groups)
+
+    def generate_results():
+        started = time.perf_counter()
+        futures = {batch_executor().submit(answer_batch_question, resume_data, question, indices): (question, indices)
+                   for question, indices in groups}
+        results = []
+        try:
+            for future in as_completed(futures):
+                question, indices = futures[future]
                 try:
-                    return func(*args, **kwargs)
-                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
-                    if attempt == max_retries - 1:  # Last attempt
-                        print(f"API call failed after {max_retries} attempts: {str(e)}")
-                        return None
-                    
-                    wait_time = delay * (2 ** attempt)  # Exponential backoff
-                    print(f"API timeout (attempt {attempt + 1}/{max_retries}), retrying in {wait_time}s...")
-                    time.sleep(wait_time)
+                    result = future.result()
                 except Exception as e:
-                    print(f"Unexpected error in API call: {str(e)}")
-                    return None
-            return None
-        return wrapper
-    return decorator
+                    print(f"Error answering batch question: {str(e)}")
+                    result = batch_result(indices, question, 'error', UNEXPECTED_ERROR_MESSAGE, 'miss', started)
+                results.append(result)
+                yield sse_event(result)
+            yield sse_event(batch_summary(total, results, started))
+        finally:
+            # The client went away: drop questions that have not started yet
+            for future in futures:
+                future.cancel()
+
+    return Response(generate_results(), mimetype='text/event-stream',
+                    headers={**SSE_HEADERS, 'X-Batch-Unique': str(len(groups))})
+
+# Apologies returned to the visitor when the upstream call does not succeed
+NOT_CONFIGURED_MESSAGE = "I apologize, but the AI service is not properly configured. Please check the API key settings."
+UNEXPECTED_ERROR_MESSAGE = "I apologize, but I encountered an unexpected error. Please try again."
+STREAM_TIMEOUT_MESSAGE = "I apologize, but the request timed out. Please try again."
+STREAM_CONNECTION_MESSAGE = "I apologize, but there was a connection error. Please check your internet connection and try again."
+UPSTREAM_UNAVAILABLE_MESSAGE = "The AI assistant is temporarily unavailable. Please try again in a minute."
+
+def api_key_configured():
+    """Whether at least one LLM provider is set up to answer"""
+    return any(provider.configured() for provider in provider_router.providers)
 
-@retry_api_call(max_retries=3, delay=2)
-def call_deepseek_api(messages):
-    """Call DeepSeek API to get AI response with retry logic"""
+# Longest answer a chat completion may generate
+COMPLETION_MAX_TOKENS = 1500
+
+def build_completion_payload(messages, stream=False, model='deepseek-chat', max_tokens=COMPLETION_MAX_TOKENS):
+    """Request body for an OpenAI-style chat completion"""
+    payload = {
+        'model': model,
+        'messages': messages,
+        'temperature': 0.7,
+        'max_tokens': max_tokens,
+        'top_p': 0.9,
+        'frequency_penalty': 0.1,
+        'presence_penalty': 0.1
+    }
+    if stream:
+        payload['stream'] = True  # Enable streaming
+        payload['stream_options'] = {'include_usage': True}  # Final chunk carries usage
+    return payload
+
+def upstream_error_message(status_code):
+    """Apology for a non-200 provider response, logging the cause"""
+    if status_code == 401:
+        print("Error: Invalid API key")
+        return "I apologize, but there's an authentication issue. Please check the API key configuration."
+    if status_code == 429:
+        print("Error: Rate limit exceeded")
+        return "I apologize, but the service is currently experiencing high demand. Please try again in a moment."
+    return f"I apologize, but I'm experiencing technical difficulties (Error {status_code}). Please try again."
+
+def parse_stream_chunk(data_str):
+    """Extract (content delta, usage or None) from one upstream SSE data payload"""
     try:
-        # Validate API key
-        if not DEEPSEEK_API_KEY or DEEPSEEK_API_KEY == 'your-deepseek-api-key':
-            print("Error: DeepSeek API key not configured properly")
-            return "I apologize, but the AI service is not properly configured. Please check the API key settings."
-        
-        headers = {
-            'Authorization': f'Bearer {DEEPSEEK_API_KEY}',
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
+        chunk_data = json.loads(data_str)
+    except json.JSONDecodeError:
+        # Skip invalid JSON chunks
+        return '', None
+    
+    content = ''
+    if chunk_data.get('choices'):
+        delta = chunk_data['choices'][0].get('delta') or {}
+        content = delta.get('content', '') or ''
+    return content, chunk_data.get('usage')
+
+# -----------------------------------------------------------------------------
+# Upstream token usage (including DeepSeek context-cache hits)
+# -----------------------------------------------------------------------------
+USAGE_FIELDS = ('prompt_tokens', 'completion_tokens', 'total_tokens',
+                'prompt_cache_hit_tokens', 'prompt_cache_miss_tokens')
+
+class UsageStats:
+    """Running totals of the usage blocks returned by the API"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.totals = dict.fromkeys(USAGE_FIELDS, 0)
+
+    def record(self, usage):
+        with self._lock:
+            self.responses += 1
+            for field in USAGE_FIELDS:
+                self.totals[field] += int(usage.get(field) or 0)
+
+    def stats(self):
+        with self._lock:
+            totals = dict(self.totals)
+            responses = self.responses
+        cached = totals['prompt_cache_hit_tokens']
+        looked_up = cached + totals['prompt_cache_miss_tokens']
+        return {
+            'responses_with_usage': responses,
+            **totals,
+            'prompt_cache_hit_ratio': round(cached / looked_up, 4) if looked_up else 0.0
         }
-        
-        payload = {
-            'model': 'deepseek-chat',
-            'messages': messages,
-            'temperature': 0.7,
-            'max_tokens': 1500,
-            'top_p': 0.9,
-            'frequency_penalty': 0.1,
-            'presence_penalty': 0.1
+
+usage_stats = UsageStats()
+
+def record_usage(usage, upstream_info=None):
+    """Aggregate one response's usage and attach it to upstream_info"""
+    if not usage:
+        return
+    usage_stats.record(usage)
+    if upstream_info is not None:
+        upstream_info['usage'] = usage
+    print(f"Usage: {usage.get('prompt_tokens', 0)} prompt tokens "
+          f"({usage.get('prompt_cache_hit_tokens', 0)} from cache), "
+          f"{usage.get('completion_tokens', 0)} completion tokens")
+
+# -----------------------------------------------------------------------------
+# Upstream resilience: deadline-bounded jittered retries behind a circuit breaker
+# -----------------------------------------------------------------------------
+UPSTREAM_DEADLINE = float(os.getenv('UPSTREAM_DEADLINE', '45'))  # budget for getting a response, all attempts included
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv('UPSTREAM_MAX_ATTEMPTS', '3'))
+UPSTREAM_BACKOFF_BASE = float(os.getenv('UPSTREAM_BACKOFF_BASE', '0.5'))
+UPSTREAM_BACKOFF_CAP = float(os.getenv('UPSTREAM_BACKOFF_CAP', '8'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))  # consecutive failures
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling a provider while its circuit breaker is open"""
+
+class Deadline:
+    """Time budget shared by every attempt of one upstream call"""
+
+    def __init__(self, seconds=UPSTREAM_DEADLINE):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def clamp(self, timeout):
+        """A per-attempt timeout that never outlives the deadline"""
+        return max(0.1, min(timeout, self.remaining()))
+
+class CircuitBreaker:
+    """Opens after consecutive upstream failures; lets one trial call through after a cool-down"""
+
+    def __init__(self, name='upstream', failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started = None
+        self.times_opened = 0
+        self._lock = threading.Lock()
+
+    def _trial_due(self, now):
+        """Whether a trial may start: the cool-down has passed, or the last trial was never settled"""
+        if self.state == 'open':
+            return now - self.opened_at >= self.reset_timeout
+        return self.state == 'half_open' and now - self.trial_started >= self.reset_timeout
+
+    def allow(self):
+        """Whether a call may go upstream now; in half-open state only one trial is allowed"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            now = time.monotonic()
+            if self._trial_due(now):
+                self.state = 'half_open'
+                self.trial_started = now
+                return True
+            return False
+
+    def available(self):
+        """Whether allow() would currently let a call through, without claiming the half-open trial"""
+        with self._lock:
+            return self.state == 'closed' or self._trial_due(time.monotonic())
+
+    def abandon_trial(self):
+        """Hand back a half-open trial that ended without an outcome, e.g. a cancelled call"""
+        with self._lock:
+            if self.state == 'half_open':
+                self.state = 'open'
+                self.opened_at = time.monotonic() - self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.times_opened += 1
+                    print(f"Circuit breaker for {self.name} opened after {self.failures} consecutive failures")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'times_opened': self.times_opened
+            }
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+def retry_delay(attempt, deadline, retry_after=None, max_attempts=UPSTREAM_MAX_ATTEMPTS):
+    """Seconds to wait before the next attempt, or None when attempts or budget are spent
+
+    Uses full-jitter exponential backoff unless the upstream asked for a
+    specific wait with Retry-After.
+    """
+    if attempt >= max_attempts:
+        return None
+    if retry_after is None:
+        delay = random.uniform(0, min(UPSTREAM_BACKOFF_CAP, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+    else:
+        delay = retry_after
+    # Leave room for the next attempt to actually connect
+    if delay + DEEPSEEK_CONNECT_TIMEOUT / 2 >= deadline.remaining():
+        return None
+    return delay
+
+def admit_upstream_attempt(provider, attempt):
+    """Breaker check before each attempt; raises UpstreamUnavailable when open"""
+    if not provider.breaker.allow():
+        metrics.inc('portfolio_upstream_errors_total', provider=provider.name, error_class='circuit_open')
+        raise UpstreamUnavailable(UPSTREAM_UNAVAILABLE_MESSAGE)
+    metrics.inc('portfolio_upstream_attempts_total', provider=provider.name, attempt=str(attempt))
+
+def settle_upstream_status(provider, status_code):
+    """Feed a response status to the breaker, router window and metrics; True when it is worth retrying"""
+    provider.window.record_outcome(status_code == 200)
+    if status_code != 200:
+        metrics.inc('portfolio_upstream_errors_total', provider=provider.name, error_class=f'http_{status_code}')
+    if status_code >= 500:
+        provider.breaker.record_failure()
+    else:
+        # A 429 still proves the upstream is alive, so it does not trip the breaker
+        provider.breaker.record_success()
+    return status_code in RETRYABLE_STATUSES
+
+def settle_upstream_exception(provider, error_class):
+    """Feed a timeout or connection failure to the breaker, router window and metrics"""
+    provider.window.record_outcome(False)
+    metrics.inc('portfolio_upstream_errors_total', provider=provider.name, error_class=error_class)
+    provider.breaker.record_failure()
+
+def send_upstream(provider, payload, stream=False, deadline=None, max_attempts=UPSTREAM_MAX_ATTEMPTS):
+    """POST a completion request to one provider with deadline-bounded, jittered retries
+
+    Only the wait for response headers is retried, so a stream is never
+    replayed after content reached the client. Returns the final response,
+    which may be a non-200 the caller turns into an apology; raises the last
+    Timeout/ConnectionError once attempts or the deadline run out, and
+    UpstreamUnavailable without calling out while the breaker is open.
+    """
+    deadline = deadline or Deadline()
+    attempt = 0
+    while True:
+        attempt += 1
+        admit_upstream_attempt(provider, attempt)
+        retry_after = None
+        try:
+            response = provider.client().post(
+                payload, stream=stream,
+                timeout=(deadline.clamp(DEEPSEEK_CONNECT_TIMEOUT), deadline.clamp(DEEPSEEK_READ_TIMEOUT))
+            )
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            settle_upstream_exception(provider, 'timeout' if isinstance(e, requests.exceptions.Timeout) else 'connection')
+            delay = retry_delay(attempt, deadline, max_attempts=max_attempts)
+            if delay is None:
+                raise
+            print(f"{provider.name} {type(e).__name__} (attempt {attempt}/{max_attempts}), retrying in {delay:.2f}s...")
+        except Exception:
+            # Every attempt is settled, or a half-open trial would hold the breaker shut
+            settle_upstream_exception(provider, 'unexpected')
+            raise
+        except BaseException:
+            # Interrupted rather than failed: not the provider's fault
+            provider.breaker.abandon_trial()
+            raise
+        else:
+            if not settle_upstream_status(provider, response.status_code):
+                return response
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            delay = retry_delay(attempt, deadline, retry_after, max_attempts)
+            if delay is None:
+                return response
+            response.close()
+            print(f"{provider.name} status {response.status_code} (attempt {attempt}/{max_attempts}), retrying in {delay:.2f}s...")
+        time.sleep(delay)
+
+# -----------------------------------------------------------------------------
+# LLM providers (DeepSeek, any OpenAI-compatible endpoint, a local stub) and
+# a router preferring the fastest healthy one
+# -----------------------------------------------------------------------------
+# A provider's recent history: attempts and first-token times within this many
+# seconds, capped at ROUTER_WINDOW_SIZE samples each
+ROUTER_WINDOW_SECONDS = float(os.getenv('ROUTER_WINDOW_SECONDS', '60'))
+ROUTER_WINDOW_SIZE = int(os.getenv('ROUTER_WINDOW_SIZE', '50'))
+# Providers at or above this recent error rate are only tried after the healthy ones
+ROUTER_MAX_ERROR_RATE = float(os.getenv('ROUTER_MAX_ERROR_RATE', '0.5'))
+ROUTER_MIN_SAMPLES = int(os.getenv('ROUTER_MIN_SAMPLES', '5'))
+
+STUB_REPLY = os.getenv('STUB_REPLY', "I'm running in offline mode right now, so I can't answer in detail. "
+                                     "Please try again in a little while.")
+STUB_TOKEN_DELAY = float(os.getenv('STUB_TOKEN_DELAY', '0'))  # seconds between streamed words
+
+# name -> (kind, default API URL, default model); any other name is an OpenAI-compatible endpoint
+PROVIDER_PRESETS = {
+    'deepseek': ('openai', DEEPSEEK_API_URL, 'deepseek-chat'),
+    'openai': ('openai', 'https://api.openai.com/v1/chat/completions', 'gpt-4o-mini'),
+    'stub': ('stub', None, None)
+}
+
+def nearest_rank(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class ProviderWindow:
+    """Recent attempt outcomes and time-to-first-token samples of one provider"""
+
+    def __init__(self, seconds=ROUTER_WINDOW_SECONDS, size=ROUTER_WINDOW_SIZE):
+        self.seconds = seconds
+        self.outcomes = deque(maxlen=size)  # (monotonic time, succeeded)
+        self.ttfts = deque(maxlen=size)     # (monotonic time, seconds to first token)
+        self._lock = threading.Lock()
+
+    def record_outcome(self, ok):
+        with self._lock:
+            self.outcomes.append((time.monotonic(), ok))
+
+    def record_ttft(self, seconds):
+        with self._lock:
+            self.ttfts.append((time.monotonic(), seconds))
+
+    def summary(self):
+        cutoff = time.monotonic() - self.seconds
+        with self._lock:
+            outcomes = [ok for at, ok in self.outcomes if at >= cutoff]
+            ttfts = sorted(seconds for at, seconds in self.ttfts if at >= cutoff)
+        return {
+            'samples': len(outcomes),
+            'error_rate': outcomes.count(False) / len(outcomes) if outcomes else 0.0,
+            'ttft_p50': nearest_rank(ttfts, 0.5) if ttfts else None,
+            'ttft_p95': nearest_rank(ttfts, 0.95) if ttfts else None
         }
-        
-        print(f"Making API request to DeepSeek with {len(messages)} messages...")
-        
-        # Increased timeout and added connection timeout
-        response = requests.post(
-            DEEPSEEK_API_URL, 
-            headers=headers, 
-            json=payload, 
-            timeout=(10, 60)  # (connection timeout, read timeout)
-        )
-        
-        print(f"API response status: {response.status_code}")
-        
-        if response.status_code == 200:
-            data = response.json()
-            if 'choices' in data and len(data['choices']) > 0:
-                content = data['choices'][0]['message']['content']
-                print(f"API response received: {len(content)} characters")
-                return content
+
+class ChatProvider:
+    """A chat completions backend with its own circuit breaker and latency window"""
+
+    kind = None
+    # Only used once every regular provider is unavailable or has failed
+    fallback_only = False
+
+    def __init__(self, name, model=None):
+        self.name = name
+        self.model = model
+        self.breaker = CircuitBreaker(name=name)
+        self.window = ProviderWindow()
+
+    def configured(self):
+        return True
+
+    def stats(self):
+        summary = self.window.summary()
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'model': self.model,
+            'configured': self.configured(),
+            'circuit': self.breaker.stats(),
+            'samples': summary['samples'],
+            'error_rate': round(summary['error_rate'], 3),
+            'ttft_p50_ms': None if summary['ttft_p50'] is None else round(summary['ttft_p50'] * 1000, 1),
+            'ttft_p95_ms': None if summary['ttft_p95'] is None else round(summary['ttft_p95'] * 1000, 1)
+        }
+
+class OpenAICompatibleProvider(ChatProvider):
+    """DeepSeek, OpenAI or any other endpoint speaking the OpenAI chat completions API"""
+
+    kind = 'openai'
+
+    def __init__(self, name, api_url, api_key, model):
+        super().__init__(name, model)
+        self.api_url = api_url
+        self.api_key = api_key
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    def configured(self):
+        # Endpoints without authentication still need some key, e.g. "none"
+        return bool(self.api_key) and not self.api_key.startswith('your-')
+
+    def payload(self, messages, stream=False, max_tokens=COMPLETION_MAX_TOKENS):
+        return build_completion_payload(messages, stream, model=self.model, max_tokens=max_tokens)
+
+    def headers(self):
+        return {'Authorization': f'Bearer {self.api_key}', 'Content-Type': 'application/json'}
+
+    def client(self):
+        """This process's pooled client, built fresh after a fork"""
+        client = self._client
+        if client is not None and client.pid == os.getpid():
+            return client
+        with self._client_lock:
+            if self._client is None or self._client.pid != os.getpid():
+                # Sockets inherited from the parent must never be shared with it
+                self._client = UpstreamClient(self.api_url, self.api_key)
+            return self._client
+
+    def reset_after_fork(self):
+        self._client = None
+        self._client_lock = threading.Lock()
+
+class StubProvider(ChatProvider):
+    """Canned local answer, so the chat keeps responding with no network (development, last resort)"""
+
+    kind = 'stub'
+    fallback_only = True
+
+    def __init__(self, name, reply=STUB_REPLY, token_delay=STUB_TOKEN_DELAY):
+        super().__init__(name, model='stub')
+        self.reply = reply
+        self.token_delay = token_delay
+
+    def chunks(self):
+        """The reply word by word, the way a model would stream it"""
+        return re.findall(r'\S+\s*', self.reply)
+
+def load_providers(names=LLM_PROVIDERS):
+    """Build providers from <NAME>_KIND, <NAME>_API_URL, <NAME>_API_KEY and <NAME>_MODEL"""
+    providers = []
+    for name in names:
+        prefix = re.sub(r'\W', '_', name).upper()
+        kind, api_url, model = PROVIDER_PRESETS.get(name, ('openai', None, None))
+        kind = os.getenv(f'{prefix}_KIND', kind).lower()
+        if kind == 'stub':
+            providers.append(StubProvider(name))
+            continue
+        api_url = os.getenv(f'{prefix}_API_URL', api_url)
+        model = os.getenv(f'{prefix}_MODEL', model)
+        if kind != 'openai' or not api_url or not model:
+            print(f"WARNING: skipping LLM provider {name!r}: set {prefix}_API_URL and {prefix}_MODEL "
+                  f"(and {prefix}_KIND=openai or stub)")
+            continue
+        providers.append(OpenAICompatibleProvider(name, api_url, os.getenv(f'{prefix}_API_KEY'), model))
+    return providers
+
+class ProviderRouter:
+    """Orders the providers to try for each call
+
+    Healthy providers come first, fastest recent median time-to-first-token
+    leading. Healthy providers without first-token samples follow in
+    configuration order: TTFT is only measured on streaming calls, so one
+    used only for plain completions or summaries has no speed to rank by.
+    Providers over ROUTER_MAX_ERROR_RATE follow, then fallback-only stubs.
+    Providers whose circuit breaker is open are left out.
+    """
+
+    def __init__(self, providers):
+        self.providers = providers
+        self.failovers = 0
+
+    def candidates(self):
+        ranked = []
+        for index, provider in enumerate(self.providers):
+            if not provider.configured() or not provider.breaker.available():
+                continue
+            summary = provider.window.summary()
+            degraded = summary['samples'] >= ROUTER_MIN_SAMPLES and summary['error_rate'] >= ROUTER_MAX_ERROR_RATE
+            latency = summary['ttft_p50'] if summary['ttft_p50'] is not None else float('inf')
+            ranked.append(((provider.fallback_only, degraded, latency, index), provider))
+        ranked.sort(key=lambda item: item[0])
+        return [provider for _, provider in ranked]
+
+    def record_failover(self, provider, reason):
+        self.failovers += 1
+        metrics.inc('portfolio_provider_failovers_total', provider=provider.name, reason=reason)
+        print(f"Provider {provider.name} failed ({reason}), failing over to the next one")
+
+    def stats(self):
+        order = [provider.name for provider in self.candidates()]
+        return {
+            'order': order,
+            'failovers': self.failovers,
+            'providers': [provider.stats() for provider in self.providers]
+        }
+
+provider_router = ProviderRouter(load_providers())
+
+def _reset_provider_clients_after_fork():
+    for provider in provider_router.providers:
+        if isinstance(provider, OpenAICompatibleProvider):
+            provider.reset_after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_provider_clients_after_fork)
+
+class ProviderFailed(Exception):
+    """A provider failed before producing any content, so the next one may be tried
+
+    message is the apology to show when no provider is left (None when the
+    provider could not be reached at all); reason labels the failure.
+    """
+
+    def __init__(self, message, reason):
+        super().__init__(message or reason)
+        self.message = message
+        self.reason = reason
+
+# -----------------------------------------------------------------------------
+# Upstream admission control (bounded concurrency, wait queue, token bucket)
+# -----------------------------------------------------------------------------
+UPSTREAM_MAX_IN_FLIGHT = int(os.getenv('UPSTREAM_MAX_IN_FLIGHT', '16'))  # per worker
+UPSTREAM_QUEUE_SIZE = int(os.getenv('UPSTREAM_QUEUE_SIZE', '32'))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', '5'))
+# Requests per second allowed to DeepSeek per worker; 0 disables the bucket
+UPSTREAM_RATE_LIMIT = float(os.getenv('UPSTREAM_RATE_LIMIT', '0'))
+UPSTREAM_RATE_BURST = int(os.getenv('UPSTREAM_RATE_BURST', '10'))
+SHED_MESSAGE = "The assistant is busy right now. Please try again in a few seconds."
+
+class UpstreamOverloaded(Exception):
+    """Raised when admission control sheds a request; carries a Retry-After hint"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(SHED_MESSAGE)
+        self.reason = reason
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+class TokenBucket:
+    """Rate limiter that hands out future tokens, so callers know how long to wait"""
+
+    def __init__(self, rate=UPSTREAM_RATE_LIMIT, burst=UPSTREAM_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait):
+        """Take one token; returns the seconds to wait for it, or None (taking nothing) if over max_wait"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def next_token_in(self):
+        with self._lock:
+            return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else 0.0
+
+class AdmissionTicket:
+    """An admission slot; release it (or use it as a context manager) when the generation ends"""
+
+    def __init__(self, controller):
+        self._controller = controller
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class AdmissionController:
+    """Caps concurrent upstream generations, queues a bounded overflow and sheds the rest"""
+
+    def __init__(self, max_in_flight=UPSTREAM_MAX_IN_FLIGHT, queue_size=UPSTREAM_QUEUE_SIZE,
+                 queue_timeout=UPSTREAM_QUEUE_TIMEOUT, bucket=None):
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.bucket = bucket or TokenBucket()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self._condition = threading.Condition()
+
+    def _shed(self, reason, retry_after):
+        with self._condition:
+            self.shed += 1
+        metrics.inc('portfolio_upstream_shed_total', reason=reason)
+        print(f"Shedding upstream request ({reason})")
+        raise UpstreamOverloaded(reason, retry_after)
+
+    def acquire(self):
+        """Wait for a slot and a rate token; raises UpstreamOverloaded instead of waiting past the timeout"""
+        started = time.monotonic()
+        expires = started + self.queue_timeout
+        queue_full = False
+        with self._condition:
+            if self.in_flight < self.max_in_flight:
+                # A free slot: admitted without ever counting as queued
+                self.in_flight += 1
+                admitted = True
+            elif self.waiting >= self.queue_size:
+                queue_full = True
             else:
-                print("Error: No choices in API response")
-                return "I apologize, but I couldn't generate a proper response. Please try again."
-                
-        elif response.status_code == 401:
-            print("Error: Invalid API key")
-            return "I apologize, but there's an authentication issue. Please check the API key configuration."
-            
-        elif response.status_code == 429:
-            print("Error: Rate limit exceeded")
-            return "I apologize, but the service is currently experiencing high demand. Please try again in a moment."
-            
-        else:
-            print(f"DeepSeek API error: {response.status_code} - {response.text}")
-            return f"I apologize, but I'm experiencing technical difficulties (Error {response.status_code}). Please try again."
-    
+                self.waiting += 1
+                metrics.inc('portfolio_upstream_queue_depth')
+                try:
+                    while self.in_flight >= self.max_in_flight:
+                        remaining = expires - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    admitted = self.in_flight < self.max_in_flight
+                    if admitted:
+                        self.in_flight += 1
+                finally:
+                    self.waiting -= 1
+                    metrics.inc('portfolio_upstream_queue_depth', -1)
+        if queue_full:
+            self._shed('queue_full', self.queue_timeout)
+        if not admitted:
+            self._shed('queue_timeout', self.queue_timeout)
+
+        metrics.inc('portfolio_upstream_in_flight')
+        wait = self.bucket.reserve(max(0.0, expires - time.monotonic()))
+        if wait is None:
+            self.release()
+            self._shed('rate_limited', self.bucket.next_token_in())
+        if wait:
+            time.sleep(wait)
+        with self._condition:
+            self.admitted += 1
+        metrics.observe('portfolio_upstream_queue_wait_seconds', time.monotonic() - started)
+        return AdmissionTicket(self)
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+        metrics.inc('portfolio_upstream_in_flight', -1)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'queue_depth': self.waiting,
+                'queue_size': self.queue_size,
+                'admitted': self.admitted,
+                'shed': self.shed
+            }
+
+upstream_admission = AdmissionController()
+
+def shed_response(error):
+    """503 JSON for a request shed by admission control"""
+    return jsonify({'error': str(error), 'retry_after': error.retry_after}), 503, {'Retry-After': str(error.retry_after)}
+
+def complete_with(provider, messages, upstream_info, deadline, max_attempts, max_tokens=COMPLETION_MAX_TOKENS):
+    """One provider's non-streaming answer; raises ProviderFailed when the next provider should be tried"""
+    if upstream_info is not None:
+        upstream_info.update(provider=provider.name, model=provider.model)
+    if provider.kind == 'stub':
+        return provider.reply
+
+    payload = provider.payload(messages, max_tokens=max_tokens)
+
+    print(f"Making API request to {provider.name} with {len(messages)} messages...")
+
+    started = time.perf_counter()
+    try:
+        response = send_upstream(provider, payload, deadline=deadline, max_attempts=max_attempts)
+    except UpstreamUnavailable as e:
+        raise ProviderFailed(str(e), 'circuit_open')
     except requests.exceptions.Timeout:
-        print("Error: Request timed out")
-        raise  # Let the retry decorator handle this
-    
+        print(f"Error: {provider.name} request timed out after {max_attempts} attempt(s)")
+        raise ProviderFailed(None, 'timeout')
     except requests.exceptions.ConnectionError:
-        print("Error: Connection failed")
-        raise  # Let the retry decorator handle this
-        
+        print(f"Error: {provider.name} connection failed after {max_attempts} attempt(s)")
+        raise ProviderFailed(None, 'connection')
+
+    with response:
+        metrics.observe('portfolio_upstream_connect_seconds', response.elapsed.total_seconds(),
+                        mode='message', provider=provider.name)
+
+        print(f"API response status: {response.status_code}")
+
+        if response.status_code != 200:
+            if response.status_code not in (401, 429):
+                print(f"{provider.name} API error: {response.status_code} - {response.text}")
+            raise ProviderFailed(upstream_error_message(response.status_code), f'http_{response.status_code}')
+
+        data = response.json()
+        record_usage(data.get('usage'), upstream_info)
+        if not data.get('choices'):
+            print("Error: No choices in API response")
+            raise ProviderFailed("I apologize, but I couldn't generate a proper response. Please try again.",
+                                 'no_choices')
+        content = data['choices'][0]['message']['content']
+        print(f"API response received: {len(content)} characters")
+        observe_generation('message', started, len(content), upstream_info)
+        if upstream_info is not None:
+            upstream_info['ok'] = True
+        return content
+
+def call_chat_api(messages, upstream_info=None, max_tokens=COMPLETION_MAX_TOKENS):
+    """Get an AI response from the best available provider, failing over on errors
+
+    When given, upstream_info is filled in with 'ok' (a real model answer
+    rather than an apology), 'usage' (the API's token accounting) and the
+    'provider' and 'model' that answered. Returns None when no provider
+    could be reached at all.
+    """
+    try:
+        candidates = provider_router.candidates()
+        if not candidates:
+            if not api_key_configured():
+                print("Error: no LLM provider is configured properly")
+                return NOT_CONFIGURED_MESSAGE
+            print("Every provider's circuit is open, failing fast")
+            return UPSTREAM_UNAVAILABLE_MESSAGE
+
+        # Only the last candidate retries; the others fail over at their first error
+        deadline = Deadline()
+        for position, provider in enumerate(candidates, 1):
+            last = position == len(candidates)
+            try:
+                return complete_with(provider, messages, upstream_info, deadline,
+                                     UPSTREAM_MAX_ATTEMPTS if last else 1, max_tokens)
+            except ProviderFailed as e:
+                if last:
+                    return e.message
+                provider_router.record_failover(provider, e.reason)
+
     except Exception as e:
-        print(f"Unexpected error calling DeepSeek API: {str(e)}")
-        return "I apologize, but I encountered an unexpected error. Please try again."
+        print(f"Unexpected error calling the chat API: {str(e)}")
+        metrics.inc('portfolio_upstream_errors_total', provider='unknown', error_class='unexpected')
+        return UNEXPECTED_ERROR_MESSAGE
+
+def stream_with(provider, messages, upstream_info, deadline, max_attempts):
+    """Yield one provider's content deltas; raises ProviderFailed if it fails before the first one"""
+    if upstream_info is not None:
+        upstream_info.update(provider=provider.name, model=provider.model)
+    if provider.kind == 'stub':
+        for chunk in provider.chunks():
+            yield chunk
+            if provider.token_delay:
+                time.sleep(provider.token_delay)
+        return
 
-def call_deepseek_api_streaming(messages):
-    """Call DeepSeek API with streaming support"""
+    payload = provider.payload(messages, stream=True)
+
+    print(f"Making streaming API request to {provider.name} with {len(messages)} messages...")
+
+    started = time.perf_counter()
     try:
-        # Validate API key
-        if not DEEPSEEK_API_KEY or DEEPSEEK_API_KEY == 'your-deepseek-api-key':
-            print("Error: DeepSeek API key not configured properly")
-            yield "I apologize, but the AI service is not properly configured. Please check the API key settings."
-            return
-        
-        headers = {
-            'Authorization': f'Bearer {DEEPSEEK_API_KEY}',
-            'Content-Type': 'application/json',
-            'Accept': 'text/event-stream'
-        }
-        
-        payload = {
-            'model': 'deepseek-chat',
-            'messages': messages,
-            'temperature': 0.7,
-            'max_tokens': 1500,
-            'top_p': 0.9,
-            'frequency_penalty': 0.1,
-            'presence_penalty': 0.1,
-            'stream': True  # Enable streaming
-        }
-        
-        print(f"Making streaming API request to DeepSeek with {len(messages)} messages...")
-        
-        # Make streaming request
-        response = requests.post(
-            DEEPSEEK_API_URL, 
-            headers=headers, 
-            json=payload, 
-            stream=True,
-            timeout=(10, 60)
-        )
-        
-        print(f"Streaming API response status: {response.status_code}")
-        
-        if response.status_code == 200:
-            # Process streaming response
-            for line in response.iter_lines(decode_unicode=True):
-                if line:
-                    # Handle Server-Sent Events format
-                    if line.startswith('data: '):
-                        data_str = line[6:]  # Remove 'data: ' prefix
-                        
-                        # Handle end of stream
-                        if data_str.strip() == '[DONE]':
-                            break
-                        
-                        try:
-                            # Parse JSON chunk
-                            chunk_data = json.loads(data_str)
-                            
-                            # Extract content from the chunk
-                            if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
-                                delta = chunk_data['choices'][0].get('delta', {})
-                                content = delta.get('content', '')
-                                
-                                if content:
-                                    yield content
-                                    
-                        except json.JSONDecodeError:
-                            # Skip invalid JSON chunks
-                            continue
-                        
-        elif response.status_code == 401:
-            print("Error: Invalid API key")
-            yield "I apologize, but there's an authentication issue. Please check the API key configuration."
-            
-        elif response.status_code == 429:
-            print("Error: Rate limit exceeded")
-            yield "I apologize, but the service is currently experiencing high demand. Please try again in a moment."
-            
-        else:
-            print(f"DeepSeek API error: {response.status_code} - {response.text}")
-            yield f"I apologize, but I'm experiencing technical difficulties (Error {response.status_code}). Please try again."
-    
+        response = send_upstream(provider, payload, stream=True, deadline=deadline, max_attempts=max_attempts)
+    except UpstreamUnavailable as e:
+        raise ProviderFailed(str(e), 'circuit_open')
     except requests.exceptions.Timeout:
-        print("Error: Streaming request timed out")
-        yield "I apologize, but the request timed out. Please try again."
-    
+        print(f"Error: {provider.name} streaming request timed out")
+        raise ProviderFailed(STREAM_TIMEOUT_MESSAGE, 'timeout')
     except requests.exceptions.ConnectionError:
-        print("Error: Streaming connection failed")
-        yield "I apologize, but there was a connection error. Please check your internet connection and try again."
-        
+        print(f"Error: {provider.name} streaming connection failed")
+        raise ProviderFailed(STREAM_CONNECTION_MESSAGE, 'connection')
+
+    generated_chars = 0
+    try:
+        # Closing the response hands the keep-alive connection back to the pool
+        with response:
+            print(f"Streaming API response status: {response.status_code}")
+            metrics.observe('portfolio_upstream_connect_seconds', response.elapsed.total_seconds(),
+                            mode='stream', provider=provider.name)
+
+            if response.status_code != 200:
+                if response.status_code not in (401, 429):
+                    print(f"{provider.name} API error: {response.status_code} - {response.text}")
+                raise ProviderFailed(upstream_error_message(response.status_code), f'http_{response.status_code}')
+
+            # Process streaming response
+            for line in response.iter_lines(decode_unicode=True):
+                # Handle Server-Sent Events format
+                if not line or not line.startswith('data: '):
+                    continue
+                data_str = line[6:]  # Remove 'data: ' prefix
+
+                # Handle end of stream; drain the terminating chunk so the
+                # connection goes back to the pool instead of being dropped
+                if data_str.strip() == '[DONE]':
+                    response.raw.drain_conn()
+                    if upstream_info is not None:
+                        upstream_info['ok'] = True
+                    break
+
+                content, usage = parse_stream_chunk(data_str)
+                record_usage(usage, upstream_info)
+                if content:
+                    if not generated_chars:
+                        ttft = time.perf_counter() - started
+                        metrics.observe('portfolio_time_to_first_token_seconds', ttft,
+                                        mode='stream', provider=provider.name)
+                        provider.window.record_ttft(ttft)
+                    generated_chars += len(content)
+                    yield content
+
+            observe_generation('stream', started, generated_chars, upstream_info)
+
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        # Stalled or dropped after send_upstream returned
+        timed_out = isinstance(e, requests.exceptions.Timeout)
+        settle_upstream_exception(provider, 'timeout' if timed_out else 'connection')
+        message = STREAM_TIMEOUT_MESSAGE if timed_out else STREAM_CONNECTION_MESSAGE
+        print(f"Error: {provider.name} stream {'timed out' if timed_out else 'connection failed'}")
+        if not generated_chars:
+            raise ProviderFailed(message, 'timeout' if timed_out else 'connection')
+        yield message
+
+def call_chat_api_streaming(messages, upstream_info=None):
+    """Stream an AI response from the best available provider
+
+    A provider that fails before its first content delta is replaced by the
+    next one; once text has been sent the stream stays with its provider.
+    When given, upstream_info is filled in like in call_chat_api once the
+    stream finishes. Raises UpstreamUnavailable when every provider's circuit
+    breaker is open so the SSE route can report it as an error event.
+    """
+    try:
+        candidates = provider_router.candidates()
+        if not candidates:
+            if not api_key_configured():
+                print("Error: no LLM provider is configured properly")
+                yield NOT_CONFIGURED_MESSAGE
+                return
+            print("Every provider's circuit is open, failing fast")
+            raise UpstreamUnavailable(UPSTREAM_UNAVAILABLE_MESSAGE)
+
+        deadline = Deadline()
+        for position, provider in enumerate(candidates, 1):
+            last = position == len(candidates)
+            try:
+                yield from stream_with(provider, messages, upstream_info, deadline,
+                                       UPSTREAM_MAX_ATTEMPTS if last else 1)
+                return
+            except ProviderFailed as e:
+                if not last:
+                    provider_router.record_failover(provider, e.reason)
+                    continue
+                if e.reason == 'circuit_open':
+                    print("Upstream circuit open, failing fast")
+                    raise UpstreamUnavailable(e.message)
+                yield e.message
+
+    except UpstreamUnavailable:
+        raise
+
     except Exception as e:
         print(f"Unexpected error in streaming API call: {str(e)}")
-        yield "I apologize, but I encountered an unexpected error. Please try again."
+        metrics.inc('portfolio_upstream_errors_total', provider='unknown', error_class='unexpected')
+        yield UNEXPECTED_ERROR_MESSAGE
+
+# -----------------------------------------------------------------------------
+# Background upstream health prober (/health serves its latest snapshot)
+# -----------------------------------------------------------------------------
+HEALTH_PROBE_INTERVAL = float(os.getenv('HEALTH_PROBE_INTERVAL', '60'))
+HEALTH_PROBE_JITTER = float(os.getenv('HEALTH_PROBE_JITTER', '0.2'))  # fraction of the interval
+HEALTH_PROBE_TIMEOUT = float(os.getenv('HEALTH_PROBE_TIMEOUT', '5'))
+# Readiness requires a successful probe no older than this
+HEALTH_MAX_AGE = float(os.getenv('HEALTH_MAX_AGE', str(3 * HEALTH_PROBE_INTERVAL)))
+
+def probe_provider(provider):
+    """One minimal completion request; returns the api_test status string"""
+    if not provider.configured():
+        return 'not_configured'
+    test_messages = [
+        {"role": "system", "content": "You are a test assistant."},
+        {"role": "user", "content": "Say 'API test successful' in exactly 3 words."}
+    ]
+    payload = {
+        'model': provider.model,
+        'messages': test_messages,
+        'max_tokens': 10
+    }
+    try:
+        response = provider.client().post(payload, timeout=HEALTH_PROBE_TIMEOUT)
+        return 'success' if response.status_code == 200 else f'failed_{response.status_code}'
+    except Exception as e:
+        return f'error_{str(e)[:50]}'
+
+def probe_upstream():
+    """Probe every configured network provider; returns (api_test, {provider: result})
+
+    api_test is 'success' when any of them answered. Fallback-only stubs
+    always can, so they only count when nothing else is configured.
+    """
+    configured = [p for p in provider_router.providers if p.configured()]
+    remote = [p for p in configured if not p.fallback_only]
+    if not remote:
+        return ('success' if configured else 'not_configured'), {}
+    results = {provider.name: probe_provider(provider) for provider in remote}
+    if 'success' in results.values():
+        return 'success', results
+    return next(iter(results.values())), results
+
+class HealthProber:
+    """Probes the upstream on a jittered schedule and keeps the latest result"""
+
+    def __init__(self, interval=HEALTH_PROBE_INTERVAL, jitter=HEALTH_PROBE_JITTER):
+        self.interval = interval
+        self.jitter = jitter
+        self._snapshot = {'api_test': 'pending', 'providers': {}, 'latency_ms': None, 'checked_at': None}
+        self._checked_monotonic = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        # One prober thread per worker; threads do not survive fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='health-prober', daemon=True).start()
+
+    def probe_now(self):
+        started = time.perf_counter()
+        result, providers = probe_upstream()
+        # Replace the snapshot wholesale so readers never see a half-updated one
+        self._snapshot = {
+            'api_test': result,
+            'providers': providers,
+            'latency_ms': round((time.perf_counter() - started) * 1000, 1),
+            'checked_at': datetime.now().isoformat()
+        }
+        self._checked_monotonic = time.monotonic()
+        if result != 'success':
+            print(f"Upstream health probe: {result}")
+
+    def _run(self):
+        # Small initial delay spreads the first probes of freshly forked workers
+        time.sleep(random.uniform(0, min(2.0, self.interval)))
+        while True:
+            try:
+                self.probe_now()
+            except Exception as e:
+                print(f"Upstream health probe failed: {e}")
+            spread = self.interval * self.jitter
+            time.sleep(max(1.0, self.interval + random.uniform(-spread, spread)))
+
+    def snapshot(self):
+        return self._snapshot
+
+    def age(self):
+        """Seconds since the last completed probe, or None before the first one"""
+        checked = self._checked_monotonic
+        return None if checked is None else time.monotonic() - checked
+
+    def is_healthy(self, max_age=HEALTH_MAX_AGE):
+        age = self.age()
+        return age is not None and age <= max_age and self._snapshot['api_test'] == 'success'
+
+health_prober = HealthProber()
+
+# -----------------------------------------------------------------------------
+# Worker processes (hooks for a preforking server, see gunicorn.conf.py)
+# -----------------------------------------------------------------------------
+def process_memory(pid='self'):
+    """(resident, shared) bytes of a process from /proc, or None where unavailable
+
+    Shared counts every resident page another process also maps, including
+    pages still shared copy-on-write with the process this one forked from.
+    """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line and not line.startswith(' '))
+    except OSError:
+        return None
+    kilobytes = lambda name: int(fields.get(name, '0 kB').split()[0]) * 1024
+    return kilobytes('Rss'), kilobytes('Shared_Clean') + kilobytes('Shared_Dirty')
+
+def prepare_for_fork():
+    """Build read-only derived state once in the parent so forked workers share its pages"""
+    resume = resumes_storage.get('public')
+    if resume is not None:
+        warm_resume_state(resume)
+
+class MemoryWatchdog:
+    """Reports this worker's resident memory and calls on_exceeded once it passes a ceiling"""
+
+    def __init__(self, max_bytes, interval, on_exceeded):
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.on_exceeded = on_exceeded
+        self._reported = 0
+
+    def start(self):
+        threading.Thread(target=self._run, name='memory-watchdog', daemon=True).start()
+
+    def _run(self):
+        pid = str(os.getpid())
+        while True:
+            memory = process_memory()
+            if memory is None:
+                return
+            resident = memory[0]
+            # Gauges only move by increments, so report the change since the last check
+            metrics.inc('portfolio_worker_resident_bytes', resident - self._reported, pid=pid)
+            self._reported = resident
+            if self.max_bytes and resident > self.max_bytes:
+                self.on_exceeded(resident)
+                return
+            time.sleep(self.interval)
+
+@app.before_request
+def start_background_workers():
+    health_prober.ensure_started()
+    metrics.ensure_flusher()
+    resume_watcher.ensure_started()
+
+@app.after_request
+def count_response(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('portfolio_http_requests_total', route=route, method=request.method, status=str(response.status_code))
+    return response
 
 @app.route('/reset')
 def reset_session():
-    """Reset only chat history for public session"""
-    if 'public' in resumes_storage:
-        resumes_storage['public']['chat_history'] = []
+    """Reset only this visitor's chat history"""
+    conversation_id = session.get('conversation_id')
+    if conversation_id:
+        conversation_store.clear(conversation_id)
+        conversation_memory.forget(conversation_id)
     session.clear()
     return jsonify({'success': True})
 
 @app.route('/health')
 def health_check():
-    """Health check endpoint to verify API configuration"""
+    """Health check endpoint; upstream status comes from the background prober"""
     try:
         # Basic health check
         status = {
             'status': 'healthy',
             'timestamp': datetime.now().isoformat(),
-            'api_configured': bool(DEEPSEEK_API_KEY and DEEPSEEK_API_KEY != 'your-deepseek-api-key'),
-            'active_sessions': len(resumes_storage)
+            'api_configured': api_key_configured(),
+            'active_sessions': len(resumes_storage),
+            'answer_cache': answer_cache.stats(),
+            'conversations': conversation_store.stats(),
+            'state': state_stats(),
+            'upstream_usage': usage_stats.stats(),
+            'single_flight': single_flight.stats(),
+            'providers': provider_router.stats(),
+            'upstream_admission': upstream_admission.stats(),
+            'stream_buffer': stream_buffer.stats(),
+            'page_cache': page_cache.stats(),
+            'resume': resume_watcher.stats(),
+            'memory': conversation_memory.stats()
         }
         
-        # Test API connectivity (optional)
+        # Latest background probe result (never calls the API on the request path)
         if status['api_configured']:
-            try:
-                test_messages = [
-                    {"role": "system", "content": "You are a test assistant."},
-                    {"role": "user", "content": "Say 'API test successful' in exactly 3 words."}
-                ]
-                
-                # Quick test with minimal timeout
-                headers = {
-                    'Authorization': f'Bearer {DEEPSEEK_API_KEY}',
-                    'Content-Type': 'application/json'
-                }
-                
-                payload = {
-                    'model': 'deepseek-chat',
-                    'messages': test_messages,
-                    'max_tokens': 10
-                }
-                
-                response = requests.post(
-                    DEEPSEEK_API_URL, 
-                    headers=headers, 
-                    json=payload, 
-                    timeout=5
-                )
-                
-                status['api_test'] = 'success' if response.status_code == 200 else f'failed_{response.status_code}'
-                
-            except Exception as e:
-                status['api_test'] = f'error_{str(e)[:50]}'
+            snapshot = health_prober.snapshot()
+            age = health_prober.age()
+            status['api_test'] = snapshot['api_test']
+            status['api_providers'] = snapshot['providers']
+            status['api_latency_ms'] = snapshot['latency_ms']
+            status['api_checked_at'] = snapshot['checked_at']
+            status['api_check_age_s'] = None if age is None else round(age, 1)
         else:
             status['api_test'] = 'not_configured'
         
@@ -557,18 +3786,48 @@ def health_check():
             'timestamp': datetime.now().isoformat()
         }), 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint, summed across this host's workers"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/health/live')
+def liveness_check():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({'status': 'alive'})
+
+@app.route('/health/ready')
+def readiness_check():
+    """Readiness probe: resume loaded and a recent successful upstream probe"""
+    resume_loaded = bool(resumes_storage.get('public', {}).get('resume_text'))
+    upstream_healthy = health_prober.is_healthy()
+    age = health_prober.age()
+    body = {
+        'status': 'ready' if resume_loaded and upstream_healthy else 'not_ready',
+        'resume_loaded': resume_loaded,
+        'upstream_healthy': upstream_healthy,
+        'api_check_age_s': None if age is None else round(age, 1)
+    }
+    return jsonify(body), 200 if body['status'] == 'ready' else 503
+
 if __name__ == '__main__':
     # Check configuration on startup
     print("=" * 50)
     print("Portfolio & Questions to Sulaiman Starting Up")
     print("=" * 50)
     
-    if not DEEPSEEK_API_KEY or DEEPSEEK_API_KEY == 'your-deepseek-api-key':
-        print("⚠️  WARNING: DeepSeek API key not configured!")
-        print("   Please set DEEPSEEK_API_KEY in your .env file")
-        print("   Get your API key at: https://platform.deepseek.com/api_keys")
-    else:
-        print(f"✅ DeepSeek API key configured (ends with: ...{DEEPSEEK_API_KEY[-4:]})")
+    for provider in provider_router.providers:
+        if not provider.configured():
+            print(f"⚠️  WARNING: {provider.name} API key not configured!")
+            if provider.name == 'deepseek':
+                print("   Please set DEEPSEEK_API_KEY in your .env file")
+                print("   Get your API key at: https://platform.deepseek.com/api_keys")
+        elif provider.kind == 'stub':
+            print(f"✅ {provider.name}: local stub (fallback only)")
+        else:
+            print(f"✅ {provider.name}: {provider.model} (key ends with: ...{provider.api_key[-4:]})")
+    if not provider_router.providers:
+        print("⚠️  WARNING: no LLM providers configured - check LLM_PROVIDERS")
     
     print(f"🌐 Server will start at: http://localhost:5000")
     print(f"🔧 Debug mode: {'ON' if app.debug else 'OFF'}")
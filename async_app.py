@@ -0,0 +1,855 @@
+"""
+Asyncio serving mode for the portfolio.
+
+The chat endpoints run natively on aiohttp so an SSE stream only costs a
+coroutine instead of a whole worker; every other route is handed to the
+Flask app on a thread pool. Run with:
+
+    gunicorn async_app:app --worker-class aiohttp.GunicornWebWorker --workers 2
+"""
+
+import asyncio
+import io
+import os
+import sys
+import time
+import uuid
+from collections import deque
+
+import aiohttp
+from aiohttp import web
+from multidict import CIMultiDict
+from werkzeug.test import run_wsgi_app
+
+from app import (
+    app as flask_app,
+    resumes_storage,
+    BATCH_CONCURRENCY,
+    DEEPSEEK_CONNECT_TIMEOUT,
+    DEEPSEEK_READ_TIMEOUT,
+    NOT_CONFIGURED_MESSAGE,
+    UNEXPECTED_ERROR_MESSAGE,
+    STREAM_TIMEOUT_MESSAGE,
+    STREAM_CONNECTION_MESSAGE,
+    UPSTREAM_UNAVAILABLE_MESSAGE,
+    UPSTREAM_MAX_ATTEMPTS,
+    UPSTREAM_MAX_IN_FLIGHT,
+    UPSTREAM_QUEUE_SIZE,
+    UPSTREAM_QUEUE_TIMEOUT,
+    SINGLE_FLIGHT_CHUNK_TIMEOUT,
+    SSE_COALESCE_CHARS,
+    SSE_COALESCE_WINDOW,
+    SSE_HEADERS,
+    StreamAccumulator,
+    ProviderFailed,
+    AdmissionTicket,
+    Deadline,
+    TokenBucket,
+    UpstreamOverloaded,
+    UpstreamUnavailable,
+    admit_upstream_attempt,
+    answer_cache,
+    assets,
+    batch_result,
+    batch_summary,
+    prepare_chat_turn,
+    api_key_configured,
+    metrics,
+    resume_watcher,
+    state_backend,
+    observe_generation,
+    parse_retry_after,
+    parse_stream_chunk,
+    provider_router,
+    read_batch_questions,
+    record_chat_turn,
+    record_usage,
+    retry_delay,
+    settle_upstream_exception,
+    settle_upstream_status,
+    sse_event,
+    stream_buffer,
+    upstream_error_message,
+)
+
+# Upstream connections are held for the whole length of a stream, so the
+# async pool is sized for concurrent streams rather than for worker threads
+ASYNC_UPSTREAM_POOL_SIZE = int(os.getenv('ASYNC_UPSTREAM_POOL_SIZE', '512'))
+
+# -----------------------------------------------------------------------------
+# Upstream client (one aiohttp session per worker, created after fork)
+# -----------------------------------------------------------------------------
+async def open_upstream_session(application):
+    metrics.ensure_flusher()
+    resume_watcher.ensure_started()
+    connector = aiohttp.TCPConnector(limit=ASYNC_UPSTREAM_POOL_SIZE, keepalive_timeout=60)
+    # Shared by every provider; credentials go on each request
+    application['upstream'] = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(sock_connect=DEEPSEEK_CONNECT_TIMEOUT, sock_read=DEEPSEEK_READ_TIMEOUT)
+    )
+    # Bounds the batch questions of all /chat/batch requests on this worker
+    application['batch_limit'] = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+async def close_upstream_session(application):
+    await application['upstream'].close()
+
+async def send_upstream_async(upstream, provider, payload, stream=False, deadline=None,
+                              max_attempts=UPSTREAM_MAX_ATTEMPTS):
+    """send_upstream for the event loop: same deadline, backoff and breaker, but waits never block"""
+    deadline = deadline or Deadline()
+    headers = {**provider.headers(), 'Accept': 'text/event-stream' if stream else 'application/json'}
+    attempt = 0
+    while True:
+        attempt += 1
+        admit_upstream_attempt(provider, attempt)
+        retry_after = None
+        try:
+            response = await upstream.post(
+                provider.api_url, json=payload, headers=headers,
+                timeout=aiohttp.ClientTimeout(sock_connect=deadline.clamp(DEEPSEEK_CONNECT_TIMEOUT),
+                                              sock_read=deadline.clamp(DEEPSEEK_READ_TIMEOUT))
+            )
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+            settle_upstream_exception(provider, 'timeout' if isinstance(e, asyncio.TimeoutError) else 'connection')
+            delay = retry_delay(attempt, deadline, max_attempts=max_attempts)
+            if delay is None:
+                raise
+            print(f"{provider.name} {type(e).__name__} (attempt {attempt}/{max_attempts}), retrying in {delay:.2f}s...")
+        except Exception:
+            # Every attempt is settled, or a half-open trial would hold the breaker shut
+            settle_upstream_exception(provider, 'unexpected')
+            raise
+        except BaseException:
+            # Cancelled, e.g. a batch whose client went away: not the provider's fault
+            provider.breaker.abandon_trial()
+            raise
+        else:
+            if not settle_upstream_status(provider, response.status):
+                return response
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            delay = retry_delay(attempt, deadline, retry_after, max_attempts)
+            if delay is None:
+                return response
+            response.release()
+            print(f"{provider.name} status {response.status} (attempt {attempt}/{max_attempts}), retrying in {delay:.2f}s...")
+        await asyncio.sleep(delay)
+
+async def complete_with_async(upstream, provider, messages, upstream_info, deadline, max_attempts):
+    """One provider's non-streaming answer; mirrors complete_with"""
+    if upstream_info is not None:
+        upstream_info.update(provider=provider.name, model=provider.model)
+    if provider.kind == 'stub':
+        return provider.reply
+
+    started = time.perf_counter()
+    try:
+        response = await send_upstream_async(upstream, provider, provider.payload(messages),
+                                              deadline=deadline, max_attempts=max_attempts)
+    except UpstreamUnavailable as e:
+        raise ProviderFailed(str(e), 'circuit_open')
+    except asyncio.TimeoutError:
+        print(f"Error: {provider.name} request timed out after {max_attempts} attempt(s)")
+        raise ProviderFailed(None, 'timeout')
+    except aiohttp.ClientConnectionError:
+        print(f"Error: {provider.name} connection failed after {max_attempts} attempt(s)")
+        raise ProviderFailed(None, 'connection')
+
+    async with response:
+        metrics.observe('portfolio_upstream_connect_seconds', time.perf_counter() - started,
+                        mode='message', provider=provider.name)
+        if response.status != 200:
+            if response.status not in (401, 429):
+                print(f"{provider.name} API error: {response.status} - {await response.text()}")
+            raise ProviderFailed(upstream_error_message(response.status), f'http_{response.status}')
+
+        data = await response.json()
+        record_usage(data.get('usage'), upstream_info)
+        if not data.get('choices'):
+            print("Error: No choices in API response")
+            raise ProviderFailed("I apologize, but I couldn't generate a proper response. Please try again.",
+                                 'no_choices')
+        content = data['choices'][0]['message']['content']
+        observe_generation('message', started, len(content), upstream_info)
+        if upstream_info is not None:
+            upstream_info['ok'] = True
+        return content
+
+async def call_chat_api_async(upstream, messages, upstream_info=None):
+    """Non-streaming chat call with provider failover; mirrors call_chat_api"""
+    try:
+        candidates = provider_router.candidates()
+        if not candidates:
+            if not api_key_configured():
+                print("Error: no LLM provider is configured properly")
+                return NOT_CONFIGURED_MESSAGE
+            print("Every provider's circuit is open, failing fast")
+            return UPSTREAM_UNAVAILABLE_MESSAGE
+
+        deadline = Deadline()
+        for position, provider in enumerate(candidates, 1):
+            last = position == len(candidates)
+            try:
+                return await complete_with_async(upstream, provider, messages, upstream_info, deadline,
+                                                 UPSTREAM_MAX_ATTEMPTS if last else 1)
+            except ProviderFailed as e:
+                if last:
+                    return e.message
+                provider_router.record_failover(provider, e.reason)
+
+    except Exception as e:
+        print(f"Unexpected error calling the chat API: {str(e)}")
+        metrics.inc('portfolio_upstream_errors_total', provider='unknown', error_class='unexpected')
+        return UNEXPECTED_ERROR_MESSAGE
+
+async def stream_with_async(upstream, provider, messages, upstream_info, deadline, max_attempts):
+    """Yield one provider's content deltas; mirrors stream_with"""
+    if upstream_info is not None:
+        upstream_info.update(provider=provider.name, model=provider.model)
+    if provider.kind == 'stub':
+        for chunk in provider.chunks():
+            yield chunk
+            await asyncio.sleep(provider.token_delay)
+        return
+
+    started = time.perf_counter()
+    try:
+        response = await send_upstream_async(upstream, provider, provider.payload(messages, stream=True),
+                                              stream=True, deadline=deadline, max_attempts=max_attempts)
+    except UpstreamUnavailable as e:
+        raise ProviderFailed(str(e), 'circuit_open')
+    except asyncio.TimeoutError:
+        print(f"Error: {provider.name} streaming request timed out")
+        raise ProviderFailed(STREAM_TIMEOUT_MESSAGE, 'timeout')
+    except aiohttp.ClientConnectionError:
+        print(f"Error: {provider.name} streaming connection failed")
+        raise ProviderFailed(STREAM_CONNECTION_MESSAGE, 'connection')
+
+    generated_chars = 0
+    try:
+        async with response:
+            metrics.observe('portfolio_upstream_connect_seconds', time.perf_counter() - started,
+                            mode='stream', provider=provider.name)
+            if response.status != 200:
+                if response.status not in (401, 429):
+                    print(f"{provider.name} API error: {response.status} - {await response.text()}")
+                raise ProviderFailed(upstream_error_message(response.status), f'http_{response.status}')
+
+            async for raw_line in response.content:
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith('data: '):
+                    continue
+
+                data_str = line[6:]
+                if data_str.strip() == '[DONE]':
+                    if upstream_info is not None:
+                        upstream_info['ok'] = True
+                    break
+
+                content, usage = parse_stream_chunk(data_str)
+                record_usage(usage, upstream_info)
+                if content:
+                    if not generated_chars:
+                        ttft = time.perf_counter() - started
+                        metrics.observe('portfolio_time_to_first_token_seconds', ttft,
+                                        mode='stream', provider=provider.name)
+                        provider.window.record_ttft(ttft)
+                    generated_chars += len(content)
+                    yield content
+
+        observe_generation('stream', started, generated_chars, upstream_info)
+
+    except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+        # Stalled or dropped after send_upstream_async returned
+        timed_out = isinstance(e, asyncio.TimeoutError)
+        settle_upstream_exception(provider, 'timeout' if timed_out else 'connection')
+        message = STREAM_TIMEOUT_MESSAGE if timed_out else STREAM_CONNECTION_MESSAGE
+        print(f"Error: {provider.name} stream {'timed out' if timed_out else 'connection failed'}")
+        if not generated_chars:
+            raise ProviderFailed(message, 'timeout' if timed_out else 'connection')
+        yield message
+
+async def call_chat_api_streaming_async(upstream, messages, upstream_info=None):
+    """Streaming chat call with provider failover; yields content deltas like call_chat_api_streaming"""
+    try:
+        candidates = provider_router.candidates()
+        if not candidates:
+            if not api_key_configured():
+                print("Error: no LLM provider is configured properly")
+                yield NOT_CONFIGURED_MESSAGE
+                return
+            print("Every provider's circuit is open, failing fast")
+            raise UpstreamUnavailable(UPSTREAM_UNAVAILABLE_MESSAGE)
+
+        deadline = Deadline()
+        for position, provider in enumerate(candidates, 1):
+            last = position == len(candidates)
+            try:
+                async for chunk in stream_with_async(upstream, provider, messages, upstream_info, deadline,
+                                                     UPSTREAM_MAX_ATTEMPTS if last else 1):
+                    yield chunk
+                return
+            except ProviderFailed as e:
+                if not last:
+                    provider_router.record_failover(provider, e.reason)
+                    continue
+                if e.reason == 'circuit_open':
+                    print("Upstream circuit open, failing fast")
+                    raise UpstreamUnavailable(e.message)
+                yield e.message
+
+    except UpstreamUnavailable:
+        raise
+
+    except Exception as e:
+        print(f"Unexpected error in streaming API call: {str(e)}")
+        metrics.inc('portfolio_upstream_errors_total', provider='unknown', error_class='unexpected')
+        yield UNEXPECTED_ERROR_MESSAGE
+
+# -----------------------------------------------------------------------------
+# Single-flight streams (asyncio counterpart of app.SingleFlight)
+# -----------------------------------------------------------------------------
+class AsyncFlight:
+    """One upstream generation that any number of SSE clients can follow"""
+
+    def __init__(self):
+        self.chunks = []
+        self.chars = 0
+        self.done = False
+        self.error = None
+        self.upstream_info = {}
+        self.task = None
+        self._condition = asyncio.Condition()
+
+    @classmethod
+    def finished(cls, text):
+        """A completed flight holding a ready answer, so it can be streamed and resumed like a live one"""
+        flight = cls()
+        flight.chunks.append(text)
+        flight.chars = len(text)
+        flight.done = True
+        return flight
+
+    def text(self):
+        return ''.join(self.chunks)
+
+    def _locate(self, offset):
+        """(chunk index, chars into that chunk) of a character offset"""
+        position, before = 0, 0
+        while position < len(self.chunks) and before + len(self.chunks[position]) <= offset:
+            before += len(self.chunks[position])
+            position += 1
+        return position, offset - before
+
+    async def publish(self, chunk):
+        async with self._condition:
+            self.chunks.append(chunk)
+            self.chars += len(chunk)
+            self._condition.notify_all()
+
+    async def finish(self, error=None):
+        async with self._condition:
+            self.error = error
+            self.done = True
+            self._condition.notify_all()
+
+    async def subscribe(self, timeout=SINGLE_FLIGHT_CHUNK_TIMEOUT, window=SSE_COALESCE_WINDOW,
+                        max_chars=SSE_COALESCE_CHARS, offset=0):
+        """Yield the text from offset on, then the live tail until the flight ends, as coalesced frames"""
+        position, trim = self._locate(offset)
+        consumed = 0
+        while True:
+            async with self._condition:
+                await asyncio.wait_for(
+                    self._condition.wait_for(lambda: position < len(self.chunks) or self.done),
+                    timeout
+                )
+                if consumed:
+                    try:
+                        await asyncio.wait_for(
+                            self._condition.wait_for(lambda: self.done or self.chars - consumed >= max_chars),
+                            window
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+                new_chunks = self.chunks[position:]
+                finished = self.done
+                consumed = self.chars
+            if new_chunks:
+                yield ''.join(new_chunks)[trim:]
+                trim = 0
+            position += len(new_chunks)
+            if finished:
+                if self.error:
+                    raise RuntimeError(self.error)
+                return
+
+class AsyncSingleFlight:
+    """Registry of in-flight generations keyed by prompt fingerprint"""
+
+    def __init__(self):
+        self._flights = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def join(self, key, producer, admit=None):
+        """Attach to the flight for key, starting producer(upstream_info) as a task if there is none
+
+        Only a new leader awaits admit(); its ticket is held until the producer ends.
+        """
+        if admit is not None and key not in self._flights:
+            ticket = await admit()
+        else:
+            ticket = None
+        flight = self._flights.get(key)
+        if flight is not None:
+            # Either an existing flight, or another leader started while we waited for admission
+            if ticket is not None:
+                ticket.release()
+            self.followers += 1
+            return flight, False
+        flight = self._flights[key] = AsyncFlight()
+        self.leaders += 1
+        flight.task = asyncio.ensure_future(self._run(key, flight, producer, ticket))
+        return flight, True
+
+    async def _run(self, key, flight, producer, ticket=None):
+        error = None
+        try:
+            async for chunk in producer(flight.upstream_info):
+                if chunk:
+                    await flight.publish(chunk)
+        except Exception as e:
+            print(f"Error in single-flight generation: {str(e)}")
+            error = str(e)
+        finally:
+            self._flights.pop(key, None)
+            if ticket is not None:
+                ticket.release()
+            await flight.finish(error)
+
+single_flight = AsyncSingleFlight()
+
+class AsyncAdmissionController:
+    """AdmissionController for the event loop: waiters queue as futures and get slots in FIFO order"""
+
+    def __init__(self, max_in_flight=UPSTREAM_MAX_IN_FLIGHT, queue_size=UPSTREAM_QUEUE_SIZE,
+                 queue_timeout=UPSTREAM_QUEUE_TIMEOUT, bucket=None):
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.bucket = bucket or TokenBucket()
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        self._waiters = deque()
+
+    def _shed(self, reason, retry_after):
+        self.shed += 1
+        metrics.inc('portfolio_upstream_shed_total', reason=reason)
+        print(f"Shedding upstream request ({reason})")
+        raise UpstreamOverloaded(reason, retry_after)
+
+    async def acquire(self):
+        started = time.monotonic()
+        if self.in_flight >= self.max_in_flight:
+            if len(self._waiters) >= self.queue_size:
+                self._shed('queue_full', self.queue_timeout)
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            metrics.inc('portfolio_upstream_queue_depth')
+            try:
+                # release() hands its slot straight to the first live waiter
+                await asyncio.wait_for(waiter, self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._shed('queue_timeout', self.queue_timeout)
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                metrics.inc('portfolio_upstream_queue_depth', -1)
+        else:
+            self.in_flight += 1
+
+        metrics.inc('portfolio_upstream_in_flight')
+        wait = self.bucket.reserve(max(0.0, started + self.queue_timeout - time.monotonic()))
+        if wait is None:
+            self.release()
+            self._shed('rate_limited', self.bucket.next_token_in())
+        if wait:
+            await asyncio.sleep(wait)
+        self.admitted += 1
+        metrics.observe('portfolio_upstream_queue_wait_seconds', time.monotonic() - started)
+        return AdmissionTicket(self)
+
+    def release(self):
+        metrics.inc('portfolio_upstream_in_flight', -1)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+upstream_admission = AsyncAdmissionController()
+
+# -----------------------------------------------------------------------------
+# Conversation and answer state (blocking with a shared backend, so kept off the loop)
+# -----------------------------------------------------------------------------
+async def off_loop(func, *args):
+    """Run conversation/answer-cache work on the default thread pool when it may block
+
+    With STATE_BACKEND=sqlite these calls read SQLite and group-commit turns,
+    waiting up to the busy timeout while another worker holds the write lock;
+    on the loop that would stall every stream of this worker. In-memory state
+    is a dictionary lookup, cheaper inline than a thread hop.
+    """
+    if state_backend is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+def streaming_producer(upstream, messages, cache_key):
+    """Upstream generation for a flight; caches the answer before the flight closes"""
+    async def produce(upstream_info):
+        parts = []
+        async for chunk in call_chat_api_streaming_async(upstream, messages, upstream_info):
+            parts.append(chunk)
+            yield chunk
+        if upstream_info.get('ok') and parts:
+            await off_loop(answer_cache.put, cache_key, ''.join(parts))
+    return produce
+
+# -----------------------------------------------------------------------------
+# Chat routes
+# -----------------------------------------------------------------------------
+def load_flask_session(request):
+    """Decode the Flask session cookie so both serving modes share sessions"""
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if not cookie or serializer is None:
+        return {}
+    try:
+        return serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return {}
+
+def save_flask_session(response, session_data):
+    """Write session_data back as a Flask-compatible signed cookie"""
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if serializer is None:
+        return
+    response.set_cookie(
+        flask_app.config['SESSION_COOKIE_NAME'],
+        serializer.dumps(dict(session_data)),
+        path=flask_app.config['SESSION_COOKIE_PATH'] or '/',
+        domain=flask_app.config['SESSION_COOKIE_DOMAIN'],
+        secure=flask_app.config['SESSION_COOKIE_SECURE'],
+        httponly=flask_app.config['SESSION_COOKIE_HTTPONLY'],
+        samesite=flask_app.config['SESSION_COOKIE_SAMESITE']
+    )
+
+class ChatRequest:
+    """Validated chat POST plus the visitor's session"""
+    __slots__ = ('session_id', 'conversation_id', 'user_message', 'session', 'session_changed')
+
+    def __init__(self, session_id, conversation_id, user_message, session, session_changed):
+        self.session_id = session_id
+        self.conversation_id = conversation_id
+        self.user_message = user_message
+        self.session = session
+        self.session_changed = session_changed
+
+    def finish_response(self, response):
+        if self.session_changed:
+            save_flask_session(response, self.session)
+        return response
+
+async def read_chat_request(request):
+    """Validate a chat POST; returns a ChatRequest or an error response"""
+    session = load_flask_session(request)
+    session_id = session.get('public_session_id') or 'public'
+
+    if not session_id or session_id not in resumes_storage:
+        return None, web.json_response({'error': 'No active session. Please access the chat properly.'}, status=400)
+
+    try:
+        body = await request.json()
+        user_message = (body.get('message') or '').strip()
+    except Exception as e:
+        return None, web.json_response({'error': str(e)}, status=500)
+
+    if not user_message:
+        return None, web.json_response({'error': 'Please provide a message'}, status=400)
+
+    conversation_id = session.get('conversation_id')
+    session_changed = not conversation_id
+    if session_changed:
+        conversation_id = session['conversation_id'] = uuid.uuid4().hex
+
+    return ChatRequest(session_id, conversation_id, user_message, session, session_changed), None
+
+def shed_response(error):
+    """503 JSON for a request shed by admission control"""
+    return web.json_response({'error': str(error), 'retry_after': error.retry_after}, status=503,
+                             headers={'Retry-After': str(error.retry_after)})
+
+async def chat_message(request):
+    """Non-streaming chat endpoint, same contract as the Flask route"""
+    chat, error = await read_chat_request(request)
+    if error is not None:
+        return error
+    user_message = chat.user_message
+
+    try:
+        resume_data = resumes_storage[chat.session_id]
+        cache_key, cached, cache_status, messages, prompt_tokens = await off_loop(
+            prepare_chat_turn, resume_data, chat.conversation_id, user_message)
+        if cached is not None:
+            await off_loop(record_chat_turn, chat.conversation_id, user_message, cached)
+            return chat.finish_response(web.json_response({'response': cached}, headers={'X-Answer-Cache': cache_status}))
+
+        upstream_info = {}
+        try:
+            ticket = await upstream_admission.acquire()
+        except UpstreamOverloaded as e:
+            return shed_response(e)
+        with ticket:
+            response = await call_chat_api_async(request.app['upstream'], messages, upstream_info)
+        if response:
+            await off_loop(record_chat_turn, chat.conversation_id, user_message, response)
+            if upstream_info.get('ok'):
+                await off_loop(answer_cache.put, cache_key, response)
+            return chat.finish_response(web.json_response({'response': response}, headers={
+                'X-Answer-Cache': 'miss',
+                'X-Prompt-Tokens': str(prompt_tokens)
+            }))
+        return web.json_response({'error': 'Failed to get AI response. Please check your internet connection and try again.'}, status=500)
+
+    except Exception as e:
+        return web.json_response({'error': str(e)}, status=500)
+
+async def chat_stream(request):
+    """Streaming chat endpoint emitting the same chunk/complete/error SSE events"""
+    chat, error = await read_chat_request(request)
+    if error is not None:
+        return error
+    user_message = chat.user_message
+
+    resume_data = resumes_storage[chat.session_id]
+    headers = {**SSE_HEADERS, 'Content-Type': 'text/event-stream'}
+    resumed = stream_buffer.resume(request.headers.get('Last-Event-ID'), chat.conversation_id)
+    if resumed is not None:
+        # A dropped connection coming back: continue the buffered stream, no upstream call
+        stream_id, buffered, offset = resumed
+        flight = buffered.flight
+        headers['X-Stream-Resumed'] = str(offset)
+    else:
+        cache_key, cached, cache_status, messages, prompt_tokens = await off_loop(
+            prepare_chat_turn, resume_data, chat.conversation_id, user_message)
+        headers['X-Answer-Cache'] = cache_status
+        if cached is not None:
+            flight = AsyncFlight.finished(cached)
+        else:
+            headers['X-Prompt-Tokens'] = str(prompt_tokens)
+            # Identical concurrent questions attach to one upstream generation
+            try:
+                flight, is_leader = await single_flight.join(
+                    cache_key, streaming_producer(request.app['upstream'], messages, cache_key),
+                    admit=upstream_admission.acquire
+                )
+            except UpstreamOverloaded as e:
+                return shed_response(e)
+            headers['X-Single-Flight'] = 'leader' if is_leader else 'follower'
+        offset = 0
+        stream_id, buffered = stream_buffer.register(flight, chat.conversation_id, user_message)
+    headers['X-Stream-Id'] = stream_id
+
+    stream = web.StreamResponse(headers=headers)
+    chat.finish_response(stream)
+    await stream.prepare(request)
+
+    metrics.inc('portfolio_active_sse_streams')
+    try:
+        # The digest covers the whole answer, including text sent before a reconnect
+        accumulator = StreamAccumulator()
+        if offset:
+            accumulator.add(flight.text()[:offset])
+        async for chunk in flight.subscribe(offset=offset):
+            accumulator.add(chunk)
+            event_id = f'{stream_id}:{accumulator.chars}'
+            await stream.write(sse_event({'chunk': chunk, 'type': 'chunk'}, event_id).encode('utf-8'))
+
+        full_response = accumulator.text()
+        if full_response and stream_buffer.claim_turn(buffered):
+            await off_loop(record_chat_turn, chat.conversation_id, buffered.user_message, full_response)
+
+        await stream.write(accumulator.complete_event(f'{stream_id}:{accumulator.chars}').encode('utf-8'))
+
+    except ConnectionResetError:
+        # Browser went away; the flight keeps running for its other subscribers
+        return stream
+
+    except Exception as e:
+        print(f"Error in streaming: {str(e)}")
+        await stream.write(sse_event({'type': 'error', 'error': str(e)}).encode('utf-8'))
+
+    finally:
+        metrics.inc('portfolio_active_sse_streams', -1)
+
+    await stream.write_eof()
+    return stream
+
+async def answer_batch_question(application, resume_data, question, indices):
+    """answer_batch_question for the event loop, bounded by the worker's batch semaphore"""
+    started = time.perf_counter()
+    cache_key, cached, cache_status, messages, _ = await off_loop(prepare_chat_turn, resume_data, None, question)
+    if cached is not None:
+        return batch_result(indices, question, 'ok', cached, cache_status, started)
+
+    upstream_info = {}
+    async with application['batch_limit']:
+        try:
+            ticket = await upstream_admission.acquire()
+        except UpstreamOverloaded as e:
+            return batch_result(indices, question, 'shed', str(e), 'miss', started, retry_after=e.retry_after)
+        with ticket:
+            response = await call_chat_api_async(application['upstream'], messages, upstream_info)
+    if upstream_info.get('ok'):
+        await off_loop(answer_cache.put, cache_key, response)
+    return batch_result(indices, question, 'ok' if upstream_info.get('ok') else 'error', response, 'miss',
+                        started, provider=upstream_info.get('provider'))
+
+async def chat_batch(request):
+    """Batch endpoint, same contract as the Flask route: one SSE result event per unique question"""
+    session = load_flask_session(request)
+    session_id = session.get('public_session_id') or 'public'
+    if not session_id or session_id not in resumes_storage:
+        return web.json_response({'error': 'No active session. Please access the chat properly.'}, status=400)
+    try:
+        groups = read_batch_questions(await request.json())
+    except ValueError as e:
+        return web.json_response({'error': str(e)}, status=400)
+
+    resume_data = resumes_storage[session_id]
+    total = sum(len(indices) for _, indices in groups)
+    started = time.perf_counter()
+    tasks = {asyncio.ensure_future(answer_batch_question(request.app, resume_data, question, indices)): (question, indices)
+             for question, indices in groups}
+
+    stream = web.StreamResponse(headers={**SSE_HEADERS, 'Content-Type': 'text/event-stream',
+                                         'X-Batch-Unique': str(len(groups))})
+    await stream.prepare(request)
+    results = []
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                question, indices = tasks[task]
+                try:
+                    result = task.result()
+                except Exception as e:
+                    print(f"Error answering batch question: {str(e)}")
+                    result = batch_result(indices, question, 'error', UNEXPECTED_ERROR_MESSAGE, 'miss', started)
+                results.append(result)
+                await stream.write(sse_event(result).encode('utf-8'))
+        await stream.write(sse_event(batch_summary(total, results, started)).encode('utf-8'))
+    except ConnectionResetError:
+        return stream
+    finally:
+        # The client went away: stop answering for it
+        for task in tasks:
+            task.cancel()
+
+    await stream.write_eof()
+    return stream
+
+# -----------------------------------------------------------------------------
+# Everything else is served by the Flask app on the default thread pool
+# -----------------------------------------------------------------------------
+def build_wsgi_environ(request, body):
+    host, _, port = request.host.partition(':')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': request.path,
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': host,
+        'SERVER_PORT': port or ('443' if request.scheme == 'https' else '80'),
+        'SERVER_PROTOCOL': f'HTTP/{request.version.major}.{request.version.minor}',
+        'REMOTE_ADDR': request.remote or '',
+        'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            continue
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+def call_flask(environ):
+    app_iter, status, headers = run_wsgi_app(flask_app.wsgi_app, environ, buffered=True)
+    try:
+        body = b''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    return status, headers, body
+
+async def flask_fallback(request):
+    body = await request.read()
+    environ = build_wsgi_environ(request, body)
+    status, headers, body = await asyncio.get_running_loop().run_in_executor(None, call_flask, environ)
+    response_headers = CIMultiDict((name, value) for name, value in headers.items() if name.lower() != 'content-length')
+    return web.Response(status=int(status.split(' ', 1)[0]), headers=response_headers, body=body)
+
+# -----------------------------------------------------------------------------
+# Fingerprinted static assets straight from memory, without the Flask hop
+# -----------------------------------------------------------------------------
+async def static_asset(request):
+    selected = assets.select(request.match_info['filename'], request.headers.get('Accept-Encoding'))
+    if selected is None:
+        raise web.HTTPNotFound()
+    mimetype, coding, body = selected
+    return web.Response(body=body, content_type=mimetype, headers=assets.headers(coding))
+
+@web.middleware
+async def count_native_requests(request, handler):
+    """Count natively served routes; Flask counts everything it serves itself"""
+    if request.match_info.handler is flask_fallback:
+        return await handler(request)
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource else 'unmatched'
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.inc('portfolio_http_requests_total', route=route, method=request.method, status=str(status))
+
+def create_app():
+    application = web.Application(middlewares=[count_native_requests])
+    application.on_startup.append(open_upstream_session)
+    application.on_cleanup.append(close_upstream_session)
+    application.router.add_post('/chat/message', chat_message)
+    application.router.add_post('/chat/stream', chat_stream)
+    application.router.add_post('/chat/batch', chat_batch)
+    application.router.add_get('/assets/{filename:.+}', static_asset)
+    application.router.add_route('*', '/{tail:.*}', flask_fallback)
+    return application
+
+app = create_app()
+
+if __name__ == '__main__':
+    web.run_app(app, host='0.0.0.0', port=int(os.getenv('PORT', '5000')))
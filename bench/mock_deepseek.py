@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the DeepSeek chat completions API, for benchmarks.
+Speaks the same OpenAI-style JSON and SSE formats, including the final
+usage chunk, with configurable latency and fault injection. Point the
+app at it with DEEPSEEK_API_URL=http://127.0.0.1:8900/v1/chat/completions.
+
+Usage: python bench/mock_deepseek.py [--port 8900] [--tokens 120]
+       [--token-delay 0.02] [--first-byte-delay 0.3]
+       [--error-rate 0.0] [--rate-limit-rate 0.0] [--retry-after 1]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+WORDS = ("Sulaiman has built data pipelines with Python, SQL and Spark, "
+         "shipped dashboards for stakeholders and automated reporting across teams.").split()
+
+def completion_text(tokens):
+    return ' '.join(WORDS[i % len(WORDS)] for i in range(tokens))
+
+def usage_block(prompt_tokens, completion_tokens):
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+        'prompt_cache_hit_tokens': 0,
+        'prompt_cache_miss_tokens': prompt_tokens
+    }
+
+def sse(data):
+    return f"data: {json.dumps(data)}\n\n".encode('utf-8')
+
+class MockDeepSeek:
+    """Request handler plus counters, configured from the command line"""
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.counts = {'requests': 0, 'streams': 0, 'errors': 0, 'rate_limited': 0}
+
+    def injected_fault(self):
+        """A (status, headers) to fail with, or None to answer normally"""
+        roll = self.random.random()
+        if roll < self.args.rate_limit_rate:
+            self.counts['rate_limited'] += 1
+            return 429, {'Retry-After': str(self.args.retry_after)}
+        if roll < self.args.rate_limit_rate + self.args.error_rate:
+            self.counts['errors'] += 1
+            return 503, {}
+        return None
+
+    async def completions(self, request):
+        self.counts['requests'] += 1
+        body = await request.json()
+        prompt_tokens = sum(len(m.get('content', '')) for m in body.get('messages', [])) // 4
+        tokens = min(self.args.tokens, body.get('max_tokens') or self.args.tokens)
+
+        await asyncio.sleep(self.args.first_byte_delay)
+        fault = self.injected_fault()
+        if fault is not None:
+            status, headers = fault
+            return web.json_response({'error': {'message': 'injected fault'}}, status=status, headers=headers)
+
+        if not body.get('stream'):
+            await asyncio.sleep(self.args.token_delay * tokens)
+            return web.json_response({
+                'id': f'mock-{self.counts["requests"]}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body.get('model', 'deepseek-chat'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': completion_text(tokens)},
+                             'finish_reason': 'stop'}],
+                'usage': usage_block(prompt_tokens, tokens)
+            })
+
+        self.counts['streams'] += 1
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        for i in range(tokens):
+            word = WORDS[i % len(WORDS)]
+            await response.write(sse({'choices': [{'index': 0, 'delta': {'content': word if i == 0 else ' ' + word}}]}))
+            await asyncio.sleep(self.args.token_delay)
+        final = {'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+        if (body.get('stream_options') or {}).get('include_usage'):
+            final['usage'] = usage_block(prompt_tokens, tokens)
+        await response.write(sse(final))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def stats(self, request):
+        return web.json_response(self.counts)
+
+def create_app(args):
+    mock = MockDeepSeek(args)
+    application = web.Application()
+    application.router.add_get('/stats', mock.stats)
+    application.router.add_post('/{tail:.*}', mock.completions)
+    return application
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--tokens', type=int, default=120, help='tokens per answer (default 120)')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='seconds between tokens (default 0.02)')
+    parser.add_argument('--first-byte-delay', type=float, default=0.3, help='seconds before the first byte (default 0.3)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with a 429 (default 1)')
+    parser.add_argument('--seed', type=int, default=None, help='seed for fault injection')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    web.run_app(create_app(args), host=args.host, port=args.port, print=None, access_log=None)
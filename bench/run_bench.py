@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Load and latency benchmark for /chat/stream and /chat/message.
+Starts the mock DeepSeek server, then, for each gunicorn worker model,
+serves the app against it and drives concurrent chat clients. Reports
+p50/p95/p99 time-to-first-token and total latency, requests/sec and RSS
+per worker as JSON, for regression tracking.
+
+Usage: python bench/run_bench.py [--models sync:4,gthread:2x8,aiohttp:2]
+       [--endpoints stream,message] [--concurrency 50] [--requests 300]
+       [--output bench/results.json] [mock options, see --help]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_VERSION = 1
+
+# Worker model name -> gunicorn app and worker class
+WORKER_MODELS = {
+    'sync': ('wsgi:app', 'sync'),
+    'gthread': ('wsgi:app', 'gthread'),
+    'gevent': ('wsgi:app', 'gevent'),
+    'aiohttp': ('async_app:app', 'aiohttp.GunicornWebWorker'),
+}
+
+def parse_model(spec):
+    """'gthread:2x8' -> ('gthread', 2 workers, 8 threads)"""
+    name, _, size = spec.partition(':')
+    if name not in WORKER_MODELS:
+        raise argparse.ArgumentTypeError(f"unknown worker model {name!r} (choose from {', '.join(WORKER_MODELS)})")
+    workers, _, threads = (size or '1').partition('x')
+    return name, int(workers), int(threads or 1)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+
+def percentile(sorted_values, p):
+    """Linear-interpolated percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+def summarize_ms(values):
+    values = sorted(v * 1000 for v in values)
+    if not values:
+        return None
+    return {
+        'p50': round(percentile(values, 50), 2),
+        'p95': round(percentile(values, 95), 2),
+        'p99': round(percentile(values, 99), 2),
+        'mean': round(sum(values) / len(values), 2),
+        'max': round(values[-1], 2)
+    }
+
+# -----------------------------------------------------------------------------
+# Process memory (Linux /proc)
+# -----------------------------------------------------------------------------
+def child_pids(parent):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                # The command name may contain spaces, so split after its closing parenthesis
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent:
+            children.append(int(entry))
+    return children
+
+def rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+async def sample_rss(master_pid, peaks, interval=0.5):
+    """Record the peak RSS of each gunicorn worker until cancelled"""
+    while True:
+        for pid in child_pids(master_pid):
+            value = rss_mb(pid)
+            if value is not None:
+                peaks[pid] = max(peaks.get(pid, 0), value)
+        await asyncio.sleep(interval)
+
+# -----------------------------------------------------------------------------
+# Load driver
+# -----------------------------------------------------------------------------
+class Sample:
+    __slots__ = ('ok', 'status', 'ttft', 'latency')
+
+    def __init__(self, ok, status, ttft, latency):
+        self.ok = ok
+        self.status = status
+        self.ttft = ttft
+        self.latency = latency
+
+async def one_request(client, base_url, endpoint, question):
+    started = time.perf_counter()
+    ttft = None
+    try:
+        async with client.post(f'{base_url}/chat/{endpoint}', json={'message': question}) as response:
+            if endpoint == 'message':
+                await response.read()
+                latency = time.perf_counter() - started
+                return Sample(response.status == 200, str(response.status), latency, latency)
+
+            ok = False
+            async for line in response.content:
+                if not line.startswith(b'data: '):
+                    continue
+                if ttft is None and b'"type":"chunk"' in line:
+                    ttft = time.perf_counter() - started
+                elif b'"type":"complete"' in line:
+                    ok = True
+                elif b'"type":"error"' in line:
+                    break
+            return Sample(ok and response.status == 200, str(response.status), ttft, time.perf_counter() - started)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return Sample(False, type(e).__name__, None, time.perf_counter() - started)
+
+def make_question(index, distinct):
+    if distinct:
+        return f"Benchmark question {index % distinct}: what has the candidate built with data pipelines?"
+    # A unique question every time, so neither the answer cache nor single-flight hides the upstream
+    return f"Benchmark question {uuid.uuid4().hex}: what has the candidate built with data pipelines?"
+
+async def drive(base_url, endpoint, concurrency, total, distinct, timeout):
+    """Run total requests from concurrency visitors; returns (samples, wall seconds)"""
+    samples = []
+    issued = 0
+
+    async def visitor():
+        nonlocal issued
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        async with aiohttp.ClientSession(timeout=client_timeout) as client:
+            # Each visitor gets its own session cookie and conversation, like a browser tab
+            await (await client.get(f'{base_url}/public')).read()
+            while issued < total:
+                index = issued
+                issued += 1
+                samples.append(await one_request(client, base_url, endpoint, make_question(index, distinct)))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(visitor() for _ in range(concurrency)))
+    return samples, time.perf_counter() - started
+
+# -----------------------------------------------------------------------------
+# Servers
+# -----------------------------------------------------------------------------
+def start_mock(args, port):
+    command = [sys.executable, os.path.join(ROOT, 'bench', 'mock_deepseek.py'), '--port', str(port),
+               '--tokens', str(args.tokens), '--token-delay', str(args.token_delay),
+               '--first-byte-delay', str(args.first_byte_delay), '--error-rate', str(args.error_rate),
+               '--rate-limit-rate', str(args.rate_limit_rate), '--retry-after', str(args.retry_after)]
+    if args.seed is not None:
+        command += ['--seed', str(args.seed)]
+    process = subprocess.Popen(command, cwd=ROOT)
+    wait_for_port(port)
+    return process
+
+def start_gunicorn(model, port, mock_url, extra_env, log_file):
+    name, workers, threads = model
+    app_target, worker_class = WORKER_MODELS[name]
+    env = {
+        **os.environ,
+        'DEEPSEEK_API_URL': mock_url,
+        'DEEPSEEK_API_KEY': 'bench-key',
+        'METRICS_DIR': tempfile.mkdtemp(prefix='bench-metrics-'),
+        **extra_env
+    }
+    command = [sys.executable, '-m', 'gunicorn', app_target, '--bind', f'127.0.0.1:{port}',
+               '--worker-class', worker_class, '--workers', str(workers), '--timeout', '120']
+    if name == 'gthread':
+        command += ['--threads', str(threads)]
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    wait_for_port(port)
+    return process
+
+def stop(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+async def benchmark_model(args, model, mock_url, log_file):
+    port = free_port()
+    server = start_gunicorn(model, port, mock_url, args.env, log_file)
+    base_url = f'http://127.0.0.1:{port}'
+    label = f"{model[0]}:{model[1]}" + (f"x{model[2]}" if model[0] == 'gthread' else '')
+    runs = []
+    try:
+        for endpoint in args.endpoints:
+            if args.warmup:
+                await drive(base_url, endpoint, min(args.concurrency, args.warmup), args.warmup, args.distinct, args.timeout)
+            peaks = {}
+            sampler = asyncio.ensure_future(sample_rss(server.pid, peaks))
+            try:
+                samples, wall = await drive(base_url, endpoint, args.concurrency, args.requests, args.distinct, args.timeout)
+            finally:
+                sampler.cancel()
+            ok = [s for s in samples if s.ok]
+            run = {
+                'model': label,
+                'endpoint': endpoint,
+                'requests': len(samples),
+                'ok': len(ok),
+                'errors': len(samples) - len(ok),
+                'status_counts': dict(Counter(s.status for s in samples)),
+                'duration_s': round(wall, 3),
+                'requests_per_s': round(len(ok) / wall, 2) if wall else None,
+                'ttft_ms': summarize_ms([s.ttft for s in ok if s.ttft is not None]),
+                'latency_ms': summarize_ms([s.latency for s in ok]),
+                'rss_mb': {
+                    'workers': sorted(round(v, 1) for v in peaks.values()),
+                    'peak_total': round(sum(peaks.values()), 1)
+                }
+            }
+            runs.append(run)
+            ttft = (run['ttft_ms'] or {}).get('p50')
+            print(f"  {label:<14} {endpoint:<8} {run['requests_per_s']} req/s, "
+                  f"TTFT p50 {ttft} ms, errors {run['errors']}", file=sys.stderr)
+    finally:
+        stop(server)
+    return runs
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--models', default='sync:4,gthread:2x8,aiohttp:2',
+                        help='comma-separated worker models, name:workers[xthreads] (default sync:4,gthread:2x8,aiohttp:2)')
+    parser.add_argument('--endpoints', default='stream,message', help='comma-separated: stream, message')
+    parser.add_argument('--concurrency', type=int, default=50, help='concurrent visitors (default 50)')
+    parser.add_argument('--requests', type=int, default=300, help='measured requests per model and endpoint (default 300)')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests first (default 10)')
+    parser.add_argument('--distinct', type=int, default=0,
+                        help='cycle through this many questions to exercise caching; 0 makes every question unique')
+    parser.add_argument('--timeout', type=float, default=120, help='client timeout per request in seconds')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra environment for the app, e.g. --env UPSTREAM_MAX_IN_FLIGHT=64')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--server-log', default=os.devnull, help='file for gunicorn output (default: discarded)')
+    mock = parser.add_argument_group('mock DeepSeek server')
+    mock.add_argument('--tokens', type=int, default=120)
+    mock.add_argument('--token-delay', type=float, default=0.02)
+    mock.add_argument('--first-byte-delay', type=float, default=0.3)
+    mock.add_argument('--error-rate', type=float, default=0.0)
+    mock.add_argument('--rate-limit-rate', type=float, default=0.0)
+    mock.add_argument('--retry-after', type=int, default=1)
+    mock.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+    args.models = [parse_model(spec.strip()) for spec in args.models.split(',') if spec.strip()]
+    args.endpoints = [e.strip() for e in args.endpoints.split(',') if e.strip()]
+    for endpoint in args.endpoints:
+        if endpoint not in ('stream', 'message'):
+            parser.error(f"unknown endpoint {endpoint!r}")
+    args.env = dict(item.split('=', 1) for item in args.env)
+    return args
+
+async def main_async(args):
+    mock_port = free_port()
+    mock = start_mock(args, mock_port)
+    mock_url = f'http://127.0.0.1:{mock_port}/v1/chat/completions'
+    runs = []
+    try:
+        with open(args.server_log, 'a') as log_file:
+            for model in args.models:
+                runs.extend(await benchmark_model(args, model, mock_url, log_file))
+    finally:
+        stop(mock)
+    return {
+        'version': RESULTS_VERSION,
+        'generated_at': datetime.now().isoformat(),
+        'git_commit': git_commit(),
+        'config': {
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'distinct_questions': args.distinct,
+            'app_env': args.env,
+            'mock': {
+                'tokens': args.tokens,
+                'token_delay': args.token_delay,
+                'first_byte_delay': args.first_byte_delay,
+                'error_rate': args.error_rate,
+                'rate_limit_rate': args.rate_limit_rate
+            }
+        },
+        'runs': runs
+    }
+
+def main():
+    args = parse_args()
+    results = asyncio.run(main_async(args))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        print(f"✅ Wrote {len(results['runs'])} runs to {args.output}", file=sys.stderr)
+    else:
+        print(text)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Build fingerprinted, precompressed copies of the static assets.
+Writes content-hashed files plus .gz (and .br when the brotli package is
+installed) variants under static/dist, and a manifest the app uses to
+serve them at /assets/ with immutable caching.
+
+Usage: python build_assets.py [--clean]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+
+import app as portfolio
+
+# Small files gain nothing from compression
+MIN_COMPRESS_BYTES = 256
+
+def source_files(static_dir, dist_dir):
+    """Every file under static/ except the build output itself, as relative paths"""
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.abspath(root) == os.path.abspath(dist_dir):
+            dirs[:] = []
+            continue
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) != os.path.abspath(dist_dir)]
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name), static_dir).replace(os.sep, '/')
+
+def fingerprinted_name(source, data):
+    stem, ext = os.path.splitext(source)
+    return f"{stem}.{portfolio.asset_fingerprint(data)}{ext}"
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def build(static_dir, dist_dir):
+    assets = {}
+    for source in source_files(static_dir, dist_dir):
+        with open(os.path.join(static_dir, source), 'rb') as f:
+            data = f.read()
+        built = fingerprinted_name(source, data)
+        target = os.path.join(dist_dir, built)
+        write_file(target, data)
+
+        sizes = [f"{len(data)}B"]
+        if len(data) >= MIN_COMPRESS_BYTES:
+            variants = portfolio.compress_variants(data)
+            for coding, suffix in portfolio.ASSET_ENCODINGS:
+                compressed = variants.get(coding)
+                if compressed is not None:
+                    write_file(target + suffix, compressed)
+                    sizes.append(f"{coding} {len(compressed)}B")
+        assets[source] = built
+        print(f"  {source} -> {built} ({', '.join(sizes)})")
+    return assets
+
+def write_manifest(path, assets):
+    manifest = {'version': portfolio.ASSET_MANIFEST_VERSION, 'assets': assets}
+    # Rename into place so running workers never read a partial manifest
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clean', action='store_true', help='remove previous build output first')
+    args = parser.parse_args()
+
+    static_dir = portfolio.app.static_folder
+    dist_dir = portfolio.STATIC_DIST_DIR
+    if args.clean and os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+    os.makedirs(dist_dir, exist_ok=True)
+
+    if portfolio.brotli is None:
+        print("brotli is not installed; writing gzip variants only")
+    print(f"Building static assets into {dist_dir}...")
+    assets = build(static_dir, dist_dir)
+    write_manifest(portfolio.ASSET_MANIFEST_PATH, assets)
+    print(f"✅ Wrote {len(assets)} assets and {portfolio.ASSET_MANIFEST_PATH}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
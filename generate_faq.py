@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Pre-generate answers to frequently asked questions for the current resume.
+The artifact is loaded at startup and served by /chat/message and
+/chat/stream without calling an LLM provider.
+
+Usage: python generate_faq.py [--questions FILE] [--workers N] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import app as portfolio
+
+DEFAULT_QUESTIONS_FILE = os.path.join(os.path.dirname(__file__), 'content', 'faq_questions.txt')
+
+def read_questions(file_path):
+    """One question per line; blank lines and # comments are skipped"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    questions = []
+    seen = set()
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        key = portfolio.normalize_question(line)
+        if key not in seen:
+            seen.add(key)
+            questions.append(line)
+    return questions
+
+def generate_answer(resume_text, question):
+    """Answer one question exactly as a first message in a fresh chat would be"""
+    messages, _ = portfolio.build_chat_messages({'resume_text': resume_text}, [], question)
+    upstream_info = {}
+    answer = portfolio.call_chat_api(messages, upstream_info)
+    return (answer, upstream_info.get('model')) if upstream_info.get('ok') else (None, None)
+
+def write_artifact(file_path, resume_text, answers, models):
+    artifact = {
+        'version': portfolio.FAQ_ARTIFACT_VERSION,
+        'resume_hash': portfolio.resume_hash(resume_text),
+        'generated_at': datetime.now().isoformat(),
+        'model': ', '.join(sorted(models)),
+        'answers': answers
+    }
+    # Write next to the target and rename so running workers never read a partial file
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(artifact, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, file_path)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--questions', default=DEFAULT_QUESTIONS_FILE, help='file with one question per line')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent upstream requests (default 4)')
+    parser.add_argument('--output', default=portfolio.FAQ_FILE_PATH, help='artifact to write')
+    args = parser.parse_args()
+
+    if not portfolio.api_key_configured():
+        print("❌ No LLM provider is configured - set DEEPSEEK_API_KEY (or LLM_PROVIDERS) in your .env file")
+        return 1
+
+    resume_text = portfolio.load_resume_from_file(portfolio.RESUME_FILE_PATH)
+    if not resume_text:
+        print(f"❌ No resume found at {portfolio.RESUME_FILE_PATH}")
+        return 1
+
+    questions = read_questions(args.questions)
+    print(f"Generating {len(questions)} answers with {args.workers} workers...")
+
+    answers = {}
+    models = set()
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {pool.submit(generate_answer, resume_text, question): question for question in questions}
+        for future in as_completed(futures):
+            question = futures[future]
+            answer, model = future.result()
+            if answer:
+                answers[question] = answer
+                models.add(model)
+                print(f"   ✅ {question}")
+            else:
+                print(f"   ❌ {question}")
+
+    # Keep the question file's order so diffs of the artifact stay readable
+    ordered = [{'question': q, 'answer': answers[q]} for q in questions if q in answers]
+    write_artifact(args.output, resume_text, ordered, models)
+    print(f"\nWrote {len(ordered)}/{len(questions)} answers to {args.output} "
+          f"(resume {portfolio.resume_hash(resume_text)})")
+    return 0 if len(ordered) == len(questions) else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
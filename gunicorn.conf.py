@@ -0,0 +1,113 @@
+"""
+Production gunicorn configuration (picked up automatically from this directory).
+Loads the app once in the master and freezes it before forking, so workers
+share the resume, FAQ answers, assets and compiled prompt copy-on-write.
+Per-worker resources (upstream pools, SQLite connections, background
+threads) are created after fork. Workers that grow past a memory ceiling
+are recycled, and boot time and RSS are logged for every worker.
+
+Usage: gunicorn            (worker model, size and ceiling from the environment)
+       WEB_WORKER_CLASS=gthread WEB_CONCURRENCY=2 WEB_THREADS=8 gunicorn
+       gunicorn wsgi:app  (an app named on the command line picks a worker model it can run on)
+"""
+
+import gc
+import os
+import signal
+import sys
+import time
+
+STARTED = time.monotonic()
+
+# Worker model -> (app, gunicorn worker class)
+WORKER_MODELS = {
+    'sync': ('wsgi:app', 'sync'),
+    'gthread': ('wsgi:app', 'gthread'),
+    'aiohttp': ('async_app:app', 'aiohttp.GunicornWebWorker'),
+}
+
+ASYNC_APP = WORKER_MODELS['aiohttp'][0]
+
+def command_line():
+    """(app, worker class) given on the gunicorn command line, None where not given"""
+    from gunicorn.config import Config
+
+    try:
+        args, _ = Config().parser().parse_known_args()
+    except SystemExit:
+        return None, None
+    return (args.args[0] if args.args else None), args.worker_class
+
+# The command line wins over this file, so an app named there (e.g. the existing
+# `gunicorn wsgi:app`) must get a worker model that can serve it: a WSGI app
+# handed to the aiohttp worker does not boot
+COMMAND_LINE_APP, COMMAND_LINE_WORKER_CLASS = command_line()
+default_model = 'aiohttp' if COMMAND_LINE_APP in (None, ASYNC_APP) else 'gthread'
+WEB_WORKER_CLASS = os.getenv('WEB_WORKER_CLASS', default_model).lower()
+if WEB_WORKER_CLASS not in WORKER_MODELS:
+    raise RuntimeError(f"WEB_WORKER_CLASS must be one of {', '.join(WORKER_MODELS)}, not {WEB_WORKER_CLASS!r}")
+if (COMMAND_LINE_APP is not None and COMMAND_LINE_WORKER_CLASS is None
+        and (COMMAND_LINE_APP == ASYNC_APP) != (WEB_WORKER_CLASS == 'aiohttp')):
+    raise RuntimeError(f"{COMMAND_LINE_APP} cannot run on WEB_WORKER_CLASS={WEB_WORKER_CLASS} workers; "
+                       f"use {'aiohttp' if COMMAND_LINE_APP == ASYNC_APP else 'gthread or sync'}")
+# Resident memory at which a worker finishes its requests and is replaced; 0 disables
+WORKER_MAX_RSS_MB = int(os.getenv('WORKER_MAX_RSS_MB', '512'))
+WORKER_RSS_CHECK_INTERVAL = float(os.getenv('WORKER_RSS_CHECK_INTERVAL', '10'))
+
+wsgi_app, worker_class = WORKER_MODELS[WEB_WORKER_CLASS]
+bind = os.getenv('BIND', f"0.0.0.0:{os.getenv('PORT', '5000')}")
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+# gunicorn turns sync workers with several threads into gthread, so size by the class in effect
+threads = int(os.getenv('WEB_THREADS', '8' if (COMMAND_LINE_WORKER_CLASS or worker_class) == 'gthread' else '1'))
+# Sync workers hold a whole SSE stream, which may take longer than gunicorn's default 30s
+timeout = int(os.getenv('WEB_TIMEOUT', '120'))
+preload_app = os.getenv('WEB_PRELOAD', '1').lower() not in ('0', 'false', 'no')
+
+if preload_app:
+    # Collecting while the app loads would only churn objects that live forever; frozen in when_ready
+    gc.disable()
+
+def megabytes(value):
+    return value / (1024 * 1024)
+
+def when_ready(server):
+    portfolio = sys.modules.get('app')
+    if portfolio is not None:
+        portfolio.prepare_for_fork()
+    # Move everything loaded so far out of the collector's reach: a collection in a
+    # worker would otherwise write to every object's header and un-share its page
+    gc.collect()
+    gc.freeze()
+    gc.enable()
+    elapsed = time.monotonic() - STARTED
+    memory = portfolio.process_memory() if portfolio is not None else None
+    detail = f"master RSS {megabytes(memory[0]):.1f} MB" if memory else 'app not preloaded'
+    server.log.info(f"Ready in {elapsed:.2f}s ({detail}, {gc.get_freeze_count()} objects frozen); "
+                    f"starting {workers} {WEB_WORKER_CLASS} workers")
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+
+def post_worker_init(worker):
+    import app as portfolio
+
+    boot = time.monotonic() - worker.forked_at
+    portfolio.metrics.observe('portfolio_worker_boot_seconds', boot, worker_class=WEB_WORKER_CLASS)
+    # Open pools and start background threads now rather than on the first request
+    portfolio.start_background_workers()
+
+    memory = portfolio.process_memory()
+    if memory is None:
+        worker.log.info(f"Worker {worker.pid} booted in {boot * 1000:.0f} ms")
+        return
+    resident, shared = memory
+    worker.log.info(f"Worker {worker.pid} booted in {boot * 1000:.0f} ms, "
+                    f"RSS {megabytes(resident):.1f} MB ({megabytes(shared):.1f} MB shared)")
+
+    def recycle(resident):
+        worker.log.warning(f"Worker {worker.pid} RSS {megabytes(resident):.1f} MB is over "
+                           f"WORKER_MAX_RSS_MB={WORKER_MAX_RSS_MB}; restarting it after in-flight requests")
+        # The same graceful exit the master requests on shutdown; the master then forks a replacement
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    portfolio.MemoryWatchdog(WORKER_MAX_RSS_MB * 1024 * 1024, WORKER_RSS_CHECK_INTERVAL, recycle).start()
@@ -137,6 +137,8 @@ class ChatInterface {
                     errorMessage = 'Request timed out. The AI service might be busy. Please try again in a moment.';
                 } else if (error.message.includes('401')) {
                     errorMessage = 'Authentication failed. Please check if the DeepSeek API key is configured correctly.';
+                } else if (error.message.includes('503')) {
+                    errorMessage = 'The assistant is busy right now. Please try again in a few seconds.';
                 } else if (error.message.includes('429')) {
                     errorMessage = 'Too many requests. Please wait a moment before trying again.';
                 } else if (error.message.includes('500')) {
@@ -164,102 +166,154 @@ class ChatInterface {
             const contentElement = assistantMessage.querySelector('.message-content');
             let fullResponse = '';
             let hasStartedStreaming = false;
-            
-            // Create fetch request for streaming
-            fetch('/chat/stream', {
-                method: 'POST',
-                headers: {
+            // Id of the last event received; a dropped stream is resumed from it
+            let lastEventId = null;
+            let resumeAttempts = 0;
+            const maxResumeAttempts = 3;
+
+            const finalize = () => {
+                const formattedText = this.formatMessage(fullResponse);
+                contentElement.innerHTML = formattedText;
+                assistantMessage.classList.remove('streaming');
+                
+                this.chatHistory.push({
+                    role: 'assistant',
+                    content: fullResponse,
+                    timestamp: new Date()
+                });
+                resolve(fullResponse);
+            };
+
+            const fail = (error) => {
+                // Remove the assistant message placeholder on error
+                if (assistantMessage && assistantMessage.parentNode) {
+                    assistantMessage.parentNode.removeChild(assistantMessage);
+                }
+                reject(error);
+            };
+
+            // Reconnect with Last-Event-ID after a dropped connection; the server
+            // continues the same answer without asking the AI again
+            const resumeOrFail = (error) => {
+                if (lastEventId && !error.fromServer && resumeAttempts < maxResumeAttempts) {
+                    resumeAttempts++;
+                    console.warn(`Stream interrupted, resuming (attempt ${resumeAttempts})...`);
+                    setTimeout(() => openStream(), 1000 * resumeAttempts);
+                    return;
+                }
+                fail(error);
+            };
+
+            const openStream = () => {
+                const headers = {
                     'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    message: message
-                })
-            })
-            .then(response => {
-                if (!response.ok) {
-                    throw new Error(`HTTP error! status: ${response.status}`);
+                };
+                if (lastEventId) {
+                    headers['Last-Event-ID'] = lastEventId;
                 }
 
-                const reader = response.body.getReader();
-                const decoder = new TextDecoder();
-
-                function readStream() {
-                    reader.read().then(({ done, value }) => {
-                        if (done) {
-                            // Stream completed naturally - finalize message
-                            if (fullResponse) {
-                                const formattedText = this.formatMessage(fullResponse);
-                                contentElement.innerHTML = formattedText;
-                                assistantMessage.classList.remove('streaming');
-                                
-                                this.chatHistory.push({
-                                    role: 'assistant',
-                                    content: fullResponse,
-                                    timestamp: new Date()
-                                });
+                fetch('/chat/stream', {
+                    method: 'POST',
+                    headers: headers,
+                    body: JSON.stringify({
+                        message: message
+                    })
+                })
+                .then(response => {
+                    if (!response.ok) {
+                        const error = new Error(`HTTP error! status: ${response.status}`);
+                        error.fromServer = true;
+                        throw error;
+                    }
+                    if (lastEventId && response.headers.get('X-Stream-Resumed') === null) {
+                        // The server no longer had the stream and started the answer over
+                        fullResponse = '';
+                    }
+
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    // Frames can be split across reads; keep the unfinished tail for the next read
+                    let pending = '';
+
+                    function readStream() {
+                        reader.read().then(({ done, value }) => {
+                            if (done) {
+                                // Ended without a complete event: treat it as a dropped connection
+                                if (lastEventId && resumeAttempts < maxResumeAttempts) {
+                                    resumeOrFail(new Error('Stream ended early'));
+                                } else if (fullResponse) {
+                                    finalize();
+                                } else {
+                                    resolve(fullResponse);
+                                }
+                                return;
                             }
-                            resolve(fullResponse);
-                            return;
-                        }
 
-                        // Process the chunk
-                        const chunk = decoder.decode(value, { stream: true });
-                        const lines = chunk.split('\n');
+                            // Process the chunk
+                            pending += decoder.decode(value, { stream: true });
+                            const lines = pending.split('\n');
+                            pending = lines.pop();
+
+                            for (const line of lines) {
+                                if (line.startsWith('id: ')) {
+                                    lastEventId = line.slice(4);
+                                    continue;
+                                }
+                                if (!line.startsWith('data: ')) {
+                                    continue;
+                                }
 
-                        for (const line of lines) {
-                            if (line.startsWith('data: ')) {
+                                let data;
                                 try {
-                                    const data = JSON.parse(line.slice(6));
-                                    
-                                    if (data.type === 'chunk' && data.chunk) {
-                                        if (!hasStartedStreaming) {
-                                            hasStartedStreaming = true;
-                                            // Remove the initial cursor, we'll add it back with content
-                                            contentElement.innerHTML = '';
-                                        }
-                                        fullResponse += data.chunk;
-                                        this.updateStreamingMessage(contentElement, fullResponse);
-                                    } else if (data.type === 'complete') {
-                                        // Streaming completed - remove cursor and finalize message
-                                        const formattedText = this.formatMessage(fullResponse);
-                                        contentElement.innerHTML = formattedText;
-                                        assistantMessage.classList.remove('streaming');
-                                        
-                                        this.chatHistory.push({
-                                            role: 'assistant',
-                                            content: fullResponse,
-                                            timestamp: new Date()
-                                        });
-                                        resolve(fullResponse);
-                                        return;
-                                    } else if (data.type === 'error') {
-                                        throw new Error(data.error);
-                                    }
+                                    data = JSON.parse(line.slice(6));
                                 } catch (e) {
                                     // Skip invalid JSON
                                     continue;
                                 }
+                                
+                                if (data.type === 'chunk' && data.chunk) {
+                                    if (!hasStartedStreaming) {
+                                        hasStartedStreaming = true;
+                                        // Remove the initial cursor, we'll add it back with content
+                                        contentElement.innerHTML = '';
+                                    }
+                                    fullResponse += data.chunk;
+                                    this.updateStreamingMessage(contentElement, fullResponse);
+                                } else if (data.type === 'complete') {
+                                    // The server sends a length and checksum instead of echoing the text
+                                    if (data.full_response !== undefined) {
+                                        fullResponse = data.full_response;
+                                    } else if (!this.matchesDigest(fullResponse, data)) {
+                                        console.warn('Streamed response does not match the server checksum');
+                                    }
+                                    // Streaming completed - remove cursor and finalize message
+                                    finalize();
+                                    return;
+                                } else if (data.type === 'error') {
+                                    const error = new Error(data.error);
+                                    error.fromServer = true;
+                                    throw error;
+                                }
                             }
-                        }
-
-                        // Continue reading
-                        readStream.call(this);
-                    }).catch(error => {
-                        console.error('Stream reading error:', error);
-                        reject(error);
-                    });
-                }
 
-                readStream.call(this);
-            })
-            .catch(error => {
-                console.error('Streaming request failed:', error);
-                // Remove the assistant message placeholder on error
-                if (assistantMessage && assistantMessage.parentNode) {
-                    assistantMessage.parentNode.removeChild(assistantMessage);
-                }
-                reject(error);
-            });
+                            // Continue reading
+                            readStream.call(this);
+                        }).catch(error => {
+                            console.error('Stream reading error:', error);
+                            reader.cancel().catch(() => {});
+                            resumeOrFail(error);
+                        });
+                    }
+
+                    readStream.call(this);
+                })
+                .catch(error => {
+                    console.error('Streaming request failed:', error);
+                    resumeOrFail(error);
+                });
+            };
+
+            openStream();
         });
     }
 
@@ -304,6 +358,24 @@ class ChatInterface {
         return messageDiv;
     }
 
+    matchesDigest(text, digest) {
+        const bytes = new TextEncoder().encode(text);
+        if (digest.length !== undefined && bytes.length !== digest.length) {
+            return false;
+        }
+        if (digest.crc32 === undefined) {
+            return true;
+        }
+        let crc = 0xFFFFFFFF;
+        for (const byte of bytes) {
+            crc ^= byte;
+            for (let bit = 0; bit < 8; bit++) {
+                crc = (crc >>> 1) ^ (0xEDB88320 & -(crc & 1));
+            }
+        }
+        return ((crc ^ 0xFFFFFFFF) >>> 0).toString(16).padStart(8, '0') === digest.crc32;
+    }
+
     updateStreamingMessage(contentElement, fullText) {
         // Format the message and add cursor
         const formattedText = this.formatMessage(fullText);
@@ -647,6 +719,9 @@ class ChatInterface {
                         const statusCode = data.api_test.split('_')[1];
                         window.resumeAssistant.showToast(`❌ API test failed (${statusCode})`, 'error');
                         this.addSystemMessage(`API test failed with status code ${statusCode}. Please check your API key and account status.`);
+                    } else if (data.api_test === 'pending') {
+                        window.resumeAssistant.showToast('API check in progress', 'info');
+                        this.addSystemMessage('The first API health check has not finished yet. Please try again in a few seconds.');
                     } else if (data.api_test.startsWith('error_')) {
                         const errorMsg = data.api_test.split('_')[1];
                         window.resumeAssistant.showToast('❌ API connection error', 'error');
@@ -0,0 +1,48 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def queue_depth(monkeypatch):
+    """Changes made to the portfolio_upstream_queue_depth gauge"""
+    changes = []
+    inc = app.metrics.inc
+
+    def record(name, amount=1, **labels):
+        if name == 'portfolio_upstream_queue_depth':
+            changes.append(amount)
+        inc(name, amount, **labels)
+    monkeypatch.setattr(app.metrics, 'inc', record)
+    return changes
+
+
+def test_free_slots_are_not_counted_as_queued(queue_depth):
+    controller = app.AdmissionController(max_in_flight=2, queue_size=0, queue_timeout=0.1)
+    tickets = [controller.acquire(), controller.acquire()]
+    assert controller.stats()['in_flight'] == 2
+    assert queue_depth == []
+    with pytest.raises(app.UpstreamOverloaded) as shed:
+        controller.acquire()
+    assert shed.value.reason == 'queue_full'
+    for ticket in tickets:
+        ticket.release()
+
+
+def test_waiting_requests_are_counted_until_admitted(queue_depth):
+    controller = app.AdmissionController(max_in_flight=1, queue_size=1, queue_timeout=2)
+    first = controller.acquire()
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(controller.acquire()))
+    waiter.start()
+    while controller.stats()['queue_depth'] == 0:
+        time.sleep(0.01)
+    assert queue_depth == [1]
+
+    first.release()
+    waiter.join()
+    assert controller.stats()['queue_depth'] == 0 and queue_depth == [1, -1]
+    admitted[0].release()
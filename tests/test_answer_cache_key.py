@@ -0,0 +1,47 @@
+import uuid
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def resume_data():
+    return {'resume_text': 'Jane Doe\nSenior engineer at Example Corp, 2019-2024.'}
+
+
+def conversation(turns):
+    conversation_id = f'test-{uuid.uuid4().hex}'
+    for question, answer in turns:
+        app.conversation_store.append(conversation_id, question, answer)
+    return conversation_id
+
+
+def cache_key(resume_data, turns, question='How do you approach design reviews?'):
+    key, answer, _, messages, _ = app.prepare_chat_turn(resume_data, conversation(turns), question)
+    assert answer is None and messages is not None
+    return key
+
+
+def test_key_ignores_turns_the_prompt_leaves_out(resume_data, monkeypatch):
+    monkeypatch.setattr(app.prompt_builder, 'history_turns', 2)
+    recent = [('Second question', 'Second answer'), ('Third question', 'Third answer')]
+    assert cache_key(resume_data, [('First question', 'First answer')] + recent) == \
+        cache_key(resume_data, [('Another first question', 'Another answer')] + recent)
+
+
+def test_key_follows_turns_the_prompt_includes(resume_data, monkeypatch):
+    # With a window wider than the old fixed five turns, the sixth-newest turn is in the prompt
+    monkeypatch.setattr(app.prompt_builder, 'history_turns', 8)
+    recent = [(f'Question {i}', f'Answer {i}') for i in range(5)]
+    assert cache_key(resume_data, [('Oldest question', 'Oldest answer')] + recent) != \
+        cache_key(resume_data, [('Other oldest question', 'Other answer')] + recent)
+
+
+def test_key_ignores_turns_over_the_token_budget(resume_data, monkeypatch):
+    system_tokens = app.prompt_builder.system_prompt(resume_data['resume_text'])[1]
+    monkeypatch.setattr(app.prompt_builder, 'token_budget', system_tokens + 100)
+    recent = [('Latest question', 'Latest answer')]
+    long_turn = ('Long question', 'x' * 4000)
+    assert cache_key(resume_data, [long_turn] + recent) == \
+        cache_key(resume_data, [('Different long question', 'y' * 4000)] + recent)
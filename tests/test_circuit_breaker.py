@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+import pytest
+
+import app
+import async_app
+
+RESET = 0.05
+
+
+@pytest.fixture
+def provider():
+    provider = app.OpenAICompatibleProvider('test', 'http://127.0.0.1:9/v1/chat/completions', 'test-key', 'test-model')
+    provider.breaker = app.CircuitBreaker('test', failure_threshold=1, reset_timeout=RESET)
+    return provider
+
+
+def trip_and_cool_down(breaker):
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    time.sleep(RESET * 1.2)
+
+
+def test_half_open_allows_a_single_trial(provider):
+    breaker = provider.breaker
+    trip_and_cool_down(breaker)
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+    assert not breaker.available()
+
+
+def test_abandoned_trial_is_granted_again_after_reset_timeout(provider):
+    router = app.ProviderRouter([provider])
+    trip_and_cool_down(provider.breaker)
+    assert provider.breaker.allow()
+    # The trial's outcome is never recorded
+    assert router.candidates() == []
+    time.sleep(RESET * 1.2)
+    assert router.candidates() == [provider]
+    assert provider.breaker.allow()
+
+
+def test_unexpected_error_settles_the_trial(provider, monkeypatch):
+    class BrokenClient:
+        def post(self, payload, stream=False, timeout=None):
+            raise ValueError('bad payload')
+
+    monkeypatch.setattr(provider, 'client', lambda: BrokenClient())
+    trip_and_cool_down(provider.breaker)
+    with pytest.raises(ValueError):
+        app.send_upstream(provider, {}, max_attempts=1)
+    # The trial counted as a failure: open again rather than stuck half-open
+    assert provider.breaker.state == 'open'
+    assert not provider.breaker.available()
+
+
+def test_cancelled_trial_is_handed_back(provider):
+    class HangingSession:
+        async def post(self, *args, **kwargs):
+            await asyncio.sleep(10)
+
+    async def cancel_mid_request():
+        task = asyncio.ensure_future(async_app.send_upstream_async(HangingSession(), provider, {}, max_attempts=1))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    trip_and_cool_down(provider.breaker)
+    asyncio.run(cancel_mid_request())
+    assert provider.breaker.state == 'open'
+    assert provider.breaker.available()
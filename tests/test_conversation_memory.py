@@ -0,0 +1,73 @@
+import uuid
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def resume_data():
+    return {'resume_text': 'Jane Doe\nSenior engineer at Example Corp, 2019-2024.'}
+
+
+@pytest.fixture
+def memory(monkeypatch):
+    memory = app.ConversationMemory(mode='summary', recent_turns=1)
+    monkeypatch.setattr(app, 'conversation_memory', memory)
+    # Narrower than the turns a lagging fold leaves uncovered
+    monkeypatch.setattr(app.prompt_builder, 'history_turns', 2)
+    return memory
+
+
+def conversation(turns):
+    conversation_id = f'test-{uuid.uuid4().hex}'
+    for question, answer in turns:
+        app.conversation_store.append(conversation_id, question, answer)
+    return conversation_id
+
+
+def summarizer(text, ok=True):
+    def call_chat_api(messages, upstream_info=None, max_tokens=None):
+        upstream_info['ok'] = ok
+        return text
+    return call_chat_api
+
+
+def prompt_for(resume_data, conversation_id, question='What are you working on now?'):
+    key, answer, _, messages, _ = app.prepare_chat_turn(resume_data, conversation_id, question)
+    assert answer is None
+    return key, [message['content'] for message in messages]
+
+
+def test_failed_fold_keeps_every_uncovered_turn(resume_data, memory, monkeypatch):
+    turns = [(f'Question {i}', f'Answer {i}') for i in range(6)]
+    conversation_id = conversation(turns)
+    monkeypatch.setattr(app, 'call_chat_api', summarizer(app.UPSTREAM_UNAVAILABLE_MESSAGE, ok=False))
+
+    assert memory.fold(conversation_id) is False
+    assert memory.failed_folds == 1
+    _, contents = prompt_for(resume_data, conversation_id)
+    for question, answer in turns:
+        assert question in contents and answer in contents
+
+
+def test_prompt_after_fold_carries_summary_and_uncovered_turns(resume_data, memory, monkeypatch):
+    conversation_id = conversation([(f'Question {i}', f'Answer {i}') for i in range(4)])
+    monkeypatch.setattr(app, 'call_chat_api', summarizer('They asked about questions 0 to 2.'))
+
+    assert memory.fold(conversation_id) is True
+    _, contents = prompt_for(resume_data, conversation_id)
+    assert any('They asked about questions 0 to 2.' in content for content in contents)
+    assert 'Question 3' in contents and 'Question 2' not in contents
+
+
+def test_key_covers_the_summary(resume_data, memory, monkeypatch):
+    turns = [(f'Question {i}', f'Answer {i}') for i in range(3)]
+    first, second = conversation(turns), conversation(turns)
+    monkeypatch.setattr(app, 'call_chat_api', summarizer('They asked about Python.'))
+    memory.fold(first)
+    monkeypatch.setattr(app, 'call_chat_api', summarizer('They asked about Rust.'))
+    memory.fold(second)
+
+    # Same uncovered turn and question, different summaries
+    assert prompt_for(resume_data, first)[0] != prompt_for(resume_data, second)[0]
@@ -0,0 +1,54 @@
+import pytest
+
+import app
+
+
+@pytest.fixture(scope='module')
+def matcher():
+    return app.IntentMatcher(app.PORTFOLIO_DATA)
+
+
+@pytest.mark.parametrize('question, intents', [
+    ("What's your email?", ['email']),
+    ("What is your email address and phone number", ['email', 'phone']),
+    ("list your skills", ['skills']),
+    ("Where did you study?", ['education']),
+    ("What is your educational background? Which degree?", ['education']),
+    ("What's your GitHub?", ['github']),
+    ("How can I contact you?", ['contact']),
+    ("When were you at IO-Solutions?", ['company']),
+    ("What did you do at Advance AI Lab?", ['company']),
+    ("When did you study at Concordia?", ['education']),
+    ("How long were you at IO-Solutions?", ['company']),
+    ("Could you share your email?", ['email']),
+    ("How should I contact you?", ['contact']),
+])
+def test_lookup_questions_are_answered(matcher, question, intents):
+    matched = matcher.match(question)
+    assert matched is not None
+    assert matched[1] == intents
+
+
+@pytest.mark.parametrize('question', [
+    "Tell me about your background",
+    "What is your background?",
+    "What are your qualifications?",
+    "Can you code?",
+    "Where is your code?",
+    "What is your address?",
+    "Tell me about yourself",
+    "How do your skills compare to a senior engineer?",
+    "What is your experience with Spark at Advance AI Lab?",
+    "Tell me more about that",
+    "Why did you leave Advance AI Lab and IO-Solutions?",
+    "How did you use Python at IO-Solutions?",
+    "Would you relocate for a job at Advance AI Lab?",
+    "What did you enjoy at IO-Solutions?",
+])
+def test_open_questions_go_to_the_model(matcher, question):
+    assert matcher.match(question) is None
+
+
+def test_answer_is_first_person_from_portfolio_data(matcher):
+    answer, _ = matcher.match("When were you at IO-Solutions?")
+    assert answer == "I was at IO-Solutions from Aug 2022 to Dec 2023 as a Voice and Non Voice Associate."
@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def registry(tmp_path):
+    registry = app.MetricsRegistry(directory=str(tmp_path))
+    registry.define('test_requests_total', 'counter', 'Requests')
+    registry.define('test_active_streams', 'gauge', 'Open streams')
+    registry.define('test_latency_seconds', 'histogram', 'Latency', (0.1, 1.0))
+    return registry
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_worker(registry, pid, requests, streams):
+    with open(os.path.join(registry.directory, f'{pid}.json'), 'w', encoding='utf-8') as f:
+        json.dump({'test_requests_total': [[[], requests]],
+                   'test_active_streams': [[[], streams]],
+                   'test_latency_seconds': [[[], [1, 2, 0.6, 2]]]}, f)
+
+
+def test_exited_workers_keep_their_counters_and_histograms(registry):
+    registry.inc('test_requests_total', 3)
+    registry.inc('test_active_streams', 1)
+    write_worker(registry, exited_pid(), requests=5, streams=2)
+    write_worker(registry, exited_pid(), requests=7, streams=4)
+
+    for _ in range(2):  # retiring is done once, later scrapes read exited.json
+        merged = registry.collect()
+        assert merged['test_requests_total'][()] == 15
+        assert merged['test_latency_seconds'][()] == [2, 4, 1.2, 4]
+        # Streams of exited workers are closed
+        assert merged['test_active_streams'][()] == 1
+    assert sorted(os.listdir(registry.directory)) == ['.lock', f'{os.getpid()}.json', 'exited.json']
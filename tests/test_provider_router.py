@@ -0,0 +1,31 @@
+import app
+
+
+def provider(name):
+    return app.OpenAICompatibleProvider(name, f'http://127.0.0.1:9/{name}/v1/chat/completions', 'test-key', 'test-model')
+
+
+def test_providers_without_first_token_samples_follow_measured_ones():
+    # Used only for plain completions: successes but no time-to-first-token
+    unmeasured = provider('unmeasured')
+    for _ in range(10):
+        unmeasured.window.record_outcome(True)
+    measured = provider('measured')
+    measured.window.record_outcome(True)
+    measured.window.record_ttft(0.8)
+
+    router = app.ProviderRouter([unmeasured, measured])
+    assert [p.name for p in router.candidates()] == ['measured', 'unmeasured']
+
+
+def test_unmeasured_providers_keep_configuration_order():
+    router = app.ProviderRouter([provider('primary'), provider('secondary')])
+    assert [p.name for p in router.candidates()] == ['primary', 'secondary']
+
+
+def test_fastest_measured_provider_leads():
+    slow, fast = provider('slow'), provider('fast')
+    slow.window.record_ttft(2.0)
+    fast.window.record_ttft(0.3)
+    router = app.ProviderRouter([slow, fast])
+    assert [p.name for p in router.candidates()] == ['fast', 'slow']
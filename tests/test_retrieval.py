@@ -0,0 +1,50 @@
+import math
+
+import pytest
+
+import app
+
+PASSAGES = [
+    'Built data pipelines in Python and Airflow',
+    'Deployed services on Kubernetes and AWS',
+    'Python tooling for machine learning experiments, Python everywhere',
+    'Studied computer science at Concordia University',
+]
+
+
+def reference_scores(passages, query):
+    """Textbook BM25 with the index's k1 and b"""
+    documents = [app.tokenize(passage) for passage in passages]
+    avg_length = sum(map(len, documents)) / len(documents)
+    scores = []
+    for tokens in documents:
+        score = 0.0
+        for term in set(app.tokenize(query)):
+            df = sum(term in document for document in documents)
+            tf = tokens.count(term)
+            if not tf:
+                continue
+            idf = math.log1p((len(documents) - df + 0.5) / (df + 0.5))
+            norm = app.BM25_K1 * (1 - app.BM25_B + app.BM25_B * len(tokens) / max(avg_length, 1.0))
+            score += idf * tf * (app.BM25_K1 + 1) / (tf + norm)
+        scores.append(score)
+    return scores
+
+
+@pytest.mark.parametrize('query', ['python pipelines', 'kubernetes', 'where did you study', 'python aws concordia'])
+def test_search_ranks_like_bm25(query):
+    index = app.RetrievalIndex(PASSAGES)
+    scores = reference_scores(PASSAGES, query)
+    expected = sorted(sorted(range(len(PASSAGES)), key=lambda i: -scores[i])[:2])
+    assert index.search(query, k=2) == [i for i in expected if scores[i] > 0]
+
+
+def test_postings_hold_only_terms_present():
+    index = app.RetrievalIndex(PASSAGES)
+    pairs = sum(len(set(app.tokenize(passage))) for passage in PASSAGES)
+    assert len(index.data) == len(index.doc_ids) == pairs
+    assert index.indptr[-1] == pairs
+
+
+def test_unknown_terms_match_nothing():
+    assert app.RetrievalIndex(PASSAGES).search('zzz qqq') == []